@@ -2,11 +2,16 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.models import User
+from parking_app import wallet
 from parking_app.models import Booking, UserProfile, ParkingSpot, UserReport
+from parking_app.pagination import PaginationError, filter_bookings, paginate_bookings
 from django.db.models import Q
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 import json
 
+ADMIN_PAGE_SIZE = 500
+
 
 @csrf_exempt
 @require_http_methods(["GET"])
@@ -61,14 +66,17 @@ def admin_users(request):
 @require_http_methods(["GET"])
 def admin_bookings(request):
     try:
-        # Optional filters
-        status = request.GET.get("status")
+        # Optional filters (status/from/to shared with the other booking lists)
         slot = request.GET.get("slot")
         search = request.GET.get("search")
 
-        bookings_qs = Booking.objects.select_related("user", "parking_spot").all()
-        if status:
-            bookings_qs = bookings_qs.filter(status__iexact=status)
+        bookings_qs = Booking.objects.select_related(
+            "user", "parking_spot", "user__profile"
+        )
+        try:
+            bookings_qs = filter_bookings(bookings_qs, request.GET)
+        except PaginationError as e:
+            return JsonResponse({"success": False, "message": str(e)}, status=400)
         if slot:
             bookings_qs = bookings_qs.filter(parking_spot__spot_number__iexact=slot)
         if search:
@@ -86,13 +94,8 @@ def admin_bookings(request):
                 actual_duration = int(delta.total_seconds() / 60)
 
             # Get number plate from user profile (correct source)
-            number_plate = ""
-            if b.user_id:
-                try:
-                    profile = UserProfile.objects.get(user_id=b.user_id)
-                    number_plate = profile.number_plate or ""
-                except UserProfile.DoesNotExist:
-                    number_plate = ""
+            profile = getattr(b.user, "profile", None) if b.user_id else None
+            number_plate = (profile.number_plate or "") if profile else ""
 
             return {
                 "id": b.id,
@@ -111,8 +114,20 @@ def admin_bookings(request):
                 "amount": float(getattr(b, "total_cost", 0) or 0),
             }
 
-        data = [serialize_booking(b) for b in bookings_qs.order_by("-start_time")[:500]]
-        return JsonResponse({"success": True, "bookings": data})
+        # Keyset pages of up to 500 (the old fixed cap); follow next_cursor
+        try:
+            page, next_cursor = paginate_bookings(
+                bookings_qs,
+                request.GET,
+                default=ADMIN_PAGE_SIZE,
+                maximum=ADMIN_PAGE_SIZE,
+            )
+        except PaginationError as e:
+            return JsonResponse({"success": False, "message": str(e)}, status=400)
+        data = [serialize_booking(b) for b in page]
+        return JsonResponse(
+            {"success": True, "bookings": data, "next_cursor": next_cursor}
+        )
     except Exception as e:
         return JsonResponse(
             {"success": False, "message": f"Error fetching bookings: {str(e)}"},
@@ -235,12 +250,14 @@ def admin_users_create(request):
         profile, _ = UserProfile.objects.get_or_create(user=user)
         profile.phone = data.get("phone", profile.phone)
         profile.address = data.get("address", profile.address)
+        profile.save(update_fields=["phone", "address", "updated_at"])
         if "balance" in data:
+            # Opening balance goes through the ledger as an adjustment
             try:
-                profile.balance = float(data.get("balance") or 0)
-            except Exception:
-                profile.balance = 0
-        profile.save()
+                balance = Decimal(str(data.get("balance") or 0))
+            except InvalidOperation:
+                balance = Decimal("0.00")
+            wallet.set_balance(user, balance, note="Opening balance set by admin")
 
         return JsonResponse({"success": True, "id": user.id})
     except json.JSONDecodeError:
@@ -381,12 +398,22 @@ def admin_users_update(request, user_id):
         for pfield in ["phone", "address", "license_number", "number_plate"]:
             if pfield in data:
                 setattr(profile, pfield, data[pfield])
+        # Balance is written by the ledger below, never from this stale copy
+        profile.save(
+            update_fields=[
+                pfield
+                for pfield in ["phone", "address", "license_number", "number_plate"]
+                if pfield in data
+            ]
+            + ["updated_at"]
+        )
         if "balance" in data:
             try:
-                profile.balance = float(data.get("balance") or 0)
-            except Exception:
-                pass
-        profile.save()
+                balance = Decimal(str(data.get("balance") or 0))
+            except InvalidOperation:
+                balance = None
+            if balance is not None:
+                wallet.set_balance(user, balance)
 
         # Return updated user data including role information
         return JsonResponse(
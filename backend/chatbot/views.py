@@ -1,12 +1,27 @@
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from rest_framework import status
+from rest_framework import serializers, status
 from django.utils import timezone
 from datetime import timedelta
 
 from parking_app.models import Booking, ParkingSpot, UserProfile
-from parking_app.serializers import BookingSerializer
+from parking_app.serializers import (
+    BookingSerializer,
+    booking_list_values,
+    parse_booking_fields,
+    serialize_booking_rows,
+)
+from parking_app.bookings import BookingConflict, create_active_booking
+from parking_app.outbox import enqueue_whatsapp
+from parking_app.pagination import (
+    PaginationError,
+    filter_bookings,
+    next_page_url,
+    ordered,
+    paginate_bookings,
+    wants_page,
+)
 
 # Twilio imports for WhatsApp webhook
 from django.views.decorators.csrf import csrf_exempt
@@ -22,94 +37,28 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def send_whatsapp_message(to_phone, message):
+def send_whatsapp_message(to_phone, message, booking=None, user=None):
     """
-    Send a WhatsApp message programmatically using Twilio REST API.
+    Queue a WhatsApp message for delivery through the notification outbox.
+
+    The message is persisted and sent by the outbox dispatcher (see
+    parking_app/outbox.py), so callers never wait on Twilio.
 
     Args:
         to_phone: Recipient phone number (with country code, e.g., +1234567890)
         message: Message text to send
+        booking, user: optional records the message is about
 
     Returns:
-        bool: True if message sent successfully, False otherwise
+        bool: True if the message was queued, False otherwise
     """
     try:
-        from django.conf import settings
-        from twilio.rest import Client
-
-        # Get Twilio credentials from settings
-        account_sid = getattr(settings, "TWILIO_ACCOUNT_SID", None)
-        auth_token = getattr(settings, "TWILIO_AUTH_TOKEN", None)
-        from_number = getattr(settings, "TWILIO_WHATSAPP_NUMBER", "+14155238886")
-
-        print(f"🔍 [Twilio] Credentials check:")
-        print(
-            f"   Account SID: {account_sid[:10]}..."
-            if account_sid and len(account_sid) > 10
-            else f"   Account SID: {account_sid}"
-        )
-        print(f"   Auth Token: {'***' if auth_token else 'None'}")
-        print(f"   From Number: {from_number}")
-
-        if not account_sid or not auth_token:
-            print("❌ [Twilio] Credentials not configured!")
-            logger.warning(
-                "Twilio credentials not configured - cannot send WhatsApp message"
-            )
-            return False
-
-        # Initialize Twilio client
-        try:
-            client = Client(account_sid, auth_token)
-            print("✅ [Twilio] Client initialized successfully")
-        except Exception as client_error:
-            print(f"❌ [Twilio] Failed to initialize client: {client_error}")
-            raise
-
-        # Format phone number for WhatsApp (add whatsapp: prefix)
-        if not to_phone.startswith("whatsapp:"):
-            # Clean the number
-            to_phone = to_phone.replace(" ", "").replace("-", "")
-
-            # Handle South African numbers (0713291359 -> +27713291359)
-            if to_phone.startswith("0") and len(to_phone) == 10:
-                to_phone = "27" + to_phone[1:]
-
-            # Ensure it has + prefix for international format
-            if not to_phone.startswith("+"):
-                to_phone = f"+{to_phone}"
-
-            to_phone = f"whatsapp:{to_phone}"
-
-        # Send message
-        from_formatted = f"whatsapp:{from_number.replace('whatsapp:', '')}"
-        print(f"📱 [Twilio] Sending message:")
-        print(f"   From: {from_formatted}")
-        print(f"   To: {to_phone}")
-        print(f"   Message: {message[:100]}...")
-
-        twilio_message = client.messages.create(
-            body=message,
-            from_=from_formatted,
-            to=to_phone,
-        )
-
-        print(f"✅ [Twilio] Message sent successfully!")
-        print(f"   Message SID: {twilio_message.sid}")
-        print(f"   Status: {twilio_message.status}")
-        logger.info(
-            f"✅ WhatsApp message sent to {to_phone} - SID: {twilio_message.sid}, Status: {twilio_message.status}"
-        )
+        entry = enqueue_whatsapp(to_phone, message, user=user, booking=booking)
+        print(f"📤 [Outbox] WhatsApp message {entry.id} queued for {to_phone}")
         return True
-
     except Exception as e:
-        print(f"❌ [Twilio] Error sending message: {e}")
-        print(f"   To: {to_phone}")
-        print(f"   From: {from_number}")
-        import traceback
-
-        traceback.print_exc()
-        logger.error(f"❌ Failed to send WhatsApp message to {to_phone}: {e}")
+        print(f"❌ [Outbox] Error queueing message for {to_phone}: {e}")
+        logger.error(f"❌ Failed to queue WhatsApp message to {to_phone}: {e}")
         return False
 
 
@@ -160,6 +109,8 @@ def booking_history(request):
     """
     Return user's booking history with optional filter window: days, weeks, months.
     Query params: window=days|weeks|months, value=<int>
+    Also accepts the shared status/from/to filters, and cursor/page_size for
+    keyset pages (see parking_app.pagination).
     """
     try:
         window = request.query_params.get("window", "days")
@@ -177,8 +128,35 @@ def booking_history(request):
         since = timezone.now() - delta
         bookings = Booking.objects.filter(
             user=request.user, start_time__gte=since
-        ).order_by("-start_time")
-        return Response(BookingSerializer(bookings, many=True).data)
+        ).select_related("parking_spot", "user__profile")
+        fields = None
+
+        def serialize(rows):
+            if fields is None:
+                return BookingSerializer(rows, many=True).data
+            return serialize_booking_rows(rows, fields)
+
+        try:
+            bookings = filter_bookings(bookings, request.query_params)
+            # ?fields= returns slim values() rows (see BOOKING_LIST_FIELDS)
+            if "fields" in request.query_params:
+                fields = parse_booking_fields(request.query_params["fields"])
+                bookings = booking_list_values(bookings, fields)
+            if wants_page(request.query_params):
+                page, next_cursor = paginate_bookings(bookings, request.query_params)
+                return Response(
+                    {
+                        "next": next_page_url(request, next_cursor),
+                        "next_cursor": next_cursor,
+                        "results": serialize(page),
+                    }
+                )
+        except PaginationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except serializers.ValidationError as e:
+            return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(serialize(ordered(bookings)))
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -351,40 +329,8 @@ def reserve_slot(request):
             f"Reserve API: Attempting to reserve {spot.spot_number} (ID: {slot_id}) for user {request.user.username}"
         )
 
-        # Check for active bookings on this spot (this is the real check!)
-        active_booking = Booking.objects.filter(
-            parking_spot=spot, status="active"
-        ).first()
-
-        if active_booking:
-            logger.warning(
-                f"Reserve API: Slot {spot.spot_number} has active booking ID: {active_booking.id}"
-            )
-            return Response(
-                {
-                    "error": f"Slot {spot.spot_number} is already booked (Booking #{active_booking.id})"
-                },
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
-        # Check if user already has an active booking
-        user_active_booking = Booking.objects.filter(
-            user=request.user, status="active"
-        ).first()
-
-        if user_active_booking:
-            logger.warning(
-                f"Reserve API: User {request.user.username} already has active booking ID: {user_active_booking.id}"
-            )
-            return Response(
-                {
-                    "error": f"You already have an active booking for {user_active_booking.parking_spot.spot_number}. Please complete or cancel it first."
-                },
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
         # Note: We don't check spot.is_occupied here because IoT sensor data might be stale
-        # The real check is if there's an active booking (checked above)
+        # The real check is the one-active-booking constraint on the insert below
 
         # Create booking like mobile app: pay for actual time parked, not fixed duration
         start = timezone.now()
@@ -392,29 +338,62 @@ def reserve_slot(request):
         end = start
 
         # Get number_plate safely
-        number_plate = ""
-        try:
-            profile = UserProfile.objects.get(user=request.user)
-            number_plate = profile.number_plate or ""
-        except UserProfile.DoesNotExist:
+        number_plate = (
+            UserProfile.objects.filter(user=request.user)
+            .values_list("number_plate", flat=True)
+            .first()
+        )
+        if number_plate is None:
             logger.warning(f"Reserve API: User {request.user.username} has no profile")
-            pass
 
-        booking = Booking.objects.create(
-            user=request.user,
-            parking_spot=spot,
-            start_time=start,
-            end_time=end,  # Same as start_time - billing based on actual parked time
-            duration_minutes=0,  # No fixed duration - pay for actual time
-            status="active",
-            grace_period_started=start,  # Enable timer detection (20 second grace period)
-            timer_started=None,  # Will be set when car detected by sensor
-            number_plate=number_plate,
-        )
+        try:
+            booking = create_active_booking(
+                request.user,
+                spot.id,
+                start_time=start,
+                end_time=end,  # Same as start_time - billing based on actual parked time
+                duration_minutes=0,  # No fixed duration - pay for actual time
+                grace_period_started=start,  # Enable timer detection (20 second grace period)
+                timer_started=None,  # Will be set when car detected by sensor
+                number_plate=number_plate or "",
+            )
+        except BookingConflict as conflict:
+            existing = conflict.existing
+            if conflict.reason == "spot":
+                logger.warning(
+                    f"Reserve API: Slot {spot.spot_number} has active booking ID: {existing.id}"
+                )
+                return Response(
+                    {
+                        "error": f"Slot {spot.spot_number} is already booked (Booking #{existing.id})"
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if conflict.reason == "reservation":
+                logger.warning(
+                    f"Reserve API: Slot {spot.spot_number} is reserved (Reservation #{existing.id})"
+                )
+                return Response(
+                    {
+                        "error": f"Slot {spot.spot_number} is reserved by another user from {existing.start_time:%H:%M}"
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            logger.warning(
+                f"Reserve API: User {request.user.username} already has active booking ID: {existing.id}"
+            )
+            return Response(
+                {
+                    "error": f"You already have an active booking for {existing.parking_spot.spot_number}. Please complete or cancel it first."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        booking.parking_spot = spot
 
-        # Mark spot as occupied
+        # Mark spot as occupied (an instance save adjusts the lot counters and
+        # the allocation pool for this one spot)
         spot.is_occupied = True
-        spot.save()
+        spot.save(update_fields=["is_occupied", "updated_at"])
 
         logger.info(
             f"Reserve API: Successfully created booking ID: {booking.id} for {spot.spot_number}"
@@ -628,7 +607,7 @@ def get_whatsapp_user(from_number):
         profile, _ = UserProfile.objects.get_or_create(user=user)
         if not profile.phone or profile.phone != from_number_clean:
             profile.phone = from_number_clean
-            profile.save()
+            profile.save(update_fields=["phone", "updated_at"])
         return user
     except User.DoesNotExist:
         user = User.objects.create_user(
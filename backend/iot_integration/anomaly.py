@@ -0,0 +1,232 @@
+"""
+Streaming anomaly detection over the IoT sensor reading stream
+Keeps constant-memory online statistics per device (transition rate, distance
+variance, battery slope, RSSI) and writes one DeviceLog warning per episode of
+flapping, stuck sensors, dying batteries or weak signal.
+"""
+
+import math
+import threading
+
+from django.conf import settings
+
+from .models import DeviceLog
+
+DEFAULT_ANOMALY = {
+    "alpha": 0.1,  # EWMA weight of the newest reading
+    "min_readings": 20,  # warm-up before any flag can be raised
+    "flapping_rate": 0.3,  # share of readings that flip a slot
+    "stuck_readings": 120,  # identical distance readings in a row
+    "stuck_variance": 0.01,  # cm^2
+    "battery_min_level": 15.0,  # percent
+    "battery_min_hours": 24.0,  # projected hours until empty
+    "battery_half_life_hours": 24.0,  # weighting of the battery trend fit
+    "rssi_min": -85.0,  # dBm
+    "recovery_ratio": 0.5,  # clear flapping once the rate halves
+}
+
+ANOMALY_MESSAGES = {
+    "flapping": "Sensor flapping: occupancy changed on {rate:.0%} of recent readings",
+    "stuck": "Sensor stuck: distance unchanged at {distance} cm for {repeats} readings",
+    "battery": "Battery dying: {level:.0f}% ({slope:+.2f}%/h, ~{hours:.0f}h left)",
+    "weak_signal": "Weak signal: average RSSI {rssi:.0f} dBm",
+}
+
+
+class DeviceStats:
+    """Online statistics for one device; every update is O(1) time and memory"""
+
+    __slots__ = (
+        "readings",
+        "last_state",
+        "transition_rate",
+        "distance_mean",
+        "distance_var",
+        "last_distance",
+        "distance_repeats",
+        "battery_origin",
+        "battery_last_hours",
+        "battery_sums",
+        "battery_level",
+        "rssi_mean",
+        "active",
+    )
+
+    def __init__(self):
+        self.readings = 0
+        self.last_state = None
+        self.transition_rate = 0.0
+        self.distance_mean = None
+        self.distance_var = 0.0
+        self.last_distance = None
+        self.distance_repeats = 0
+        self.battery_origin = None
+        self.battery_last_hours = 0.0
+        # Exponentially weighted sums for a battery ~ time regression: w, t, b, tt, tb
+        self.battery_sums = [0.0, 0.0, 0.0, 0.0, 0.0]
+        self.battery_level = None
+        self.rssi_mean = None
+        self.active = set()
+
+    def update(self, reading, config):
+        alpha = config["alpha"]
+        self.readings += 1
+
+        state = (reading.is_occupied, reading.slot1_occupied, reading.slot2_occupied)
+        changed = self.last_state is not None and state != self.last_state
+        self.transition_rate += alpha * (
+            (1.0 if changed else 0.0) - self.transition_rate
+        )
+        self.last_state = state
+
+        distance = reading.distance_cm
+        if distance is not None:
+            if self.distance_mean is None:
+                self.distance_mean = distance
+            else:
+                delta = distance - self.distance_mean
+                self.distance_mean += alpha * delta
+                self.distance_var = (1 - alpha) * (
+                    self.distance_var + alpha * delta * delta
+                )
+            if distance == self.last_distance:
+                self.distance_repeats += 1
+            else:
+                self.distance_repeats = 1
+            self.last_distance = distance
+
+        if reading.battery_level is not None:
+            self._update_battery(reading.timestamp, reading.battery_level, config)
+
+        if reading.signal_strength is not None:
+            if self.rssi_mean is None:
+                self.rssi_mean = reading.signal_strength
+            else:
+                self.rssi_mean += alpha * (reading.signal_strength - self.rssi_mean)
+
+    def _update_battery(self, timestamp, level, config):
+        if self.battery_origin is None:
+            self.battery_origin = timestamp
+        hours = (timestamp - self.battery_origin).total_seconds() / 3600.0
+        elapsed = max(0.0, hours - self.battery_last_hours)
+        decay = 0.5 ** (elapsed / config["battery_half_life_hours"])
+        self.battery_last_hours = hours
+        w, t, b, tt, tb = (s * decay for s in self.battery_sums)
+        self.battery_sums = [
+            w + 1,
+            t + hours,
+            b + level,
+            tt + hours * hours,
+            tb + hours * level,
+        ]
+        self.battery_level = level
+
+    def battery_slope(self):
+        """Weighted least-squares slope of battery level, in percent per hour"""
+        w, t, b, tt, tb = self.battery_sums
+        denominator = w * tt - t * t
+        # Need a few readings spread over at least ~30 minutes to trust a trend
+        if w < 3 or denominator / (w * w) < 0.25:
+            return None
+        return (w * tb - t * b) / denominator
+
+    def detect(self, config):
+        """Return {anomaly: message_kwargs} for conditions currently present"""
+        found = {}
+        if self.readings < config["min_readings"]:
+            return found
+
+        flapping_limit = config["flapping_rate"]
+        if "flapping" in self.active:
+            flapping_limit *= config["recovery_ratio"]
+        if self.transition_rate > flapping_limit:
+            found["flapping"] = {"rate": self.transition_rate}
+
+        if (
+            self.distance_repeats >= config["stuck_readings"]
+            and self.distance_var <= config["stuck_variance"]
+        ):
+            found["stuck"] = {
+                "distance": self.last_distance,
+                "repeats": self.distance_repeats,
+            }
+
+        slope = self.battery_slope()
+        if self.battery_level is not None:
+            hours_left = (
+                self.battery_level / -slope
+                if slope is not None and slope < 0
+                else math.inf
+            )
+            if (
+                self.battery_level <= config["battery_min_level"]
+                or hours_left <= config["battery_min_hours"]
+            ):
+                found["battery"] = {
+                    "level": self.battery_level,
+                    "slope": slope or 0.0,
+                    "hours": min(hours_left, 9999),
+                }
+
+        if self.rssi_mean is not None and self.rssi_mean < config["rssi_min"]:
+            found["weak_signal"] = {"rssi": self.rssi_mean}
+        return found
+
+
+class SensorAnomalyDetector:
+    """Tracks per-device statistics and logs anomaly episodes"""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def get_config(self):
+        config = dict(DEFAULT_ANOMALY)
+        config.update(getattr(settings, "SENSOR_ANOMALY", {}) or {})
+        return config
+
+    def observe(self, device, reading):
+        """Feed one stored SensorData row; returns the anomalies that started"""
+        config = self.get_config()
+        with self._lock:
+            stats = self._stats.get(device.id)
+            if stats is None:
+                stats = self._stats[device.id] = DeviceStats()
+            stats.update(reading, config)
+            found = stats.detect(config)
+            started = {k: v for k, v in found.items() if k not in stats.active}
+            stats.active = set(found)
+
+        # One warning per episode: only log when a condition first appears
+        if started:
+            DeviceLog.objects.bulk_create(
+                [
+                    DeviceLog(
+                        device=device,
+                        log_type="warning",
+                        message=ANOMALY_MESSAGES[name].format(**values),
+                    )
+                    for name, values in started.items()
+                ]
+            )
+        return started
+
+    def active_anomalies(self):
+        """Snapshot of {device_pk: [anomaly, ...]} currently flagged"""
+        with self._lock:
+            return {
+                device_pk: sorted(stats.active)
+                for device_pk, stats in self._stats.items()
+                if stats.active
+            }
+
+    def reset(self, device_pk=None):
+        with self._lock:
+            if device_pk is None:
+                self._stats.clear()
+            else:
+                self._stats.pop(device_pk, None)
+
+
+# Global detector instance fed by the sensor_data endpoint
+anomaly_detector = SensorAnomalyDetector()
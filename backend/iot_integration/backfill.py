@@ -0,0 +1,409 @@
+"""
+Store-and-forward backfill for IoT sensor readings
+ESP32 devices buffer timestamped readings while offline and upload them in
+bulk. Readings are inserted in timestamp order, then occupancy transitions are
+replayed against the booking timeline to correct timer starts, completion
+times and charges (one recomputation pass per affected booking).
+"""
+
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DeviceLog, SensorData
+from .occupancy import SlotDebouncer, get_debounce_config
+
+READING_FIELDS = [
+    "is_occupied",
+    "distance_cm",
+    "battery_level",
+    "signal_strength",
+    "temperature",
+    "humidity",
+    "slot1_occupied",
+    "slot2_occupied",
+    "ir_alert",
+]
+
+# Dual-sensor slot fields map onto the IoT lot spots (same as sensor_data)
+SLOT_FIELDS = {"slot1_occupied": "Slot A", "slot2_occupied": "Slot B"}
+
+
+class BackfillError(ValueError):
+    pass
+
+
+def parse_reading_time(raw, received_at):
+    """Accept ISO 8601, epoch seconds/milliseconds, or {"age_ms": n}"""
+    if isinstance(raw, dict) and "age_ms" in raw:
+        return received_at - timedelta(milliseconds=float(raw["age_ms"]))
+    if isinstance(raw, (int, float)):
+        seconds = raw / 1000.0 if raw > 1e11 else float(raw)
+        return datetime.fromtimestamp(seconds, tz=dt_timezone.utc)
+    if isinstance(raw, str):
+        parsed = parse_datetime(raw)
+        if parsed is None:
+            raise BackfillError(f"Invalid timestamp: {raw}")
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed, dt_timezone.utc)
+        return parsed
+    raise BackfillError(f"Invalid timestamp: {raw}")
+
+
+def prepare_readings(device, raw_readings, received_at=None):
+    """Validate and sort uploaded readings; returns unsaved SensorData rows"""
+    received_at = received_at or timezone.now()
+    max_readings = getattr(settings, "IOT_BACKFILL_MAX_READINGS", 20000)
+    if not isinstance(raw_readings, list) or not raw_readings:
+        raise BackfillError("readings must be a non-empty list")
+    if len(raw_readings) > max_readings:
+        raise BackfillError(f"At most {max_readings} readings per upload")
+
+    rows = []
+    for index, raw in enumerate(raw_readings):
+        if not isinstance(raw, dict):
+            raise BackfillError(f"Reading {index} must be an object")
+        when = raw.get("timestamp")
+        if when is None and "age_ms" in raw:
+            when = {"age_ms": raw["age_ms"]}
+        if when is None:
+            raise BackfillError(f"Reading {index} has no timestamp")
+        timestamp = parse_reading_time(when, received_at)
+        if timestamp > received_at + timedelta(seconds=60):
+            raise BackfillError(f"Reading {index} is in the future")
+
+        values = {field: raw.get(field) for field in READING_FIELDS}
+        values["is_occupied"] = bool(values["is_occupied"])
+        values["firmware_occupied"] = values["is_occupied"]
+        rows.append(
+            SensorData(
+                device=device,
+                parking_spot_id=device.parking_spot_id,
+                timestamp=timestamp,
+                **values,
+            )
+        )
+
+    rows.sort(key=lambda r: r.timestamp)
+    return rows
+
+
+def ingest_backfill(device, raw_readings, received_at=None):
+    """Insert buffered readings and reconcile affected bookings.
+
+    Returns a summary dict with inserted/duplicate counts and booking changes.
+    """
+    rows = prepare_readings(device, raw_readings, received_at)
+    window_start, window_end = rows[0].timestamp, rows[-1].timestamp
+
+    # Re-uploads after a partial failure must not duplicate readings; distinct
+    # readings that share a timestamp are both kept
+    seen = {
+        _reading_key(values)
+        for values in SensorData.objects.filter(
+            device=device, timestamp__gte=window_start, timestamp__lte=window_end
+        ).values_list("timestamp", *READING_FIELDS)
+    }
+    new_rows = []
+    for row in rows:
+        key = _reading_key(
+            [row.timestamp] + [getattr(row, field) for field in READING_FIELDS]
+        )
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+
+    with transaction.atomic():
+        SensorData.objects.bulk_create(new_rows, batch_size=500)
+        changes = replay_transitions(device, window_start, window_end)
+        DeviceLog.objects.create(
+            device=device,
+            log_type="info",
+            message=(
+                f"Backfill received: {len(new_rows)} reading(s) from "
+                f"{window_start.isoformat()} to {window_end.isoformat()}, "
+                f"{len(changes)} booking(s) reconciled"
+            ),
+        )
+
+    return {
+        "received": len(rows),
+        "inserted": len(new_rows),
+        "duplicates": len(rows) - len(new_rows),
+        "window_start": window_start,
+        "window_end": window_end,
+        "bookings": changes,
+    }
+
+
+def _reading_key(values):
+    """Identity of a reading: its timestamp and every reported value"""
+    timestamp, *fields = values
+    return (timestamp, *(float(v) if isinstance(v, int) else v for v in fields))
+
+
+def _spot_channels(device):
+    """Map reading fields to the (spot id, spot number) they describe"""
+    from parking_app.models import ParkingSpot
+
+    channels = {}
+    if device.parking_spot_id:
+        channels["is_occupied"] = (
+            device.parking_spot_id,
+            device.parking_spot.spot_number,
+        )
+    for spot in ParkingSpot.objects.filter(
+        parking_lot__name="IoT Smart Parking",
+        spot_number__in=list(SLOT_FIELDS.values()),
+    ).only("id", "spot_number"):
+        for field, spot_number in SLOT_FIELDS.items():
+            if spot.spot_number == spot_number:
+                channels[field] = (spot.id, spot.spot_number)
+    return channels
+
+
+def _load_timelines(device, channels, window_start, window_end):
+    """Debounced occupancy timelines per spot: sorted (times, states)"""
+    fields = list(channels)
+    readings = list(
+        SensorData.objects.filter(
+            device=device, timestamp__gte=window_start, timestamp__lte=window_end
+        )
+        .order_by("timestamp", "id")
+        .values_list("timestamp", *fields)
+    )
+    before = (
+        SensorData.objects.filter(device=device, timestamp__lt=window_start)
+        .order_by("-timestamp", "-id")
+        .values_list("timestamp", *fields)
+        .first()
+    )
+    if before:
+        readings.insert(0, before)
+
+    timelines = {}
+    for position, field in enumerate(fields, start=1):
+        spot_id, spot_number = channels[field]
+        # Same hysteresis as the live stream, so replay agrees with it
+        config = get_debounce_config(spot_number)
+        debouncer = SlotDebouncer(
+            config["window"], config["min_consistent"], config["stable_ms"]
+        )
+        times, states = [], []
+        for row in readings:
+            if row[position] is None:
+                continue
+            if not states:
+                times.append(row[0])
+                states.append(bool(row[position]))
+                continue
+            now_ms = int(row[0].timestamp() * 1000)
+            state = debouncer.update(states[-1], row[position], now_ms)
+            if state != states[-1]:
+                times.append(row[0])
+                states.append(state)
+        timelines[spot_id] = (times, states)
+    return timelines
+
+
+def _first_state_at_or_after(times, states, since, state, until):
+    """First instant in [since, until] at which the spot is in ``state``"""
+    index = bisect_left(times, since)
+    # The spot may already be in the requested state when ``since`` starts
+    if index > 0 and states[index - 1] == state and times[index - 1] <= since:
+        return since
+    while index < len(times) and times[index] <= until:
+        if states[index] == state:
+            return times[index]
+        index += 1
+    return None
+
+
+def replay_transitions(device, window_start, window_end):
+    """Correct bookings whose timeline overlaps the backfilled window"""
+    from django.db.models import Q
+    from parking_app.models import Booking
+    from parking_app.wallet import booking_charged_total
+
+    channels = _spot_channels(device)
+    if not channels:
+        return []
+    timelines = _load_timelines(device, channels, window_start, window_end)
+
+    bookings = list(
+        Booking.objects.filter(
+            parking_spot_id__in=list(timelines),
+            start_time__lte=window_end,
+            status__in=["active", "completed"],
+        )
+        .filter(Q(completed_at__isnull=True) | Q(completed_at__gte=window_start))
+        .select_related("user", "parking_spot__parking_lot")
+        .order_by("start_time")
+    )
+    if not bookings:
+        return []
+
+    charged = {booking.id: booking_charged_total(booking) for booking in bookings}
+    was_active = {booking.id for booking in bookings if booking.status == "active"}
+
+    changes, to_update = [], []
+    for booking in bookings:
+        times, states = timelines[booking.parking_spot_id]
+        if not times:
+            continue
+        change = _reconcile_booking(
+            booking, times, states, window_start, window_end, charged
+        )
+        if change:
+            changes.append(change)
+            to_update.append(booking)
+
+    if to_update:
+        Booking.objects.bulk_update(
+            to_update,
+            [
+                "timer_started",
+                "grace_period_ended",
+                "last_billing_at",
+                "status",
+                "end_time",
+                "completed_at",
+                "duration_minutes",
+                "total_cost",
+            ],
+        )
+        _apply_charge_deltas(changes, {b.id: b for b in to_update})
+        completed = [
+            b for b in to_update if b.status == "completed" and b.id in was_active
+        ]
+        _release_completed_spots(completed, timelines)
+        _release_completed_slots(
+            device, [b.parking_spot.spot_number for b in completed]
+        )
+    return changes
+
+
+def _reconcile_booking(booking, times, states, window_start, window_end, charged):
+    from parking_app import tariffs
+
+    original = {
+        "timer_started": booking.timer_started,
+        "completed_at": booking.completed_at,
+        "status": booking.status,
+    }
+    search_from = max(booking.start_time, window_start)
+    latest = booking.completed_at or window_end
+
+    # Arrival: a car seen earlier than the live stream noticed
+    arrival = _first_state_at_or_after(times, states, search_from, True, latest)
+    if arrival and (booking.timer_started is None or arrival < booking.timer_started):
+        if booking.timer_started is None and booking.status != "active":
+            arrival = None  # never parked per the live stream; leave as is
+        else:
+            booking.timer_started = arrival
+            if booking.grace_period_started:
+                booking.grace_period_ended = arrival
+            if booking.last_billing_at is None or booking.last_billing_at < arrival:
+                booking.last_billing_at = arrival
+
+    # Departure: the car left while the device was offline
+    if booking.timer_started:
+        departure = _first_state_at_or_after(
+            times, states, booking.timer_started, False, window_end
+        )
+        if departure and (
+            booking.status == "active"
+            or (booking.completed_at and departure < booking.completed_at)
+        ):
+            booking.status = "completed"
+            booking.completed_at = departure
+            booking.end_time = departure
+
+    if (
+        booking.timer_started == original["timer_started"]
+        and booking.completed_at == original["completed_at"]
+        and booking.status == original["status"]
+    ):
+        return None
+
+    change = {
+        "booking_id": booking.id,
+        "timer_started": booking.timer_started,
+        "completed_at": booking.completed_at,
+        "status": booking.status,
+        "charge_delta": Decimal("0.00"),
+    }
+    if booking.status == "completed" and booking.timer_started:
+        elapsed = max(
+            0, int((booking.completed_at - booking.timer_started).total_seconds())
+        )
+        final_cost = tariffs.session_cost(
+            booking.timer_started,
+            booking.timer_started + timedelta(seconds=elapsed),
+            booking.parking_spot,
+        )
+        booking.duration_minutes = elapsed // 60
+        booking.total_cost = final_cost
+        change["total_cost"] = final_cost
+        change["charge_delta"] = final_cost - (charged.get(booking.id) or Decimal("0"))
+    return change
+
+
+def _apply_charge_deltas(changes, bookings_by_id):
+    """Charge missing amounts / refund over-charges for recomputed bookings"""
+    from parking_app import wallet
+
+    for change in changes:
+        delta = change["charge_delta"].quantize(Decimal("0.01"))
+        if delta == 0:
+            continue
+        booking = bookings_by_id[change["booking_id"]]
+        if delta > 0:
+            wallet.debit(
+                booking.user,
+                delta,
+                booking=booking,
+                note="Backfill correction - sensor readings replayed",
+            )
+        else:
+            wallet.credit(
+                booking.user,
+                -delta,
+                type="adjustment",
+                booking=booking,
+                note="Backfill refund - sensor readings replayed",
+            )
+
+
+def _release_completed_spots(bookings, timelines):
+    """Free the spots of bookings the replay completed (counters, pool, status)"""
+    for booking in bookings:
+        times, states = timelines[booking.parking_spot_id]
+        if states and states[-1]:
+            continue  # another car is parked there by the end of the window
+        spot = booking.parking_spot
+        if spot.is_occupied:
+            spot.is_occupied = False
+            spot.save(update_fields=["is_occupied"])
+
+
+def _release_completed_slots(device, slot_numbers):
+    """Clear LED booking state for slots whose booking was completed by replay"""
+    if not slot_numbers:
+        return
+    metadata = device.metadata or {}
+    for slot_number in slot_numbers:
+        if slot_number == "Slot A":
+            metadata["slot1_booked"] = False
+            metadata["slot1_led_state"] = "off"
+        elif slot_number == "Slot B":
+            metadata["slot2_booked"] = False
+            metadata["slot2_led_state"] = "off"
+    device.metadata = metadata
+    device.save(update_fields=["metadata"])
@@ -0,0 +1,250 @@
+"""
+Distance-based occupancy calibration for ultrasonic parking sensors
+Learns per-spot empty-floor / vehicle distances from SensorData history and
+classifies readings server-side so thresholds can be tuned without reflashing.
+"""
+
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F, Window
+from django.db.models.functions import Coalesce, RowNumber
+from django.utils import timezone
+
+from .models import DeviceLog, IoTDevice, SensorData, SpotCalibration
+
+DEFAULT_CALIBRATION = {
+    "history_days": 14,
+    "max_samples": 5000,  # most recent readings per spot
+    "min_samples": 50,
+    "min_gap_cm": 20.0,  # minimum empty/vehicle separation to trust two modes
+    "empty_only_ratio": 0.6,  # threshold as a share of empty distance (one mode)
+    "drift_tolerance_cm": 10.0,
+    "drift_tolerance_ratio": 0.1,
+}
+
+
+def get_calibration_config():
+    config = dict(DEFAULT_CALIBRATION)
+    config.update(getattr(settings, "SENSOR_CALIBRATION", {}) or {})
+    return config
+
+
+def otsu_threshold(distances, bins=64):
+    """Split a distance sample into two modes (Otsu's method, vectorized)"""
+    hist, edges = np.histogram(distances, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    cum_mean = np.cumsum(hist * centers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_low = cum_mean / weight_low
+        mean_high = (cum_mean[-1] - cum_mean) / weight_high
+        between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    between = np.nan_to_num(between[:-1])
+    return float(edges[int(np.argmax(between)) + 1])
+
+
+def fit_spot(distances, firmware_occupied, config):
+    """Fit calibration values for one spot from its distance history.
+
+    ``firmware_occupied`` must be the raw sensor flags (SensorData's
+    ``firmware_occupied``): they are the independent reference the fit is
+    checked against. Returns a dict of calibration fields, or None if the history is too short
+    or there is no usable empty-floor mode.
+    """
+    distances = np.asarray(distances, dtype=float)
+    firmware_occupied = np.asarray(firmware_occupied, dtype=bool)
+    valid = np.isfinite(distances) & (distances > 0)
+    distances = distances[valid]
+    firmware_occupied = firmware_occupied[valid]
+    if distances.size < config["min_samples"] or np.ptp(distances) == 0:
+        return None
+
+    threshold = otsu_threshold(distances)
+    low = distances[distances < threshold]
+    high = distances[distances >= threshold]
+    empty = float(np.median(high)) if high.size else None
+    vehicle = float(np.median(low)) if low.size else None
+
+    if empty is None or vehicle is None or empty - vehicle < config["min_gap_cm"]:
+        # Single mode: only trust it as the empty floor if firmware agrees
+        if firmware_occupied.mean() >= 0.5:
+            return None
+        empty = float(np.median(distances))
+        vehicle = None
+        threshold = empty * config["empty_only_ratio"]
+    else:
+        threshold = (empty + vehicle) / 2
+
+    agreement = float(np.mean((distances < threshold) == firmware_occupied))
+    return {
+        "empty_distance_cm": round(empty, 1),
+        "vehicle_distance_cm": round(vehicle, 1) if vehicle is not None else None,
+        "threshold_cm": round(threshold, 1),
+        "sample_count": int(distances.size),
+        "agreement_rate": round(agreement, 3),
+    }
+
+
+def load_distance_history(spot_ids=None, config=None):
+    """Fetch recent distance readings grouped by spot: {spot_id: (distances, flags)}
+
+    Flags are the raw firmware occupancy, never the server's own classification,
+    and at most ``max_samples`` of the newest readings per spot are read.
+    """
+    config = config or get_calibration_config()
+    since = timezone.now() - timedelta(days=config["history_days"])
+    readings = (
+        SensorData.objects.filter(
+            timestamp__gte=since,
+            distance_cm__isnull=False,
+            firmware_occupied__isnull=False,
+        )
+        .annotate(spot=Coalesce("parking_spot_id", "device__parking_spot_id"))
+        .filter(spot__isnull=False)
+    )
+    if spot_ids is not None:
+        readings = readings.filter(spot__in=spot_ids)
+    rows = list(
+        readings.annotate(
+            rank=Window(
+                RowNumber(), partition_by=[F("spot")], order_by=F("timestamp").desc()
+            )
+        )
+        .filter(rank__lte=config["max_samples"])
+        .values_list("spot", "distance_cm", "firmware_occupied")
+    )
+    if not rows:
+        return {}
+
+    spots = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    distances = np.fromiter((row[1] for row in rows), dtype=float, count=len(rows))
+    flags = np.fromiter((row[2] for row in rows), dtype=bool, count=len(rows))
+
+    order = np.argsort(spots, kind="stable")
+    spots, distances, flags = spots[order], distances[order], flags[order]
+    unique_spots, starts = np.unique(spots, return_index=True)
+    return {
+        int(spot_id): (d, f)
+        for spot_id, d, f in zip(
+            unique_spots, np.split(distances, starts[1:]), np.split(flags, starts[1:])
+        )
+    }
+
+
+def recalibrate_spots(spot_ids=None, dry_run=False):
+    """Recompute calibrations in batch and flag sensors whose empty floor drifted.
+
+    Returns a list of result dicts, one per spot with enough history.
+    """
+    config = get_calibration_config()
+    history = load_distance_history(spot_ids, config)
+    existing = {
+        c.parking_spot_id: c
+        for c in SpotCalibration.objects.filter(parking_spot_id__in=list(history))
+    }
+    now = timezone.now()
+    results, to_create, to_update, drift_logs = [], [], [], []
+
+    for spot_id, (distances, flags) in history.items():
+        fitted = fit_spot(distances, flags, config)
+        if fitted is None:
+            continue
+        calibration = existing.get(spot_id)
+        previous_empty = calibration.empty_distance_cm if calibration else None
+        drift = (
+            abs(fitted["empty_distance_cm"] - previous_empty)
+            if previous_empty is not None
+            else 0.0
+        )
+        is_drifted = previous_empty is not None and drift > max(
+            config["drift_tolerance_cm"],
+            config["drift_tolerance_ratio"] * previous_empty,
+        )
+        results.append(
+            {
+                "parking_spot_id": spot_id,
+                "drift_cm": round(drift, 1),
+                "is_drifted": is_drifted,
+                **fitted,
+            }
+        )
+        if dry_run:
+            continue
+
+        if calibration is None:
+            calibration = SpotCalibration(parking_spot_id=spot_id)
+            to_create.append(calibration)
+        else:
+            to_update.append(calibration)
+        if calibration.manual_override:
+            # Keep admin-tuned thresholds, but still report drift and fit quality
+            fitted = {
+                k: v
+                for k, v in fitted.items()
+                if k in ("sample_count", "agreement_rate")
+            }
+        for field, value in fitted.items():
+            setattr(calibration, field, value)
+        calibration.drift_cm = round(drift, 1)
+        calibration.is_drifted = is_drifted
+        calibration.calibrated_at = now
+        calibration.updated_at = now
+        if is_drifted:
+            drift_logs.append(
+                (spot_id, previous_empty, results[-1]["empty_distance_cm"])
+            )
+
+    if not dry_run:
+        SpotCalibration.objects.bulk_create(to_create)
+        SpotCalibration.objects.bulk_update(
+            to_update,
+            [
+                "empty_distance_cm",
+                "vehicle_distance_cm",
+                "threshold_cm",
+                "sample_count",
+                "agreement_rate",
+                "drift_cm",
+                "is_drifted",
+                "calibrated_at",
+                "updated_at",
+            ],
+        )
+        _log_drift(drift_logs)
+    return results
+
+
+def _log_drift(drift_logs):
+    if not drift_logs:
+        return
+    devices = {
+        d.parking_spot_id: d
+        for d in IoTDevice.objects.filter(
+            parking_spot_id__in=[spot_id for spot_id, _, _ in drift_logs]
+        )
+    }
+    DeviceLog.objects.bulk_create(
+        [
+            DeviceLog(
+                device=devices[spot_id],
+                log_type="warning",
+                message=f"Calibration drift: empty floor moved from {old:.1f} cm to {new:.1f} cm",
+            )
+            for spot_id, old, new in drift_logs
+            if spot_id in devices
+        ]
+    )
+
+
+def classify_reading(spot, distance_cm):
+    """Classify a distance reading with the spot's calibration (None if unavailable)"""
+    if spot is None or distance_cm is None:
+        return None
+    try:
+        calibration = spot.calibration
+    except SpotCalibration.DoesNotExist:
+        return None
+    return calibration.classify(distance_cm)
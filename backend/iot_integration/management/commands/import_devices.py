@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Django management command to provision IoT devices from a CSV file
+Columns: device_id, device_type, name, parking_lot (id or name) or lot_name,
+spot_number, spot_type, location, ip_address, mac_address
+"""
+
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+from iot_integration.provisioning import ProvisioningError, provision_devices
+
+
+class Command(BaseCommand):
+    help = "Bulk register IoT devices and their spot mappings from a CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="Path to the device CSV file")
+        parser.add_argument(
+            "--no-create-spots",
+            action="store_true",
+            help="Fail rows whose spot does not exist instead of creating it",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Validate the file without registering anything",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        if dry_run:
+            self.stdout.write(
+                self.style.WARNING("DRY RUN MODE - No changes will be made")
+            )
+
+        try:
+            with open(options["csv_file"], newline="", encoding="utf-8-sig") as f:
+                rows = list(csv.DictReader(f))
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['csv_file']}: {e}")
+
+        try:
+            summary = provision_devices(
+                rows,
+                create_spots=not options["no_create_spots"],
+                dry_run=dry_run,
+            )
+        except ProvisioningError as e:
+            for error in e.errors:
+                # CSV line numbers: header is line 1
+                line = error["row"] + 2 if error["row"] is not None else "-"
+                self.stdout.write(
+                    self.style.ERROR(
+                        f"  ❌ Line {line} ({error.get('device_id') or 'no id'}): "
+                        + "; ".join(error["errors"])
+                    )
+                )
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'Validated' if dry_run else 'Registered'} {summary['devices_created']} device(s), "
+                f"{summary['spots_created']} new spot(s)"
+            )
+        )
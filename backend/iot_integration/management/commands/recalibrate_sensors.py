@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Django management command to recompute per-spot distance calibrations
+Run nightly (cron) or after installing/moving sensors.
+"""
+
+from django.core.management.base import BaseCommand
+from iot_integration.calibration import recalibrate_spots
+
+
+class Command(BaseCommand):
+    help = "Learn per-spot occupancy thresholds from historical distance readings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--spot",
+            type=int,
+            action="append",
+            dest="spot_ids",
+            help="Only recalibrate the given parking spot id (repeatable)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Show fitted thresholds without saving them",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        if dry_run:
+            self.stdout.write(
+                self.style.WARNING("DRY RUN MODE - No changes will be made")
+            )
+
+        results = recalibrate_spots(spot_ids=options["spot_ids"], dry_run=dry_run)
+        if not results:
+            self.stdout.write(
+                self.style.WARNING("No spots with enough distance history")
+            )
+            return
+
+        drifted = 0
+        for result in results:
+            line = (
+                f"  📍 Spot {result['parking_spot_id']}: empty={result['empty_distance_cm']} cm, "
+                f"vehicle={result['vehicle_distance_cm']} cm, threshold={result['threshold_cm']} cm, "
+                f"samples={result['sample_count']}, agreement={result['agreement_rate']:.0%}"
+            )
+            if result["is_drifted"]:
+                drifted += 1
+                self.stdout.write(
+                    self.style.WARNING(f"{line} ⚠️ drifted {result['drift_cm']} cm")
+                )
+            else:
+                self.stdout.write(line)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Calibrated {len(results)} spot(s), {drifted} flagged for drift"
+            )
+        )
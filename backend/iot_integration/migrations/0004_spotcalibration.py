@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking_app', '0011_booking_number_plate'),
+        ('iot_integration', '0003_iotdevice_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpotCalibration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('empty_distance_cm', models.FloatField(blank=True, help_text='Typical distance to the empty floor', null=True)),
+                ('vehicle_distance_cm', models.FloatField(blank=True, help_text='Typical distance to a parked vehicle', null=True)),
+                ('threshold_cm', models.FloatField(blank=True, help_text='Readings below this distance are classified as occupied', null=True)),
+                ('sample_count', models.IntegerField(default=0)),
+                ('agreement_rate', models.FloatField(blank=True, help_text='Share of readings where firmware and server classification agree', null=True)),
+                ('drift_cm', models.FloatField(default=0, help_text='Empty-floor shift since the previous calibration')),
+                ('is_drifted', models.BooleanField(default=False)),
+                ('manual_override', models.BooleanField(default=False, help_text='Keep manually tuned thresholds on recalibration')),
+                ('calibrated_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('parking_spot', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='calibration', to='parking_app.parkingspot')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("iot_integration", "0004_spotcalibration"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="sensordata",
+            name="timestamp",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+    ]
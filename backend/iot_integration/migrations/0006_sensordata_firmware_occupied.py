@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:04
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def copy_uncalibrated_flags(apps, schema_editor):
+    """Readings of never-calibrated spots still hold the raw firmware flag"""
+    SensorData = apps.get_model("iot_integration", "SensorData")
+    SpotCalibration = apps.get_model("iot_integration", "SpotCalibration")
+    calibrated = SpotCalibration.objects.values("parking_spot_id")
+    SensorData.objects.exclude(
+        Q(parking_spot_id__in=calibrated) | Q(device__parking_spot_id__in=calibrated)
+    ).update(firmware_occupied=models.F("is_occupied"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("iot_integration", "0005_sensordata_timestamp_default"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sensordata",
+            name="firmware_occupied",
+            field=models.BooleanField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_uncalibrated_flags, migrations.RunPython.noop),
+    ]
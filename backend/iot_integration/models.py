@@ -39,6 +39,9 @@ class SensorData(models.Model):
         ParkingSpot, on_delete=models.CASCADE, null=True, blank=True
     )
     is_occupied = models.BooleanField()
+    # The flag exactly as the firmware reported it; ``is_occupied`` may hold the
+    # server's calibrated classification instead (see calibration.py)
+    firmware_occupied = models.BooleanField(null=True, blank=True)
     distance_cm = models.FloatField(null=True, blank=True)
     battery_level = models.FloatField(null=True, blank=True)
     signal_strength = models.FloatField(null=True, blank=True)
@@ -48,7 +51,8 @@ class SensorData(models.Model):
     slot1_occupied = models.BooleanField(null=True, blank=True)
     slot2_occupied = models.BooleanField(null=True, blank=True)
     ir_alert = models.BooleanField(null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: backfilled readings keep the time they were measured
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
 
     class Meta:
         ordering = ["-timestamp"]
@@ -75,3 +79,46 @@ class DeviceLog(models.Model):
 
     def __str__(self):
         return f"{self.device.name} - {self.log_type}: {self.message[:50]}"
+
+
+class SpotCalibration(models.Model):
+    """Per-spot distance calibration learned from historical sensor readings"""
+
+    parking_spot = models.OneToOneField(
+        ParkingSpot, on_delete=models.CASCADE, related_name="calibration"
+    )
+    empty_distance_cm = models.FloatField(
+        null=True, blank=True, help_text="Typical distance to the empty floor"
+    )
+    vehicle_distance_cm = models.FloatField(
+        null=True, blank=True, help_text="Typical distance to a parked vehicle"
+    )
+    threshold_cm = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Readings below this distance are classified as occupied",
+    )
+    sample_count = models.IntegerField(default=0)
+    agreement_rate = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Share of readings where firmware and server classification agree",
+    )
+    drift_cm = models.FloatField(
+        default=0, help_text="Empty-floor shift since the previous calibration"
+    )
+    is_drifted = models.BooleanField(default=False)
+    manual_override = models.BooleanField(
+        default=False, help_text="Keep manually tuned thresholds on recalibration"
+    )
+    calibrated_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Calibration for {self.parking_spot} (threshold {self.threshold_cm} cm)"
+
+    def classify(self, distance_cm):
+        """Return True/False for occupied, or None if not calibrated"""
+        if distance_cm is None or self.threshold_cm is None:
+            return None
+        return float(distance_cm) < self.threshold_cm
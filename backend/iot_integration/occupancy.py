@@ -0,0 +1,170 @@
+"""
+Server-side occupancy debouncing for IoT parking sensors
+Filters noisy per-slot readings so a single bad ultrasonic sample does not
+flip a spot and trigger booking, billing and WhatsApp side effects.
+``OccupancySnapshot`` reads the live sensor state of every slot at once, so
+sweeps over many bookings do not query the sensors once per booking.
+"""
+
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+DEFAULT_DEBOUNCE = {
+    "window": 3,  # readings kept in the ring buffer
+    "min_consistent": 2,  # consecutive agreeing readings needed to commit
+    "stable_ms": 4000,  # or: majority held for this long
+}
+
+
+class SlotDebouncer:
+    """Hysteresis filter for a single parking slot.
+
+    A transition away from the committed state is accepted once the new value
+    has been reported ``min_consistent`` times in a row, or once it holds the
+    majority of the ring buffer and has been stable for ``stable_ms``.
+    """
+
+    def __init__(self, window, min_consistent, stable_ms):
+        self.readings = deque(maxlen=max(1, int(window)))
+        self.min_consistent = max(1, int(min_consistent))
+        self.stable_ms = max(0, int(stable_ms))
+        self.candidate = None
+        self.candidate_since = None
+        self.streak = 0
+
+    def update(self, committed, value, now_ms):
+        """Feed one reading and return the (possibly new) committed state"""
+        value = bool(value)
+        self.readings.append(value)
+
+        if value == committed:
+            self.candidate = None
+            self.candidate_since = None
+            self.streak = 0
+            return committed
+
+        if self.candidate != value:
+            self.candidate = value
+            self.candidate_since = now_ms
+            self.streak = 0
+        self.streak += 1
+
+        votes = sum(1 for r in self.readings if r == value)
+        has_majority = votes * 2 > len(self.readings)
+        held_ms = now_ms - self.candidate_since
+
+        if self.streak >= self.min_consistent or (
+            has_majority and held_ms >= self.stable_ms
+        ):
+            self.candidate = None
+            self.candidate_since = None
+            self.streak = 0
+            return value
+        return committed
+
+
+_filters = {}
+_lock = threading.Lock()
+
+
+def get_debounce_config(spot_number):
+    """Return debounce thresholds for a spot (settings default + per-spot override)"""
+    config = dict(DEFAULT_DEBOUNCE)
+    configured = getattr(settings, "OCCUPANCY_DEBOUNCE", {}) or {}
+    config.update(configured.get("default", {}))
+    config.update(configured.get("spots", {}).get(spot_number, {}))
+    return config
+
+
+def debounce_occupancy(spot, reading, now_ms=None):
+    """Filter a raw occupancy reading for ``spot``.
+
+    The spot's current ``is_occupied`` is treated as the committed state, so
+    other code paths that update the spot stay authoritative. Returns the
+    occupancy value that should be persisted.
+    """
+    if reading is None:
+        return spot.is_occupied
+    if now_ms is None:
+        now_ms = int(time.monotonic() * 1000)
+
+    with _lock:
+        slot_filter = _filters.get(spot.id)
+        if slot_filter is None:
+            config = get_debounce_config(spot.spot_number)
+            slot_filter = SlotDebouncer(
+                config["window"], config["min_consistent"], config["stable_ms"]
+            )
+            _filters[spot.id] = slot_filter
+        return slot_filter.update(bool(spot.is_occupied), reading, now_ms)
+
+
+def reset_debounce_state(spot_id=None):
+    """Drop buffered readings (all spots, or a single spot)"""
+    with _lock:
+        if spot_id is None:
+            _filters.clear()
+        else:
+            _filters.pop(spot_id, None)
+
+
+# Slot name -> index of its device among active devices ordered by id
+SLOT_DEVICE_INDEX = {"Slot A": 0, "Slot B": 1}
+# Readings older than this are ignored (the ESP32 is considered offline)
+SENSOR_FRESH_SECONDS = 60
+
+
+class OccupancySnapshot:
+    """Latest sensor reading of each slot device, read in a constant 1-3 queries.
+
+    ``is_occupied(spot)`` follows the slot's device reading while the sensors
+    are online and the reading is fresh, and the spot's own ``is_occupied``
+    otherwise (the same rules the home page uses).
+    """
+
+    def __init__(self, readings, taken_at):
+        self.readings = readings  # device index -> latest SensorData (or None)
+        self.taken_at = taken_at
+
+    @classmethod
+    def take(cls, now=None):
+        from .models import IoTDevice, SensorData
+
+        now = now or timezone.now()
+        fresh_since = now - timedelta(seconds=SENSOR_FRESH_SECONDS)
+        if not SensorData.objects.filter(timestamp__gte=fresh_since).exists():
+            return cls({}, now)
+
+        latest = SensorData.objects.filter(device=OuterRef("pk")).order_by("-timestamp")
+        latest_ids = list(
+            IoTDevice.objects.filter(is_active=True)
+            .order_by("id")
+            .annotate(latest_id=Subquery(latest.values("id")[:1]))
+            .values_list("latest_id", flat=True)[: len(SLOT_DEVICE_INDEX)]
+        )
+        rows = SensorData.objects.in_bulk([i for i in latest_ids if i is not None])
+        return cls({index: rows.get(i) for index, i in enumerate(latest_ids)}, now)
+
+    def sensor_reading(self, spot_number):
+        """Fresh occupancy reported by the slot's sensor, or None"""
+        index = SLOT_DEVICE_INDEX.get(spot_number)
+        reading = self.readings.get(index)
+        if reading is None:
+            return None
+        age = (self.taken_at - reading.timestamp).total_seconds()
+        if age >= SENSOR_FRESH_SECONDS:
+            return None
+        # Dual-sensor devices report each slot separately
+        if reading.slot1_occupied is not None:
+            return reading.slot1_occupied if index == 0 else reading.slot2_occupied
+        return reading.is_occupied
+
+    def is_occupied(self, spot):
+        reading = self.sensor_reading(spot.spot_number)
+        return spot.is_occupied if reading is None else reading
@@ -0,0 +1,292 @@
+"""
+Bulk provisioning of IoT devices and their parking spot mappings
+Validates a whole batch up front with in-memory set lookups (a constant number
+of queries regardless of batch size), then creates missing spots, devices and
+their registration logs with bulk inserts inside one transaction.
+"""
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_ipv46_address
+from django.db import transaction
+
+from parking_app.models import ParkingLot, ParkingSpot
+
+from .models import DeviceLog, IoTDevice
+
+BATCH_SIZE = 500
+# Keep IN (...) lists below SQLite's bound-parameter limit
+LOOKUP_CHUNK = 900
+
+DEVICE_FIELDS = [
+    "device_id",
+    "device_type",
+    "name",
+    "parking_lot",
+    "lot_name",
+    "spot_number",
+    "spot_type",
+    "location",
+    "ip_address",
+    "mac_address",
+]
+
+
+class ProvisioningError(ValueError):
+    """Raised with per-row errors when a batch fails validation"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} row(s) failed validation")
+
+
+def parse_flag(value, default=False):
+    """Read a request flag: JSON booleans, or "1"/"true"/"yes"/"on" as text"""
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _chunks(values, size=LOOKUP_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+def _clean(value):
+    if value is None:
+        return ""
+    return str(value).strip()
+
+
+def _existing_device_ids(device_ids):
+    existing = set()
+    for chunk in _chunks(device_ids):
+        existing.update(
+            IoTDevice.objects.filter(device_id__in=chunk).values_list(
+                "device_id", flat=True
+            )
+        )
+    return existing
+
+
+def _load_lots(rows):
+    """Resolve lots referenced by id or name: ({id: lot}, {name: lot})"""
+    lot_ids, lot_names = set(), set()
+    for row in rows:
+        if row["parking_lot"]:
+            if row["parking_lot"].isdigit():
+                lot_ids.add(int(row["parking_lot"]))
+            else:
+                lot_names.add(row["parking_lot"])
+        elif row["lot_name"]:
+            lot_names.add(row["lot_name"])
+    by_id, by_name = {}, {}
+    if lot_ids or lot_names:
+        for lot in ParkingLot.objects.filter(
+            id__in=lot_ids
+        ) | ParkingLot.objects.filter(name__in=lot_names):
+            by_id[lot.id] = lot
+            # Duplicate lot names are ambiguous; only the first one wins
+            by_name.setdefault(lot.name, lot)
+    return by_id, by_name
+
+
+def _load_spots(keys):
+    """Fetch spots for (lot_id, spot_number) keys: {(lot_id, spot_number): spot}"""
+    spots = {}
+    lot_ids = {lot_id for lot_id, _ in keys}
+    numbers = {number for _, number in keys}
+    for chunk in _chunks(numbers):
+        for spot in ParkingSpot.objects.filter(
+            parking_lot_id__in=lot_ids, spot_number__in=chunk
+        ):
+            key = (spot.parking_lot_id, spot.spot_number)
+            if key in keys:
+                spots[key] = spot
+    return spots
+
+
+def validate_devices(raw_rows, create_spots=True):
+    """Normalise and validate a batch of device rows.
+
+    Returns (rows, missing_spot_keys); raises ProvisioningError listing every
+    invalid row so the whole batch can be fixed in one go.
+    """
+    if not isinstance(raw_rows, list) or not raw_rows:
+        raise ProvisioningError(
+            [{"row": None, "errors": ["devices must be a non-empty list"]}]
+        )
+
+    device_types = {choice for choice, _ in IoTDevice.DEVICE_TYPES}
+    spot_types = {choice for choice, _ in ParkingSpot.SPOT_TYPES}
+
+    rows = []
+    for raw in raw_rows:
+        if not isinstance(raw, dict):
+            raw = {}
+        row = {field: _clean(raw.get(field)) for field in DEVICE_FIELDS}
+        row["name"] = row["name"] or row["device_id"]
+        row["device_type"] = row["device_type"] or "sensor"
+        row["spot_type"] = row["spot_type"] or "regular"
+        rows.append(row)
+
+    existing_ids = _existing_device_ids(
+        {r["device_id"] for r in rows if r["device_id"]}
+    )
+    lots_by_id, lots_by_name = _load_lots(rows)
+
+    seen_ids = set()
+    spot_keys = set()
+    errors = []
+    for index, row in enumerate(rows):
+        row_errors = []
+        device_id = row["device_id"]
+        if not device_id:
+            row_errors.append("device_id is required")
+        elif len(device_id) > 50:
+            row_errors.append("device_id is longer than 50 characters")
+        elif device_id in existing_ids:
+            row_errors.append("device_id is already registered")
+        elif device_id in seen_ids:
+            row_errors.append("device_id appears more than once in this batch")
+        seen_ids.add(device_id)
+
+        if row["device_type"] not in device_types:
+            row_errors.append(f"Invalid device_type: {row['device_type']}")
+        if len(row["name"]) > 100:
+            row_errors.append("name is longer than 100 characters")
+        if len(row["location"]) > 200:
+            row_errors.append("location is longer than 200 characters")
+        if len(row["mac_address"]) > 17:
+            row_errors.append("mac_address is longer than 17 characters")
+        if row["ip_address"]:
+            try:
+                validate_ipv46_address(row["ip_address"])
+            except ValidationError:
+                row_errors.append(f"Invalid ip_address: {row['ip_address']}")
+
+        lot = None
+        lot_ref = row["parking_lot"] or row["lot_name"]
+        if lot_ref:
+            if row["parking_lot"].isdigit():
+                lot = lots_by_id.get(int(row["parking_lot"]))
+            else:
+                lot = lots_by_name.get(lot_ref)
+            if lot is None:
+                row_errors.append(f"Parking lot not found: {lot_ref}")
+        row["lot"] = lot
+
+        if row["spot_number"]:
+            if not lot_ref:
+                row_errors.append("spot_number requires parking_lot or lot_name")
+            elif len(row["spot_number"]) > 10:
+                row_errors.append("spot_number is longer than 10 characters")
+            elif row["spot_type"] not in spot_types:
+                row_errors.append(f"Invalid spot_type: {row['spot_type']}")
+            elif lot is not None:
+                spot_keys.add((lot.id, row["spot_number"]))
+
+        if row_errors:
+            errors.append({"row": index, "device_id": device_id, "errors": row_errors})
+
+    spots = _load_spots(spot_keys) if spot_keys else {}
+    missing = spot_keys - set(spots)
+    if missing and not create_spots:
+        for index, row in enumerate(rows):
+            if row["lot"] and (row["lot"].id, row["spot_number"]) in missing:
+                errors.append(
+                    {
+                        "row": index,
+                        "device_id": row["device_id"],
+                        "errors": [f"Parking spot not found: {row['spot_number']}"],
+                    }
+                )
+
+    if errors:
+        errors.sort(key=lambda e: e["row"])
+        raise ProvisioningError(errors)
+
+    for row in rows:
+        key = (row["lot"].id, row["spot_number"]) if row["lot"] else None
+        row["spot"] = spots.get(key) if row["spot_number"] else None
+        row["spot_key"] = key if row["spot_number"] else None
+    return rows, missing
+
+
+def provision_devices(raw_rows, create_spots=True, dry_run=False):
+    """Register a batch of devices (and any missing spots) in one transaction.
+
+    Returns a summary dict; raises ProvisioningError if any row is invalid.
+    """
+    rows, missing = validate_devices(raw_rows, create_spots=create_spots)
+    summary = {
+        "devices_created": len(rows),
+        "spots_created": len(missing),
+        "device_ids": [row["device_id"] for row in rows],
+    }
+    if dry_run:
+        return summary
+
+    spot_types = {}
+    for row in rows:
+        if row["spot_key"] in missing:
+            spot_types.setdefault(row["spot_key"], row["spot_type"])
+
+    with transaction.atomic():
+        if missing:
+            ParkingSpot.objects.bulk_create(
+                [
+                    ParkingSpot(
+                        parking_lot_id=lot_id,
+                        spot_number=spot_number,
+                        spot_type=spot_types[(lot_id, spot_number)],
+                    )
+                    for lot_id, spot_number in missing
+                ],
+                batch_size=BATCH_SIZE,
+            )
+            # Not every backend returns primary keys from bulk inserts
+            created_spots = _load_spots(missing)
+            for row in rows:
+                if row["spot_key"] in missing:
+                    row["spot"] = created_spots[row["spot_key"]]
+
+        IoTDevice.objects.bulk_create(
+            [
+                IoTDevice(
+                    device_id=row["device_id"],
+                    device_type=row["device_type"],
+                    name=row["name"],
+                    parking_lot=row["lot"],
+                    parking_spot=row["spot"],
+                    location=row["location"],
+                    ip_address=row["ip_address"] or None,
+                    mac_address=row["mac_address"],
+                )
+                for row in rows
+            ],
+            batch_size=BATCH_SIZE,
+        )
+
+        device_pks = {}
+        for chunk in _chunks(summary["device_ids"]):
+            device_pks.update(
+                IoTDevice.objects.filter(device_id__in=chunk).values_list(
+                    "device_id", "id"
+                )
+            )
+        DeviceLog.objects.bulk_create(
+            [
+                DeviceLog(
+                    device_id=device_pks[device_id],
+                    log_type="info",
+                    message="Device registered successfully (bulk provisioning)",
+                )
+                for device_id in summary["device_ids"]
+            ],
+            batch_size=BATCH_SIZE,
+        )
+
+    return summary
@@ -33,5 +33,5 @@ class IoTDeviceCreateSerializer(serializers.ModelSerializer):
 class SensorDataCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = SensorData
-        fields = ['device', 'parking_spot', 'is_occupied', 'distance_cm', 'battery_level', 'signal_strength', 'temperature', 'humidity', 'slot1_occupied', 'slot2_occupied', 'ir_alert']
+        fields = ['device', 'parking_spot', 'is_occupied', 'firmware_occupied', 'distance_cm', 'battery_level', 'signal_strength', 'temperature', 'humidity', 'slot1_occupied', 'slot2_occupied', 'ir_alert']
         # Dual sensor fields are optional 
\ No newline at end of file
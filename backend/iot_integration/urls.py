@@ -4,6 +4,11 @@ from . import views
 urlpatterns = [
     # Device management
     path("devices/register/", views.register_device, name="register_device"),
+    path(
+        "devices/register/bulk/",
+        views.register_devices_bulk,
+        name="register_devices_bulk",
+    ),
     path("devices/", views.get_devices, name="get_devices"),
     path("devices/details/", views.get_device_details, name="get_device_details"),
     path(
@@ -11,6 +16,7 @@ urlpatterns = [
     ),
     # Sensor data
     path("sensor/data/", views.sensor_data, name="sensor_data"),
+    path("sensor/backfill/", views.sensor_backfill, name="sensor_backfill"),
     path(
         "sensors/real-time/",
         views.get_real_time_sensor_data,
@@ -26,6 +32,11 @@ urlpatterns = [
         views.get_parking_statistics,
         name="get_parking_statistics",
     ),
+    path(
+        "sensors/calibration/",
+        views.get_sensor_calibrations,
+        name="get_sensor_calibrations",
+    ),
     path("system/status/", views.get_system_status, name="get_system_status"),
     # Device health
     path("devices/heartbeat/", views.device_heartbeat, name="device_heartbeat"),
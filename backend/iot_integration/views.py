@@ -5,9 +5,9 @@ from rest_framework import status
 from django.utils import timezone
 from datetime import datetime, timedelta
 import json
-from decimal import Decimal, ROUND_HALF_UP
+from decimal import Decimal
 
-from .models import IoTDevice, SensorData, DeviceLog
+from .models import IoTDevice, SensorData, DeviceLog, SpotCalibration
 from .serializers import (
     IoTDeviceSerializer,
     SensorDataSerializer,
@@ -15,7 +15,13 @@ from .serializers import (
     IoTDeviceCreateSerializer,
     SensorDataCreateSerializer,
 )
+from .occupancy import debounce_occupancy
+from .calibration import classify_reading
+from .anomaly import anomaly_detector
+from .backfill import BackfillError, ingest_backfill
+from .provisioning import ProvisioningError, parse_flag, provision_devices
 from parking_app.models import ParkingSpot, UserReport
+from parking_app import tariffs
 
 
 def check_unauthorized_parking(spot):
@@ -159,17 +165,16 @@ def check_grace_period_expiration():
                         print(f"📱 [Grace Period] Message preview: {message[:100]}...")
 
                         try:
-                            result = send_whatsapp_message(phone_to_use, message)
+                            result = send_whatsapp_message(
+                                phone_to_use, message, booking=booking
+                            )
                             if result:
                                 print(
-                                    f"✅ [Grace Period] Cancellation notification sent successfully for booking {booking.id} to {phone_to_use}"
+                                    f"✅ [Grace Period] Cancellation notification queued for booking {booking.id} to {phone_to_use}"
                                 )
                             else:
                                 print(
-                                    f"❌ [Grace Period] Failed to send cancellation notification - send_whatsapp_message returned False for booking {booking.id} to {phone_to_use}"
-                                )
-                                print(
-                                    f"❌ [Grace Period] Check Twilio credentials and phone number format"
+                                    f"❌ [Grace Period] Failed to queue cancellation notification for booking {booking.id} to {phone_to_use}"
                                 )
                         except Exception as e:
                             print(
@@ -226,10 +231,11 @@ def _auto_complete_booking_for_slot(spot_number):
 
         elapsed_seconds = max(0, int((now - booking.timer_started).total_seconds()))
 
-        # Calculate cost at $1 per 30 seconds
-        per_second = Decimal("1") / Decimal("30")
-        final_cost = (per_second * Decimal(str(elapsed_seconds))).quantize(
-            Decimal("0.01"), rounding=ROUND_HALF_UP
+        # Price the parked time on the spot's tariff
+        final_cost = tariffs.session_cost(
+            booking.timer_started,
+            booking.timer_started + timedelta(seconds=elapsed_seconds),
+            spot,
         )
 
         # Calculate parking duration for receipt
@@ -260,7 +266,7 @@ def _auto_complete_booking_for_slot(spot_number):
                 user=booking.user,
                 booking=booking,
                 amount=final_cost,
-                note=f"Parking charge - {duration_str} at $1/30s",
+                note=f"Parking charge - {duration_str}",
             )
 
             # Get new balance after deduction
@@ -386,14 +392,14 @@ def _auto_complete_booking_for_slot(spot_number):
                 f"📱 [Auto-complete] Receipt details: Duration={duration_str}, Cost=${final_cost:.2f}"
             )
 
-            result = send_whatsapp_message(test_phone, message)
+            result = send_whatsapp_message(test_phone, message, booking=booking)
             if result:
                 print(
-                    f"✅ [Auto-complete] Receipt notification sent successfully for booking {booking.id}!"
+                    f"✅ [Auto-complete] Receipt notification queued for booking {booking.id}!"
                 )
             else:
                 print(
-                    f"⚠️ [Auto-complete] Receipt notification failed to send for booking {booking.id}"
+                    f"⚠️ [Auto-complete] Receipt notification could not be queued for booking {booking.id}"
                 )
         except Exception as e:
             print(f"⚠️ [Auto-complete] Error sending receipt notification: {e}")
@@ -434,6 +440,51 @@ def register_device(request):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(["POST"])
+@permission_classes([AllowAny])
+def register_devices_bulk(request):
+    """Register many IoT devices (and their spot mappings) in one request"""
+    try:
+        # Flags may come as JSON booleans or as form / query strings ("false")
+        create_spots = parse_flag(
+            request.data.get("create_spots", request.query_params.get("create_spots")),
+            default=True,
+        )
+        dry_run = parse_flag(
+            request.data.get("dry_run", request.query_params.get("dry_run"))
+        )
+        try:
+            summary = provision_devices(
+                request.data.get("devices"),
+                create_spots=create_spots,
+                dry_run=dry_run,
+            )
+        except ProvisioningError as e:
+            return Response(
+                {"error": str(e), "rows": e.errors},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        print(
+            f"📡 Bulk provisioning: {summary['devices_created']} device(s), "
+            f"{summary['spots_created']} new spot(s){' (dry run)' if dry_run else ''}"
+        )
+        return Response(
+            {
+                "message": (
+                    "Devices validated successfully"
+                    if dry_run
+                    else "Devices registered successfully"
+                ),
+                "dry_run": dry_run,
+                **summary,
+            },
+            status=status.HTTP_200_OK if dry_run else status.HTTP_201_CREATED,
+        )
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def sensor_data(request):
@@ -489,6 +540,19 @@ def sensor_data(request):
             # If dual sensor fields don't exist, skip them
             pass
 
+        # Derive occupancy from distance using the spot's server-side calibration;
+        # the raw flag is kept so recalibration never fits against its own output
+        sensor_data["firmware_occupied"] = sensor_data["is_occupied"]
+        if device.parking_spot_id and sensor_data["distance_cm"] is not None:
+            try:
+                derived = classify_reading(
+                    device.parking_spot, float(sensor_data["distance_cm"])
+                )
+                if derived is not None:
+                    sensor_data["is_occupied"] = derived
+            except (TypeError, ValueError):
+                pass
+
         # Check for expired grace periods (for WhatsApp bookings)
         check_grace_period_expiration()
 
@@ -507,8 +571,11 @@ def sensor_data(request):
                         parking_lot=lot, spot_number="Slot A"
                     )
                     was_occupied = slot_a.is_occupied
-                    slot_a.is_occupied = slot1_occupied
-                    slot_a.save()
+                    # Debounce: only commit a transition once readings are stable
+                    slot1_occupied = debounce_occupancy(slot_a, slot1_occupied)
+                    if slot1_occupied != was_occupied:
+                        slot_a.is_occupied = slot1_occupied
+                        slot_a.save()
                     print(
                         f"Updated Slot A: {'Occupied' if slot1_occupied else 'Available'}"
                     )
@@ -582,15 +649,17 @@ def sensor_data(request):
 
                                     try:
                                         result = send_whatsapp_message(
-                                            test_phone, message
+                                            test_phone,
+                                            message,
+                                            booking=active_booking,
                                         )
                                         if result:
                                             print(
-                                                f"✅ [Slot A] Parking notification sent successfully!"
+                                                f"✅ [Slot A] Parking notification queued"
                                             )
                                         else:
                                             print(
-                                                f"⚠️ [Slot A] Parking notification failed to send"
+                                                f"⚠️ [Slot A] Parking notification could not be queued"
                                             )
                                     except Exception as e:
                                         print(
@@ -631,8 +700,11 @@ def sensor_data(request):
                         parking_lot=lot, spot_number="Slot B"
                     )
                     was_occupied = slot_b.is_occupied
-                    slot_b.is_occupied = slot2_occupied
-                    slot_b.save()
+                    # Debounce: only commit a transition once readings are stable
+                    slot2_occupied = debounce_occupancy(slot_b, slot2_occupied)
+                    if slot2_occupied != was_occupied:
+                        slot_b.is_occupied = slot2_occupied
+                        slot_b.save()
                     print(
                         f"Updated Slot B: {'Occupied' if slot2_occupied else 'Available'}"
                     )
@@ -706,15 +778,17 @@ def sensor_data(request):
 
                                     try:
                                         result = send_whatsapp_message(
-                                            test_phone, message
+                                            test_phone,
+                                            message,
+                                            booking=active_booking,
                                         )
                                         if result:
                                             print(
-                                                f"✅ [Slot B] Parking notification sent successfully!"
+                                                f"✅ [Slot B] Parking notification queued"
                                             )
                                         else:
                                             print(
-                                                f"⚠️ [Slot B] Parking notification failed to send"
+                                                f"⚠️ [Slot B] Parking notification could not be queued"
                                             )
                                     except Exception as e:
                                         print(
@@ -755,6 +829,12 @@ def sensor_data(request):
         if serializer.is_valid():
             sensor_data_obj = serializer.save()
 
+            # Online anomaly detection (flapping, stuck, battery, signal)
+            try:
+                anomaly_detector.observe(device, sensor_data_obj)
+            except Exception as e:
+                print(f"⚠️ Anomaly detection error for {device.device_id}: {e}")
+
             # Log the data
             DeviceLog.objects.create(
                 device=device,
@@ -778,6 +858,60 @@ def sensor_data(request):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(["POST"])
+@permission_classes([AllowAny])
+def sensor_backfill(request):
+    """Receive readings an ESP32 buffered while offline (store-and-forward)"""
+    try:
+        device_id = request.data.get("device_id")
+        if not device_id:
+            return Response(
+                {"error": "device_id is required"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            device = IoTDevice.objects.get(device_id=device_id, is_active=True)
+        except IoTDevice.DoesNotExist:
+            return Response(
+                {"error": "Device not found or inactive"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            result = ingest_backfill(device, request.data.get("readings"))
+        except BackfillError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        print(
+            f"📦 Backfill from {device_id}: {result['inserted']} inserted, "
+            f"{result['duplicates']} duplicate(s), {len(result['bookings'])} booking(s) reconciled"
+        )
+        return Response(
+            {
+                "message": "Backfill processed successfully",
+                "received": result["received"],
+                "inserted": result["inserted"],
+                "duplicates": result["duplicates"],
+                "window_start": result["window_start"],
+                "window_end": result["window_end"],
+                "bookings_reconciled": [
+                    {
+                        "booking_id": change["booking_id"],
+                        "status": change["status"],
+                        "timer_started": change["timer_started"],
+                        "completed_at": change["completed_at"],
+                        "charge_delta": float(change["charge_delta"]),
+                    }
+                    for change in result["bookings"]
+                ],
+            },
+            status=status.HTTP_201_CREATED,
+        )
+    except Exception as e:
+        print("SENSOR BACKFILL ERROR:", e)
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(["GET"])
 @permission_classes([AllowAny])
 def get_devices(request):
@@ -929,11 +1063,12 @@ def get_parking_availability(request):
                         print(f"Parking spot {slot_name} not found")
                         pass
 
-        # Get updated spots data
+        # Get updated spots data (totals from the lot counters)
         spots = ParkingSpot.objects.filter(parking_lot=lot)
-        total_spots = spots.count()
-        available_spots = spots.filter(is_occupied=False).count()
-        occupied_spots = spots.filter(is_occupied=True).count()
+        lot.refresh_from_db(fields=ParkingLot.COUNTER_FIELDS)
+        total_spots = lot.spot_count
+        available_spots = lot.available_spots
+        occupied_spots = lot.occupied_count
 
         spots_data = []
         for spot in spots:
@@ -1557,11 +1692,10 @@ def get_parking_statistics(request):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        # Get parking spots for this lot
-        spots = ParkingSpot.objects.filter(parking_lot=lot)
-        total_spots = spots.count()
-        occupied_spots = spots.filter(is_occupied=True).count()
-        available_spots = total_spots - occupied_spots
+        # Spot totals for this lot, from its maintained counters
+        total_spots = lot.spot_count
+        occupied_spots = lot.occupied_count
+        available_spots = lot.available_spots
 
         # Calculate occupancy rate
         occupancy_rate = (occupied_spots / total_spots * 100) if total_spots > 0 else 0
@@ -1664,3 +1798,42 @@ def get_system_status(request):
 
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def get_sensor_calibrations(request):
+    """Get per-spot distance calibrations (optionally only drifted sensors)"""
+    try:
+        calibrations = SpotCalibration.objects.select_related(
+            "parking_spot", "parking_spot__parking_lot"
+        ).order_by("parking_spot_id")
+        if request.query_params.get("drifted") in ("1", "true", "True"):
+            calibrations = calibrations.filter(is_drifted=True)
+
+        data = [
+            {
+                "parking_spot_id": c.parking_spot_id,
+                "spot_number": c.parking_spot.spot_number,
+                "parking_lot": c.parking_spot.parking_lot.name,
+                "empty_distance_cm": c.empty_distance_cm,
+                "vehicle_distance_cm": c.vehicle_distance_cm,
+                "threshold_cm": c.threshold_cm,
+                "sample_count": c.sample_count,
+                "agreement_rate": c.agreement_rate,
+                "drift_cm": c.drift_cm,
+                "is_drifted": c.is_drifted,
+                "manual_override": c.manual_override,
+                "calibrated_at": c.calibrated_at,
+            }
+            for c in calibrations
+        ]
+        return Response(
+            {
+                "calibrations": data,
+                "total": len(data),
+                "drifted": len([c for c in data if c["is_drifted"]]),
+            }
+        )
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,213 @@
+"""
+Automatic spot allocation
+Free spots are kept in memory as one min-heap per (lot, spot type), ordered by
+spot number, so "any regular spot in lot X" pops a candidate in O(log n)
+instead of clients guessing spot ids and retrying. The pool is fed by spot
+occupancy transitions (ParkingSpot.save) and rebuilt from the database when
+invalidated or every ``rebuild_seconds``. The booking itself is still the
+single guarded insert of ``create_active_booking``: if another process took
+the popped spot first, the next one is popped instead.
+"""
+
+import heapq
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from .bookings import BookingConflict, create_active_booking
+from .models import Booking, ParkingSpot
+
+DEFAULT_ALLOCATION = {
+    "rebuild_seconds": 30,
+    "max_attempts": 20,  # popped candidates tried per allocation
+}
+
+
+def get_allocation_config():
+    config = dict(DEFAULT_ALLOCATION)
+    config.update(getattr(settings, "SPOT_ALLOCATION", {}) or {})
+    return config
+
+
+class NoSpotAvailable(Exception):
+    """The lot has no free spot of the requested type"""
+
+
+def spot_sort_key(spot_number):
+    """Natural order of spot numbers: A2 before A10"""
+    return tuple(
+        (0, int(part), "") if part.isdigit() else (1, 0, part)
+        for part in re.findall(r"\d+|\D+", spot_number)
+    )
+
+
+class SpotPool:
+    """Per-(lot, spot type) heaps of free spot ids with lazy deletion"""
+
+    def __init__(self, spots):
+        # spots: (spot_id, lot_id, spot_type, spot_number, is_free) rows
+        self._spots = {}  # spot_id -> (lot_id, spot_type, sort key)
+        self._free = set()
+        self._heaps = {}
+        self._lock = threading.Lock()
+        for spot_id, lot_id, spot_type, spot_number, is_free in spots:
+            self._spots[spot_id] = (lot_id, spot_type, spot_sort_key(spot_number))
+            if is_free:
+                self._free.add(spot_id)
+                self._heaps.setdefault((lot_id, spot_type), []).append(
+                    (self._spots[spot_id][2], spot_id)
+                )
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    def knows(self, spot_id):
+        return spot_id in self._spots
+
+    def pop(self, lot_id, spot_type):
+        """Take the lowest free spot id of this lot and type (None if none)"""
+        with self._lock:
+            heap = self._heaps.get((lot_id, spot_type))
+            while heap:
+                _, spot_id = heapq.heappop(heap)
+                # Entries of spots taken since they were pushed are skipped
+                if spot_id in self._free:
+                    self._free.discard(spot_id)
+                    return spot_id
+            return None
+
+    def release(self, spot_id):
+        """Make a known spot allocatable again"""
+        with self._lock:
+            if spot_id in self._free or spot_id not in self._spots:
+                return
+            lot_id, spot_type, key = self._spots[spot_id]
+            self._free.add(spot_id)
+            heap = self._heaps.setdefault((lot_id, spot_type), [])
+            heapq.heappush(heap, (key, spot_id))
+            if len(heap) > 2 * len(self._free) + 64:
+                # Too many stale entries: compact this heap
+                heap[:] = [entry for entry in heap if entry[1] in self._free]
+                heapq.heapify(heap)
+
+    def take(self, spot_id):
+        """Mark a spot as not allocatable (its heap entry goes stale)"""
+        with self._lock:
+            self._free.discard(spot_id)
+
+    def free_count(self, lot_id=None):
+        with self._lock:
+            return sum(
+                1
+                for spot_id in self._free
+                if lot_id is None or self._spots[spot_id][0] == lot_id
+            )
+
+
+_pool = None
+_built_at = 0.0
+_lock = threading.Lock()
+
+
+def build_spot_pool():
+    """One query: every spot of an active lot and whether it can be allocated"""
+    active = Booking.objects.filter(parking_spot=OuterRef("pk"), status="active")
+    rows = (
+        ParkingSpot.objects.filter(parking_lot__is_active=True)
+        .annotate(booked=Exists(active))
+        .values_list(
+            "id",
+            "parking_lot_id",
+            "spot_type",
+            "spot_number",
+            "is_occupied",
+            "is_reserved",
+            "booked",
+        )
+    )
+    return SpotPool(
+        (spot_id, lot_id, spot_type, number, not (occupied or reserved or booked))
+        for spot_id, lot_id, spot_type, number, occupied, reserved, booked in rows
+    )
+
+
+def get_spot_pool():
+    """Process-wide pool, rebuilt when invalidated or stale"""
+    global _pool, _built_at
+    config = get_allocation_config()
+    with _lock:
+        if _pool is None or time.monotonic() - _built_at >= config["rebuild_seconds"]:
+            _pool = build_spot_pool()
+            _built_at = time.monotonic()
+        return _pool
+
+
+def invalidate_spot_pool():
+    """Drop the pool so the next allocation rebuilds it"""
+    global _pool
+    with _lock:
+        _pool = None
+
+
+def spot_changed(spot_id, is_free):
+    """Occupancy transition of a saved spot (called after commit)"""
+    pool = _pool
+    if pool is None:
+        return
+    if not pool.knows(spot_id):
+        invalidate_spot_pool()  # new or moved spot
+    elif (
+        is_free
+        and not Booking.objects.filter(
+            parking_spot_id=spot_id, status="active"
+        ).exists()
+    ):
+        pool.release(spot_id)
+    else:
+        # Occupied, reserved or booked (e.g. the driver left before the
+        # session was completed): not allocatable
+        pool.take(spot_id)
+
+
+def spot_booked(spot_id):
+    """A booking made outside allocate_spot took this spot (called after commit)"""
+    pool = _pool
+    if pool is not None:
+        pool.take(spot_id)
+
+
+def allocate_spot(user, lot_id, spot_type="regular", **fields):
+    """Book any free spot of ``spot_type`` in lot ``lot_id`` for ``user``.
+
+    Returns the active Booking. Raises NoSpotAvailable when the lot has no
+    candidate left and BookingConflict("user") if the user already has an
+    active booking.
+    """
+    config = get_allocation_config()
+    pool = get_spot_pool()
+    for _ in range(config["max_attempts"]):
+        spot_id = pool.pop(lot_id, spot_type)
+        if spot_id is None:
+            break
+        try:
+            # The pool may lag behind other processes: recheck the sensor flags
+            if not ParkingSpot.objects.filter(
+                id=spot_id, is_occupied=False, is_reserved=False
+            ).exists():
+                continue
+            return create_active_booking(user, spot_id, **fields)
+        except BookingConflict as conflict:
+            if conflict.reason == "user":
+                pool.release(spot_id)
+                raise
+            # Booked elsewhere since the pool was built, or reserved by
+            # another user during this booking: try the next spot
+        except ParkingSpot.DoesNotExist:
+            pass
+        except Exception:
+            # Unexpected failure (e.g. a database error): the spot is still free
+            pool.release(spot_id)
+            raise
+    raise NoSpotAvailable(f"No free {spot_type} spot in lot {lot_id}")
@@ -1,6 +1,32 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+def should_autostart(argv=None):
+    """True only in the runserver process that serves requests.
+
+    Background threads never start in other management commands (migrate,
+    test, ...), the autoreloader parent, or scripts calling django.setup().
+    """
+    argv = sys.argv if argv is None else argv
+    if len(argv) < 2 or argv[1] != "runserver":
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in argv
+
+
 class ParkingAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "parking_app"
+
+    def ready(self):
+        from .billing import autostart_billing
+        from .outbox import autostart_dispatcher
+        from .overtime import autostart_scheduler
+
+        if not should_autostart():
+            return
+        autostart_scheduler()
+        autostart_billing()
+        autostart_dispatcher()
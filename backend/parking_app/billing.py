@@ -0,0 +1,248 @@
+"""
+Progressive billing engine for running parking timers
+A tick loads every timer-running booking in one query, computes the billing
+units due for all of them at once and prices them with one tariff quote, then
+applies wallet debits, ledger rows and billing cursors (and charged totals) in
+a single transaction with a constant number of queries.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, DateTimeField, DecimalField, F, Value, When
+from django.utils import timezone
+
+from . import tariffs
+from .models import Booking, UserProfile, WalletTransaction
+from .wallet import MONEY, charged_total_increment
+
+# Case/When debits are issued per chunk of users to stay within SQL limits
+UPDATE_CHUNK = 500
+
+DEFAULT_BILLING = {
+    "autostart": True,  # run the tick in a background thread with runserver
+    "interval_seconds": 10,
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+NO_END = np.iinfo(np.int64).max
+
+
+def get_billing_config():
+    config = dict(DEFAULT_BILLING)
+    config.update(getattr(settings, "BILLING_TICK", {}) or {})
+    return config
+
+
+def _micros(value):
+    """Exact integer microseconds since the epoch (floats lose the unit edge)"""
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def compute_units_due(bookings, now, unit_seconds=None):
+    """Vectorized billing units due per booking (numpy int array)"""
+    unit_seconds = unit_seconds or tariffs.unit_seconds()
+    count = len(bookings)
+    timer_started = np.empty(count, dtype=np.int64)
+    last_billed = np.empty(count, dtype=np.int64)
+    fixed_end = np.empty(count, dtype=np.int64)
+    for i, booking in enumerate(bookings):
+        timer_started[i] = _micros(booking.timer_started)
+        last_billed[i] = (
+            _micros(booking.last_billing_at) if booking.last_billing_at else -1
+        )
+        # end_time == start_time marks pay-per-use: bill until the car leaves
+        fixed_end[i] = (
+            NO_END
+            if booking.end_time == booking.start_time
+            else _micros(booking.end_time)
+        )
+
+    bill_from = np.maximum(last_billed, timer_started)
+    bill_until = np.minimum(_micros(now), fixed_end)
+    elapsed = np.maximum(bill_until - bill_from, 0)
+    return elapsed // (unit_seconds * 1_000_000)
+
+
+def run_billing_tick(now=None, user=None, booking_ids=None):
+    """Bill every running timer (optionally limited to a user or bookings).
+
+    Returns a summary dict with the number of bookings billed, units and the
+    total amount charged.
+    """
+    now = now or timezone.now()
+    summary = {"bookings_billed": 0, "units": 0, "amount": Decimal("0.00")}
+
+    with transaction.atomic():
+        bookings = Booking.objects.select_for_update().filter(
+            status="active", timer_started__isnull=False
+        )
+        if user is not None:
+            bookings = bookings.filter(user=user)
+        if booking_ids is not None:
+            bookings = bookings.filter(id__in=booking_ids)
+        bookings = list(
+            bookings.select_related("parking_spot__parking_lot").only(
+                "id",
+                "user_id",
+                "start_time",
+                "end_time",
+                "timer_started",
+                "last_billing_at",
+                "parking_spot__spot_type",
+                "parking_spot__parking_lot__name",
+            )
+        )
+        if not bookings:
+            return summary
+
+        unit_seconds = tariffs.unit_seconds()
+        units = compute_units_due(bookings, now, unit_seconds)
+        due = [(b, int(u)) for b, u in zip(bookings, units) if u > 0]
+        if not due:
+            return summary
+
+        # Price every due span [cursor, cursor + units) in one quote
+        spans_from = [
+            max(b.last_billing_at or b.timer_started, b.timer_started) for b, _ in due
+        ]
+        spans_to = [
+            start + timedelta(seconds=unit_seconds * booking_units)
+            for start, (_, booking_units) in zip(spans_from, due)
+        ]
+        amounts = tariffs.quote(
+            spans_from,
+            spans_to,
+            tariffs.tariffs_for_spots(b.parking_spot for b, _ in due),
+        )
+        due = [
+            (booking, booking_units, amount)
+            for (booking, booking_units), amount in zip(due, amounts)
+        ]
+
+        charges = {}
+        for booking, _, amount in due:
+            charges[booking.user_id] = (
+                charges.get(booking.user_id, Decimal("0.00")) + amount
+            )
+
+        # Users without a profile get one before the debit (allow negative)
+        has_profile = set(
+            UserProfile.objects.filter(user_id__in=list(charges)).values_list(
+                "user_id", flat=True
+            )
+        )
+        missing = [uid for uid in charges if uid not in has_profile]
+        if missing:
+            UserProfile.objects.bulk_create(
+                [UserProfile(user_id=uid) for uid in missing], ignore_conflicts=True
+            )
+
+        user_ids = list(charges)
+        for start in range(0, len(user_ids), UPDATE_CHUNK):
+            chunk = user_ids[start : start + UPDATE_CHUNK]
+            UserProfile.objects.filter(user_id__in=chunk).update(
+                balance=Case(
+                    *[
+                        When(user_id=uid, then=F("balance") - Value(charges[uid]))
+                        for uid in chunk
+                    ],
+                    default=F("balance"),
+                    output_field=DecimalField(max_digits=10, decimal_places=2),
+                )
+            )
+
+        WalletTransaction.objects.bulk_create(
+            [
+                WalletTransaction(
+                    user_id=booking.user_id,
+                    booking_id=booking.id,
+                    type="parking_charge",
+                    amount=amount,
+                    method="Wallet",
+                    note=f"Progressive deduction {booking_units} units ({unit_seconds}s each)",
+                )
+                for booking, booking_units, amount in due
+            ],
+            batch_size=500,
+        )
+
+        # Advance each cursor by whole units billed (remainder carries over)
+        # and add the charge to each booking's maintained total
+        for (booking, _, _), span_end in zip(due, spans_to):
+            booking.last_billing_at = span_end
+        for start in range(0, len(due), UPDATE_CHUNK):
+            chunk = due[start : start + UPDATE_CHUNK]
+            Booking.objects.filter(id__in=[b.id for b, _, _ in chunk]).update(
+                last_billing_at=Case(
+                    *[
+                        When(id=b.id, then=Value(b.last_billing_at))
+                        for b, _, _ in chunk
+                    ],
+                    output_field=DateTimeField(),
+                ),
+                charged_total=charged_total_increment(
+                    Case(
+                        *[When(id=b.id, then=Value(amount)) for b, _, amount in chunk],
+                        output_field=MONEY,
+                    )
+                ),
+            )
+
+    summary["bookings_billed"] = len(due)
+    summary["units"] = sum(booking_units for _, booking_units, _ in due)
+    summary["amount"] = sum(charges.values(), Decimal("0.00"))
+    return summary
+
+
+_ticker = None
+_ticker_lock = threading.Lock()
+
+
+def _tick(log=print):
+    """Run one billing tick, logging (not raising) its outcome"""
+    try:
+        summary = run_billing_tick()
+        if summary["bookings_billed"]:
+            log(
+                f"💰 Billed {summary['bookings_billed']} booking(s), "
+                f"{summary['units']} unit(s), ${summary['amount']}"
+            )
+    except Exception as e:
+        log(f"❌ Billing tick failed: {e}")
+
+
+def _tick_forever(interval, log=print):
+    """Fixed-cadence billing loop (background thread and run_billing_tick)"""
+    while True:
+        started = time.monotonic()
+        close_old_connections()
+        _tick(log)
+        # Fixed cadence: subtract the time the tick itself took
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def start_background_billing():
+    """Run the billing tick in a daemon thread (idempotent)"""
+    global _ticker
+    interval = max(1.0, float(get_billing_config()["interval_seconds"]))
+    with _ticker_lock:
+        if _ticker is None:
+            _ticker = threading.Thread(
+                target=_tick_forever, args=(interval,), name="billing-tick", daemon=True
+            )
+            _ticker.start()
+            print(f"💰 Billing tick started (every {interval:g}s)")
+    return _ticker
+
+
+def autostart_billing():
+    """Start the billing tick with the dev server when BILLING_TICK enables it"""
+    if get_billing_config()["autostart"]:
+        start_background_billing()
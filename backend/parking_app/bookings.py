@@ -0,0 +1,114 @@
+"""
+Booking creation fast path
+"One active booking per spot" and "one active booking per user" are enforced
+by conditional unique constraints on Booking, so creating a booking is a single
+guarded INSERT: no pre-checks that two concurrent requests could both pass.
+A violation is mapped back to which rule was broken for the caller's message.
+The insert runs under the spot lock of ``reservations.reserve`` so a booking
+and a reservation of the same spot and time cannot both be made.
+"""
+
+from functools import partial
+
+from django.db import IntegrityError, transaction
+
+from .models import Booking, ParkingSpot, Reservation
+from .reservations import booking_window, lock_spot, reserved_by_others
+
+
+class BookingConflict(Exception):
+    """The spot or the user already has an active booking (or the spot is reserved)"""
+
+    def __init__(self, reason, existing=None):
+        # reason is "spot", "user" or "reservation"; existing is the
+        # conflicting booking (or reservation)
+        super().__init__(reason)
+        self.reason = reason
+        self.existing = existing
+
+
+def _explain_conflict(user, parking_spot_id):
+    """Map a failed insert back to the broken rule (None if neither holds)"""
+    existing = (
+        Booking.objects.select_related("parking_spot")
+        .filter(parking_spot_id=parking_spot_id, status="active")
+        .first()
+    )
+    if existing:
+        return BookingConflict("spot", existing)
+    existing = (
+        Booking.objects.select_related("parking_spot")
+        .filter(user=user, status="active")
+        .first()
+    )
+    if existing:
+        return BookingConflict("user", existing)
+    return None
+
+
+def create_active_booking(user, parking_spot_id, **fields):
+    """Insert an active booking, raising BookingConflict if a constraint fails
+    or another user reserved the spot for part of the booking.
+
+    Raises ParkingSpot.DoesNotExist if the spot id is unknown.
+    """
+    from .allocation import spot_booked
+
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                if not lock_spot(parking_spot_id):
+                    raise ParkingSpot.DoesNotExist(
+                        f"Parking spot {parking_spot_id} not found"
+                    )
+                reservation_id = reserved_by_others(
+                    parking_spot_id,
+                    *booking_window(fields.get("start_time"), fields.get("end_time")),
+                    user,
+                )
+                if reservation_id is not None:
+                    raise BookingConflict(
+                        "reservation", Reservation.objects.get(id=reservation_id)
+                    )
+                booking = Booking.objects.create(
+                    user=user,
+                    parking_spot_id=parking_spot_id,
+                    status="active",
+                    **fields,
+                )
+            transaction.on_commit(partial(spot_booked, parking_spot_id))
+            return booking
+        except IntegrityError as error:
+            # Failure path only: find out which rule the insert broke
+            conflict = _explain_conflict(user, parking_spot_id)
+            if conflict is not None:
+                raise conflict from error
+            if not ParkingSpot.objects.filter(id=parking_spot_id).exists():
+                raise ParkingSpot.DoesNotExist(
+                    f"Parking spot {parking_spot_id} not found"
+                ) from error
+            if attempt:
+                raise
+            # The conflicting booking ended between the insert and the
+            # lookup: the spot and user are free now, so insert once more
+
+
+def find_duplicate_active_bookings():
+    """Active bookings sharing a spot or user with a newer active booking.
+
+    Returns (booking_id, reason, kept_id) tuples, reason "spot" or "user".
+    Only reads id, spot and user, so it also works on a database migrated
+    to before the single-active constraints.
+    """
+    kept_spots, kept_users, duplicates = {}, {}, []
+    active = Booking.objects.filter(status="active").order_by("-id")
+    for booking_id, spot_id, user_id in active.values_list(
+        "id", "parking_spot_id", "user_id"
+    ):
+        if spot_id in kept_spots:
+            duplicates.append((booking_id, "spot", kept_spots[spot_id]))
+        elif user_id in kept_users:
+            duplicates.append((booking_id, "user", kept_users[user_id]))
+        else:
+            kept_spots[spot_id] = kept_users[user_id] = booking_id
+    return duplicates
@@ -0,0 +1,190 @@
+"""
+Nearby parking search
+Active lots with coordinates are bucketed into an in-memory grid of
+``cell_degrees`` cells. A lookup scans rings of cells outward from the query
+point and yields lots in exact (haversine) distance order, so "nearest k lots"
+touches only the few cells around the user. The grid is rebuilt lazily after a
+lot is saved or deleted in this process, and at least every
+``rebuild_seconds`` to pick up changes made by other processes.
+"""
+
+import heapq
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .models import ParkingLot
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+DEFAULT_SEARCH = {
+    "cell_degrees": 0.01,  # ~1.1 km of latitude per cell
+    "rebuild_seconds": 60,
+    "default_k": 5,
+    "max_k": 50,
+}
+
+
+def get_search_config():
+    config = dict(DEFAULT_SEARCH)
+    config.update(getattr(settings, "PARKING_SEARCH", {}) or {})
+    return config
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """Fixed-size lat/lng grid of (lot_id, lat, lng) points"""
+
+    def __init__(self, points, cell_degrees):
+        self.cell = float(cell_degrees)
+        self.buckets = {}
+        for lot_id, lat, lng in points:
+            self.buckets.setdefault(self._cell_of(lat, lng), []).append(
+                (lot_id, lat, lng)
+            )
+        self.size = sum(len(bucket) for bucket in self.buckets.values())
+        # Bounding box of occupied cells, to know when the rings can stop
+        rows = [r for r, _ in self.buckets] or [0]
+        cols = [c for _, c in self.buckets] or [0]
+        self.rows = (min(rows), max(rows))
+        self.cols = (min(cols), max(cols))
+
+    def _cell_of(self, lat, lng):
+        return math.floor(lat / self.cell), math.floor(lng / self.cell)
+
+    def _ring(self, row, col, radius):
+        """Cells at Chebyshev distance ``radius`` from (row, col)"""
+        if radius == 0:
+            yield row, col
+            return
+        for c in range(col - radius, col + radius + 1):
+            yield row - radius, c
+            yield row + radius, c
+        for r in range(row - radius + 1, row + radius):
+            yield r, col - radius
+            yield r, col + radius
+
+    def _ring_clearance_km(self, lat, radius):
+        """Lower bound on the distance to any point outside rings 0..radius.
+
+        Such a point is at least ``radius`` whole cells away in latitude or
+        in longitude.
+        """
+        if radius == 0:
+            return 0.0
+        # Longitude cells narrow towards the poles: use the widest latitude reached
+        far_lat = min(abs(lat) + (radius + 1) * self.cell, 89.9)
+        cell_km = self.cell * KM_PER_DEGREE
+        return radius * cell_km * min(1.0, math.cos(math.radians(far_lat)))
+
+    def nearest(self, lat, lng, max_km=None):
+        """Yield (distance_km, lot_id) in increasing distance"""
+        if not self.buckets:
+            return
+        row, col = self._cell_of(lat, lng)
+        max_radius = max(
+            abs(row - self.rows[0]),
+            abs(row - self.rows[1]),
+            abs(col - self.cols[0]),
+            abs(col - self.cols[1]),
+        )
+        found = []
+
+        def collect(cell):
+            for lot_id, p_lat, p_lng in self.buckets.get(cell, ()):
+                distance = haversine_km(lat, lng, p_lat, p_lng)
+                if max_km is None or distance <= max_km:
+                    heapq.heappush(found, (distance, lot_id))
+
+        for radius in range(max_radius + 1):
+            if 8 * radius > len(self.buckets):
+                # Mostly empty space left (query far from the lots): scan
+                # the remaining buckets directly instead of ring by ring
+                for cell in self.buckets:
+                    if max(abs(cell[0] - row), abs(cell[1] - col)) >= radius:
+                        collect(cell)
+                break
+            for cell in self._ring(row, col, radius):
+                collect(cell)
+            # Nothing outside the scanned rings is closer than this
+            clearance = self._ring_clearance_km(lat, radius)
+            while found and found[0][0] <= clearance:
+                yield heapq.heappop(found)
+            if max_km is not None and clearance > max_km:
+                break
+        while found:
+            yield heapq.heappop(found)
+
+
+_index = None
+_built_at = 0.0
+_lock = threading.Lock()
+
+
+def build_lot_index(config=None):
+    config = config or get_search_config()
+    points = [
+        (lot_id, float(lat), float(lng))
+        for lot_id, lat, lng in ParkingLot.objects.filter(
+            is_active=True, latitude__isnull=False, longitude__isnull=False
+        ).values_list("id", "latitude", "longitude")
+    ]
+    return GridIndex(points, config["cell_degrees"])
+
+
+def get_lot_index():
+    """Process-wide grid of active lots, rebuilt when invalidated or stale"""
+    global _index, _built_at
+    config = get_search_config()
+    with _lock:
+        if _index is None or time.monotonic() - _built_at >= config["rebuild_seconds"]:
+            _index = build_lot_index(config)
+            _built_at = time.monotonic()
+        return _index
+
+
+def invalidate_lot_index():
+    """Drop the grid so the next lookup rebuilds it (lot saved or deleted)"""
+    global _index
+    with _lock:
+        _index = None
+
+
+def nearby_lots_with_space(lat, lng, k, max_km=None, batch_size=None):
+    """The ``k`` nearest active lots with a free spot, nearest first.
+
+    Returns (lot, distance_km) pairs. Candidates come from the grid in
+    distance order and their live counters are read in batches, so usually a
+    single query serves the whole lookup.
+    """
+    batch_size = batch_size or max(2 * k, 10)
+    candidates = get_lot_index().nearest(lat, lng, max_km)
+    results = []
+    while len(results) < k:
+        batch = [pair for _, pair in zip(range(batch_size), candidates)]
+        if not batch:
+            break
+        lots = ParkingLot.objects.filter(
+            id__in=[lot_id for _, lot_id in batch], is_active=True
+        ).in_bulk()
+        for distance, lot_id in batch:
+            lot = lots.get(lot_id)
+            if lot is not None and lot.available_spots > 0:
+                results.append((lot, distance))
+                if len(results) == k:
+                    break
+    return results
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Django management command to benchmark booking list serialization
+Compares the nested BookingSerializer (model instances, user + spot + balance)
+with the slim ?fields= rows built from values(). Fixture bookings are created
+inside a transaction that is rolled back, so the database is left untouched.
+"""
+
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from parking_app.models import Booking, ParkingLot, ParkingSpot, UserProfile
+from parking_app.serializers import (
+    BOOKING_LIST_FIELDS,
+    DEFAULT_BOOKING_LIST_FIELDS,
+    BookingSerializer,
+    booking_list_values,
+    serialize_booking_rows,
+)
+
+
+class Command(BaseCommand):
+    help = "Time booking list serialization per 1,000 bookings (full vs slim)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bookings",
+            type=int,
+            default=1000,
+            help="Fixture bookings to serialize (default: 1000)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Runs per variant; the best time is reported (default: 5)",
+        )
+
+    def handle(self, *args, **options):
+        count = options["bookings"]
+        with transaction.atomic():
+            user = self._create_fixture(count)
+            # Every run uses .all() so no instance or result cache is reused
+            bookings = Booking.objects.filter(user=user).order_by("-start_time", "-id")
+
+            variants = [
+                (
+                    "BookingSerializer (before)",
+                    lambda: BookingSerializer(bookings.all(), many=True).data,
+                ),
+                (
+                    "BookingSerializer + select_related",
+                    lambda: BookingSerializer(
+                        bookings.select_related("parking_spot", "user__profile"),
+                        many=True,
+                    ).data,
+                ),
+                (
+                    "?fields= default columns",
+                    lambda: self._slim(bookings, DEFAULT_BOOKING_LIST_FIELDS),
+                ),
+                (
+                    "?fields= every column",
+                    lambda: self._slim(bookings, list(BOOKING_LIST_FIELDS)),
+                ),
+            ]
+
+            self.stdout.write(f"📊 Serializing {count} bookings:")
+            for label, run in variants:
+                best, queries = self._measure(run, options["repeat"])
+                per_thousand = best * 1000 / count * 1000
+                self.stdout.write(
+                    f"  {label:<36} {per_thousand:9.1f} ms / 1,000 bookings "
+                    f"({queries} queries)"
+                )
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            self.style.SUCCESS("✅ Benchmark finished (fixture rolled back)")
+        )
+
+    def _slim(self, bookings, fields):
+        return serialize_booking_rows(booking_list_values(bookings, fields), fields)
+
+    def _measure(self, run, repeat):
+        best = None
+        for _ in range(max(repeat, 1)):
+            # The query log is a bounded deque; a full one would count as 0
+            reset_queries()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, len(queries)
+
+    def _create_fixture(self, count):
+        user = User.objects.create(username=f"benchmark_{timezone.now():%H%M%S%f}")
+        UserProfile.objects.create(user=user, balance=100, number_plate="BENCH1")
+        lot = ParkingLot.objects.create(
+            name="Benchmark Lot", address="Benchmark", total_spots=10, hourly_rate=2
+        )
+        spots = [
+            ParkingSpot.objects.create(parking_lot=lot, spot_number=f"B{i}")
+            for i in range(10)
+        ]
+        now = timezone.now()
+        Booking.objects.bulk_create(
+            [
+                Booking(
+                    user=user,
+                    parking_spot=spots[i % len(spots)],
+                    start_time=now - timedelta(hours=i),
+                    end_time=now - timedelta(hours=i) + timedelta(minutes=45),
+                    duration_minutes=45,
+                    status="completed",
+                    total_cost=90,
+                    number_plate="BENCH1",
+                )
+                for i in range(count)
+            ],
+            batch_size=500,
+        )
+        return user
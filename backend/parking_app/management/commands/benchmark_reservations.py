@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Django management command to benchmark reservation conflict detection
+Builds an in-memory ReservationBook of random non-overlapping reservations
+(no database rows are written) and times random "is spot S free during
+[t1, t2)" lookups against a linear scan of the same spot's reservations.
+Both answers are compared on every query.
+"""
+
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from parking_app.reservations import ReservationBook
+
+
+class Command(BaseCommand):
+    help = "Time reservation conflict checks (bisect book vs linear scan)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reservations",
+            type=int,
+            default=100000,
+            help="Reservations in the book (default: 100000)",
+        )
+        parser.add_argument(
+            "--spots", type=int, default=200, help="Spots to spread them over"
+        )
+        parser.add_argument(
+            "--queries", type=int, default=20000, help="Lookups to time"
+        )
+        parser.add_argument("--seed", type=int, default=50)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        spots = options["spots"]
+        per_spot = max(1, options["reservations"] // spots)
+
+        # Back-to-back reservations of 30 min - 4 h with random gaps
+        rows = []
+        for spot_id in range(spots):
+            moment = 0.0
+            for _ in range(per_spot):
+                moment += rng.uniform(0, 3600)
+                length = rng.uniform(1800, 4 * 3600)
+                rows.append((len(rows), spot_id, moment, moment + length))
+                moment += length
+        horizon = max(end for _, _, _, end in rows)
+
+        started = time.perf_counter()
+        book = ReservationBook(rows)
+        build_seconds = time.perf_counter() - started
+        by_spot = {}
+        for reservation_id, spot_id, start, end in rows:
+            by_spot.setdefault(spot_id, []).append((start, end, reservation_id))
+
+        queries = [
+            (rng.randrange(spots), t1, t1 + rng.uniform(600, 3 * 3600))
+            for t1 in (rng.uniform(0, horizon) for _ in range(options["queries"]))
+        ]
+
+        started = time.perf_counter()
+        fast = [book.is_free(spot_id, t1, t2) for spot_id, t1, t2 in queries]
+        fast_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        slow = [
+            not any(start < t2 and end > t1 for start, end, _ in by_spot[spot_id])
+            for spot_id, t1, t2 in queries
+        ]
+        slow_seconds = time.perf_counter() - started
+
+        count = len(queries)
+        self.stdout.write(
+            f"📅 {len(book)} reservations on {spots} spots "
+            f"(book built in {build_seconds * 1000:.1f} ms)"
+        )
+        self.stdout.write(
+            f"  ⚡ bisect book:  {fast_seconds / count * 1e6:8.2f} µs/query"
+        )
+        self.stdout.write(
+            f"  🐢 linear scan: {slow_seconds / count * 1e6:8.2f} µs/query"
+        )
+        self.stdout.write(f"  🆓 free answers: {sum(fast)} of {count}")
+        if fast != slow:
+            mismatches = sum(a != b for a, b in zip(fast, slow))
+            self.stdout.write(self.style.ERROR(f"❌ {mismatches} answers differ"))
+            return
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"✅ Answers match; {slow_seconds / max(fast_seconds, 1e-9):.0f}x faster"
+            )
+        )
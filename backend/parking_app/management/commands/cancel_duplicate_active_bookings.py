@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Django management command to resolve duplicate active bookings
+Migration 0015 refuses to add the one-active-booking-per-spot/per-user
+constraints while duplicates exist. This keeps the newest active booking of
+each spot and user and cancels the older ones, after review with --dry-run.
+"""
+
+from django.core.management.base import BaseCommand
+from parking_app.bookings import find_duplicate_active_bookings
+from parking_app.models import Booking
+
+
+class Command(BaseCommand):
+    help = "Cancel active bookings superseded by a newer one on the same spot or user"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List the bookings that would be cancelled without changing them",
+        )
+
+    def handle(self, *args, **options):
+        duplicates = find_duplicate_active_bookings()
+        for booking_id, reason, kept_id in duplicates:
+            self.stdout.write(
+                f"  🔁 Booking {booking_id}: same {reason} as newer booking {kept_id}"
+            )
+
+        if options["dry_run"]:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"DRY RUN - would cancel {len(duplicates)} booking(s)"
+                )
+            )
+            return
+
+        if duplicates:
+            Booking.objects.filter(
+                id__in=[booking_id for booking_id, _, _ in duplicates]
+            ).update(status="cancelled")
+        self.stdout.write(
+            self.style.SUCCESS(f"✅ Cancelled {len(duplicates)} duplicate booking(s)")
+        )
@@ -2,14 +2,11 @@
 """
 Django management command to automatically check and bill overtime bookings
 This command should be run every minute via cron job or celery
+(or use run_overtime_scheduler, which wakes only when a deadline is due)
 """
 
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from django.db import transaction
-from parking_app.models import Booking
-from parking_app.views import check_if_car_still_parked, trigger_esp32_booking_led
-from parking_app.notifications import NotificationService
+from parking_app.overtime import expired_active_bookings, process_overtime_bookings
 import logging
 
 logger = logging.getLogger(__name__)
@@ -33,84 +30,25 @@ class Command(BaseCommand):
         self.stdout.write('🕐 Checking for overtime bookings...')
         
         # Get all active bookings that have expired
-        expired_bookings = Booking.objects.filter(
-            status='active'
-        ).exclude(
-            end_time__gt=timezone.now()
-        )
-        
-        if not expired_bookings.exists():
+        expired_bookings = list(expired_active_bookings())
+
+        if not expired_bookings:
             self.stdout.write(self.style.SUCCESS('✅ No expired bookings found'))
             return
-        
-        self.stdout.write(f'📋 Found {expired_bookings.count()} expired bookings')
-        
-        processed_count = 0
-        completed_count = 0
-        billing_count = 0
-        
-        for booking in expired_bookings:
-            try:
-                self.stdout.write(f'  📍 Processing booking {booking.id} (Spot {booking.parking_spot.spot_number})')
-                
-                # Calculate overtime
-                overtime_minutes, overtime_cost = booking.calculate_overtime()
-                
-                if overtime_minutes > 0:
-                    self.stdout.write(f'    ⏰ Overtime: {overtime_minutes} minutes (${overtime_cost:.2f})')
-                    
-                    if not dry_run:
-                        # Update overtime billing
-                        booking.update_overtime_billing()
-                        
-                        # Check if car is still parked
-                        is_still_parked = check_if_car_still_parked(booking.parking_spot)
-                        
-                        if is_still_parked:
-                            self.stdout.write(f'    🚗 Car still parked - continuing overtime billing')
-                            billing_count += 1
-                            
-                            # Send overtime alert notification
-                            NotificationService.send_overtime_alert(booking)
-                            
-                            # Turn on red light (overtime warning)
-                            try:
-                                trigger_esp32_booking_led(booking.parking_spot.spot_number, True)
-                                self.stdout.write(f'    🔴 Red light activated for overtime')
-                            except Exception as e:
-                                self.stdout.write(f'    ⚠️  Failed to activate red light: {e}')
-                        else:
-                            self.stdout.write(f'    🚗 Car has left - completing booking')
-                            
-                            # Mark as completed
-                            with transaction.atomic():
-                                booking.status = 'completed'
-                                booking.parking_spot.is_occupied = False
-                                booking.parking_spot.save()
-                                booking.save()
-                            
-                            # Send completion notification
-                            NotificationService.send_booking_completion_notification(booking)
-                            
-                            # Turn off lights
-                            try:
-                                trigger_esp32_booking_led(booking.parking_spot.spot_number, False)
-                                self.stdout.write(f'    🔵 Lights turned off')
-                            except Exception as e:
-                                self.stdout.write(f'    ⚠️  Failed to turn off lights: {e}')
-                            
-                            completed_count += 1
-                    else:
-                        self.stdout.write(f'    🚗 Would check car occupancy and update billing')
-                        billing_count += 1
-                
-                processed_count += 1
-                
-            except Exception as e:
-                self.stdout.write(
-                    self.style.ERROR(f'    ❌ Error processing booking {booking.id}: {e}')
-                )
-        
+
+        self.stdout.write(f'📋 Found {len(expired_bookings)} expired bookings')
+
+        results = process_overtime_bookings(expired_bookings, dry_run=dry_run)
+        for result in results:
+            self.stdout.write(
+                f"  📍 Booking {result['booking_id']} (Spot {result['spot_number']}): "
+                f"⏰ {result['overtime_minutes']} minutes (${result['overtime_cost']:.2f}) - {result['status']}"
+            )
+
+        processed_count = len(expired_bookings)
+        completed_count = sum(1 for r in results if r['status'] == 'completed')
+        billing_count = len(results) - completed_count
+
         # Summary
         self.stdout.write('\n📊 Summary:')
         self.stdout.write(f'  📋 Total processed: {processed_count}')
@@ -1,29 +1,37 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from parking_app.models import Booking
+from parking_app.overtime import expire_bookings
 
 class Command(BaseCommand):
     help = 'Mark expired bookings as completed and free up parking spots'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Bookings expired per transaction (default: 1000)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be done without making changes',
+        )
+
     def handle(self, *args, **options):
-        # Get all active bookings that have expired
-        expired_bookings = Booking.objects.filter(
-            status='active',
-            end_time__lt=timezone.now()
+        # Set-based: final overtime for the whole expired set is computed at
+        # once, bookings and spots are written in bulk per batch
+        expired_ids = expire_bookings(
+            batch_size=options['batch_size'], dry_run=options['dry_run']
         )
-        
-        count = 0
-        for booking in expired_bookings:
-            if booking.mark_as_completed_if_expired():
-                count += 1
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'Marked booking {booking.id} as completed and freed spot {booking.parking_spot.spot_number}'
-                    )
-                )
-        
+
+        if options['dry_run']:
+            self.stdout.write(
+                self.style.WARNING(f'DRY RUN - would expire {len(expired_ids)} bookings')
+            )
+            return
+
         self.stdout.write(
             self.style.SUCCESS(
-                f'Successfully processed {count} expired bookings'
+                f'Successfully processed {len(expired_ids)} expired bookings'
             )
-        ) 
\ No newline at end of file
+        )
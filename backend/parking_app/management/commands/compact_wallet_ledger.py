@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Django management command to compact progressive parking charges
+Merges each completed booking's micro-charges into one ledger row per session
+day (merged ids kept in WalletTransaction.compacted_from). Run nightly via
+cron; compaction never runs on the request path.
+"""
+
+from django.core.management.base import BaseCommand
+from parking_app.wallet import compact_booking_charges
+
+
+class Command(BaseCommand):
+    help = "Merge completed bookings' progressive charges into per-session ledger rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Bookings compacted per transaction (default: 500)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Show what would be merged without making changes",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        if dry_run:
+            self.stdout.write(
+                self.style.WARNING("DRY RUN MODE - No changes will be made")
+            )
+
+        lines = rows = 0
+        while True:
+            results = compact_booking_charges(
+                limit=options["batch_size"], dry_run=dry_run
+            )
+            lines += len(results)
+            rows += sum(result["rows_merged"] for result in results)
+            # A dry run cannot advance past the first batch; a real run stops
+            # once a batch finds nothing left to merge
+            if dry_run or not results:
+                break
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'Would merge' if dry_run else 'Merged'} {rows} ledger row(s) "
+                f"into {lines} session-day line(s)"
+            )
+        )
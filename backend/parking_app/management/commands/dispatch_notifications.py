@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Django management command to deliver queued notifications
+Drains the NotificationOutbox with the configured transport; use it when the
+in-process dispatcher is not autostarted (e.g. several web workers).
+"""
+
+from django.core.management.base import BaseCommand
+from parking_app.outbox import OutboxDispatcher, dispatch_pending, get_transport
+
+
+class Command(BaseCommand):
+    help = "Send queued WhatsApp notifications, retrying failures with backoff"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send one batch of due messages and exit",
+        )
+        parser.add_argument(
+            "--transport",
+            choices=["twilio", "stub"],
+            help="Override NOTIFICATION_OUTBOX['transport']",
+        )
+
+    def handle(self, *args, **options):
+        transport = get_transport(options["transport"])
+
+        if options["once"]:
+            self._report(dispatch_pending(transport=transport))
+            return
+
+        dispatcher = OutboxDispatcher(transport=transport)
+        self.stdout.write("📤 Notification dispatcher running (Ctrl+C to stop)")
+        try:
+            dispatcher.run_forever(on_summary=self._report)
+        except KeyboardInterrupt:
+            dispatcher.stop()
+        self.stdout.write(self.style.SUCCESS("✅ Notification dispatcher stopped"))
+
+    def _report(self, summary):
+        self.stdout.write(
+            f"  ✅ {summary['sent']} sent, 🔁 {summary['retrying']} retrying, "
+            f"❌ {summary['failed']} failed"
+        )
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Django management command to reconcile per-lot spot counters
+Recounts total, occupied and reserved spots for every lot and corrects any
+drift (e.g. from raw SQL). The overtime scheduler does the same every
+OVERTIME_SCHEDULER["reconcile_seconds"]; run this via cron without it.
+"""
+
+from django.core.management.base import BaseCommand
+from parking_app.models import ParkingLot
+
+
+class Command(BaseCommand):
+    help = "Recount per-lot spot counters and fix any drift"
+
+    def handle(self, *args, **options):
+        drifted = ParkingLot.recount()
+        for lot_id, stored, actual in drifted:
+            self.stdout.write(
+                f"  🔧 Lot {lot_id}: (spots, occupied, reserved) {stored} -> {actual}"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"✅ Counters reconciled ({len(drifted)} lot(s) fixed)")
+        )
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Django management command to run the progressive billing tick
+Bills every running parking timer on a fixed cadence, whether or not clients
+poll the bookings endpoint. Run as a long-lived process, or with --once from cron.
+"""
+
+from django.core.management.base import BaseCommand
+from parking_app.billing import _tick, _tick_forever
+
+
+class Command(BaseCommand):
+    help = "Bill all running parking timers on a fixed cadence"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=10.0,
+            help="Seconds between billing ticks (default: 10)",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run a single tick and exit",
+        )
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            _tick(self.stdout.write)
+            return
+
+        interval = max(1.0, options["interval"])
+        self.stdout.write(f"💰 Billing tick every {interval:g}s (Ctrl+C to stop)")
+        try:
+            _tick_forever(interval, self.stdout.write)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS("✅ Billing tick stopped"))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Django management command to run the overtime / expiry scheduler
+Long-running replacement for the per-minute check_overtime_bookings cron job:
+sleeps until the next booking deadline instead of rescanning every minute.
+"""
+
+from django.core.management.base import BaseCommand
+from parking_app.overtime import OvertimeScheduler
+
+
+class Command(BaseCommand):
+    help = "Process booking expiries and overtime exactly when they fall due"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process everything currently due and exit",
+        )
+
+    def handle(self, *args, **options):
+        scheduler = OvertimeScheduler()
+
+        if options["once"]:
+            self._report(scheduler.run_due())
+            return
+
+        self.stdout.write("⏰ Overtime scheduler running (Ctrl+C to stop)")
+        try:
+            scheduler.run_forever(on_results=self._report)
+        except KeyboardInterrupt:
+            scheduler.stop()
+        self.stdout.write(self.style.SUCCESS("✅ Overtime scheduler stopped"))
+
+    def _report(self, results):
+        for result in results:
+            icon = "✅" if result["status"] == "completed" else "💰"
+            self.stdout.write(
+                f"  {icon} Booking {result['booking_id']} (Spot {result['spot_number']}): "
+                f"{result['status']}, {result['overtime_minutes']} min overtime"
+            )
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Django management command to write end-of-day wallet balance snapshots
+Run nightly via cron after midnight; past balances are then read from the
+latest snapshot instead of replaying the ledger.
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from parking_app.wallet import snapshot_balances
+
+
+class Command(BaseCommand):
+    help = "Snapshot end-of-day wallet balances for users with activity"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--day",
+            help="Day to snapshot, YYYY-MM-DD (default: yesterday)",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=1,
+            help="Also snapshot this many days up to --day, oldest first (catch-up)",
+        )
+
+    def handle(self, *args, **options):
+        if options["day"]:
+            last = parse_date(options["day"])
+            if last is None:
+                raise CommandError("--day must be YYYY-MM-DD")
+        else:
+            last = timezone.localdate() - timedelta(days=1)
+        if last >= timezone.localdate():
+            raise CommandError("Only finished days can be snapshotted")
+
+        total = 0
+        for offset in range(max(1, options["days"]) - 1, -1, -1):
+            day = last - timedelta(days=offset)
+            written = snapshot_balances(day)
+            total += written
+            self.stdout.write(f"  📸 {day}: {written} balance(s)")
+        self.stdout.write(self.style.SUCCESS(f"✅ Wrote {total} snapshot(s)"))
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:05
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0011_booking_number_plate"),
+    ]
+
+    operations = [
+        # Existing bookings stay NULL (untracked): their totals come from the ledger
+        migrations.AddField(
+            model_name="booking",
+            name="charged_total",
+            field=models.DecimalField(
+                blank=True, decimal_places=2, max_digits=10, null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="booking",
+            name="charged_total",
+            field=models.DecimalField(
+                blank=True,
+                decimal_places=2,
+                default=Decimal("0"),
+                help_text="Net wallet charges for this booking, maintained with each debit (null = not tracked, sum the ledger)",
+                max_digits=10,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0012_booking_charged_total"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wallettransaction",
+            name="compacted_from",
+            field=models.JSONField(
+                blank=True,
+                help_text="Ids of the progressive charges merged into this summary row",
+                null=True,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="wallettransaction",
+            index=models.Index(
+                fields=["user", "-created_at"], name="parking_app_user_id_0c4f5f_idx"
+            ),
+        ),
+    ]
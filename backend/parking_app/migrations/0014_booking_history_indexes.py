@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0013_wallettransaction_compacted_from"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="booking",
+            index=models.Index(
+                fields=["user", "-start_time", "-id"],
+                name="parking_app_user_id_38942a_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="booking",
+            index=models.Index(
+                fields=["-start_time", "-id"], name="parking_app_start_t_5a93f4_idx"
+            ),
+        ),
+    ]
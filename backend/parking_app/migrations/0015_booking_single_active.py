@@ -0,0 +1,64 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:29
+
+from django.db import migrations, models
+
+
+def check_single_active_bookings(apps, schema_editor):
+    """Refuse to migrate while a spot or user has several active bookings.
+
+    Which of them is the real session is a business decision, so nothing is
+    cancelled here: resolve the listed conflicts (e.g. with
+    `manage.py cancel_duplicate_active_bookings`) and migrate again.
+    """
+    Booking = apps.get_model("parking_app", "Booking")
+    kept_spots, kept_users, conflicts = {}, {}, []
+    active = Booking.objects.filter(status="active").order_by("-id")
+    for booking_id, spot_id, user_id in active.values_list(
+        "id", "parking_spot_id", "user_id"
+    ):
+        if spot_id in kept_spots:
+            conflicts.append(
+                f"booking {booking_id} (spot {spot_id}) vs {kept_spots[spot_id]}"
+            )
+        elif user_id in kept_users:
+            conflicts.append(
+                f"booking {booking_id} (user {user_id}) vs {kept_users[user_id]}"
+            )
+        else:
+            kept_spots[spot_id] = kept_users[user_id] = booking_id
+    if conflicts:
+        shown = "\n  ".join(conflicts[:50])
+        more = f"\n  ... and {len(conflicts) - 50} more" if len(conflicts) > 50 else ""
+        raise RuntimeError(
+            f"{len(conflicts)} active booking(s) conflict with a newer active "
+            f"booking of the same spot or user:\n  {shown}{more}\n"
+            "Resolve them (manage.py cancel_duplicate_active_bookings) and "
+            "migrate again."
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0014_booking_history_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(check_single_active_bookings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="booking",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status", "active")),
+                fields=("parking_spot",),
+                name="unique_active_booking_per_spot",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="booking",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("status", "active")),
+                fields=("user",),
+                name="unique_active_booking_per_user",
+            ),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("parking_app", "0016_notificationoutbox"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WalletBalanceSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("balance", models.DecimalField(decimal_places=2, max_digits=10)),
+                (
+                    "as_of",
+                    models.DateTimeField(
+                        help_text="End of the day (next local midnight); later ledger rows are excluded"
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "-as_of"], name="parking_app_user_id_53a862_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="walletbalancesnapshot",
+            constraint=models.UniqueConstraint(
+                fields=("user", "day"), name="unique_wallet_snapshot_per_day"
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:47
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_existing_spots(apps, schema_editor):
+    """Initialise the lot counters from the spot table"""
+    ParkingLot = apps.get_model("parking_app", "ParkingLot")
+    ParkingSpot = apps.get_model("parking_app", "ParkingSpot")
+    counts = (
+        ParkingSpot.objects.order_by()
+        .values("parking_lot_id")
+        .annotate(
+            spots=Count("id"),
+            occupied=Count("id", filter=Q(is_occupied=True)),
+            reserved=Count("id", filter=Q(is_reserved=True)),
+        )
+    )
+    for row in counts:
+        ParkingLot.objects.filter(id=row["parking_lot_id"]).update(
+            spot_count=row["spots"],
+            occupied_count=row["occupied"],
+            reserved_count=row["reserved"],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0017_walletbalancesnapshot"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="parkinglot",
+            name="occupied_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="parkinglot",
+            name="reserved_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="parkinglot",
+            name="spot_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_existing_spots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0020_reservations"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="booking",
+            index=models.Index(
+                fields=["status", "updated_at"], name="parking_app_status_24d50b_idx"
+            ),
+        ),
+    ]
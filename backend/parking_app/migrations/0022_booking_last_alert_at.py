@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parking_app", "0021_booking_status_updated_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="booking",
+            name="last_alert_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="When the last overtime alert was sent (shared by every process)",
+                null=True,
+            ),
+        ),
+    ]
@@ -1,4 +1,8 @@
-from django.db import models
+from functools import partial
+
+from django.db import models, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -12,15 +16,170 @@ class ParkingLot(models.Model):
         max_digits=3, decimal_places=1, default=4.5
     )  # Added to match frontend
     is_active = models.BooleanField(default=True)
+    latitude = models.DecimalField(
+        max_digits=9,
+        decimal_places=6,
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)],
+    )
+    longitude = models.DecimalField(
+        max_digits=9,
+        decimal_places=6,
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)],
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Spot counters, kept current by every ParkingSpot write (save, delete and
+    # queryset update/delete/bulk_create); reconcile_lot_counters fixes drift
+    spot_count = models.IntegerField(default=0, editable=False)
+    occupied_count = models.IntegerField(default=0, editable=False)
+    reserved_count = models.IntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ("spot_count", "occupied_count", "reserved_count")
 
     def __str__(self):
         return self.name
 
     @property
     def available_spots(self):
-        return self.parkingspot_set.filter(is_occupied=False).count()
+        return self.spot_count - self.occupied_count
+
+    @classmethod
+    def adjust_counters(cls, lot_id, spots=0, occupied=0, reserved=0):
+        """Atomically add deltas to one lot's counters"""
+        deltas = zip(cls.COUNTER_FIELDS, (spots, occupied, reserved))
+        changes = {field: F(field) + delta for field, delta in deltas if delta}
+        if lot_id is not None and changes:
+            cls.objects.filter(id=lot_id).update(**changes)
+
+    @classmethod
+    def recount(cls, lot_ids=None):
+        """Recompute counters from the spot table (one grouped query).
+
+        ``lot_ids`` None recounts every lot. Returns the lots whose stored
+        counters were wrong, as (lot_id, stored, actual) tuples.
+        """
+        lots = (
+            cls.objects.all() if lot_ids is None else cls.objects.filter(id__in=lot_ids)
+        )
+        actual = {
+            row["parking_lot_id"]: (row["spots"], row["occupied"], row["reserved"])
+            for row in ParkingSpot.objects.filter(parking_lot__in=lots)
+            .order_by()
+            .values("parking_lot_id")
+            .annotate(
+                spots=Count("id"),
+                occupied=Count("id", filter=Q(is_occupied=True)),
+                reserved=Count("id", filter=Q(is_reserved=True)),
+            )
+        }
+        drifted = []
+        for lot in lots.only("id", *cls.COUNTER_FIELDS):
+            stored = tuple(getattr(lot, field) for field in cls.COUNTER_FIELDS)
+            counts = actual.get(lot.id, (0, 0, 0))
+            if stored != counts:
+                drifted.append((lot.id, stored, counts))
+        cls.objects.bulk_update(
+            [
+                cls(id=lot_id, **dict(zip(cls.COUNTER_FIELDS, counts)))
+                for lot_id, _, counts in drifted
+            ],
+            cls.COUNTER_FIELDS,
+        )
+        return drifted
+
+    def save(self, *args, **kwargs):
+        # Counters are only changed by atomic UPDATEs; a full save of a stale
+        # instance must not write them back
+        if (
+            not self._state.adding
+            and kwargs.get("update_fields") is None
+            and not kwargs.get("force_insert")
+        ):
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+        self._invalidate_indexes()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self._invalidate_indexes()
+        return result
+
+    @staticmethod
+    def _invalidate_indexes():
+        """Rebuild the in-memory search and allocation indexes after commit"""
+        from .allocation import invalidate_spot_pool
+        from .geo import invalidate_lot_index
+
+        transaction.on_commit(invalidate_lot_index)
+        transaction.on_commit(invalidate_spot_pool)
+
+
+# ParkingSpot fields that feed the lot counters
+COUNTED_SPOT_FIELDS = ("parking_lot_id", "is_occupied", "is_reserved")
+
+
+class ParkingSpotQuerySet(models.QuerySet):
+    """Bulk spot writes recount the lots they touch"""
+
+    def _invalidate_allocation(self):
+        from .allocation import invalidate_spot_pool
+
+        transaction.on_commit(invalidate_spot_pool, using=self.db)
+
+    def _lot_ids(self):
+        return set(self.order_by().values_list("parking_lot_id", flat=True).distinct())
+
+    def update(self, **kwargs):
+        if not {"parking_lot", "parking_lot_id", "is_occupied", "is_reserved"} & set(
+            kwargs
+        ):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            lot_ids = self._lot_ids()
+            rows = super().update(**kwargs)
+            moved_to = kwargs.get("parking_lot_id", kwargs.get("parking_lot"))
+            if moved_to is not None:
+                lot_ids.add(getattr(moved_to, "pk", moved_to))
+            ParkingLot.recount(lot_ids)
+            self._invalidate_allocation()
+        return rows
+
+    def transition(self, pk, previous, current):
+        """Move one spot's counted fields from ``previous`` to ``current``.
+
+        A conditional UPDATE: it only matches while the row still holds
+        ``previous``, so of two writers racing on the same transition exactly
+        one sees a changed row. Returns whether this call changed it.
+        """
+        row = self.filter(pk=pk, **dict(zip(COUNTED_SPOT_FIELDS, previous)))
+        # Plain update: the caller adjusts the counters itself
+        return bool(
+            models.QuerySet.update(row, **dict(zip(COUNTED_SPOT_FIELDS, current)))
+        )
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            lot_ids = self._lot_ids()
+            result = super().delete()
+            ParkingLot.recount(lot_ids)
+            self._invalidate_allocation()
+        return result
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            ParkingLot.recount({obj.parking_lot_id for obj in objs})
+            self._invalidate_allocation()
+        return created
 
 
 class ParkingSpot(models.Model):
@@ -36,15 +195,134 @@ class ParkingSpot(models.Model):
     spot_type = models.CharField(max_length=20, choices=SPOT_TYPES, default="regular")
     is_occupied = models.BooleanField(default=False)
     is_reserved = models.BooleanField(default=False)
+    # Optional position of the spot itself (e.g. for in-lot wayfinding)
+    latitude = models.DecimalField(
+        max_digits=9, decimal_places=6, null=True, blank=True
+    )
+    longitude = models.DecimalField(
+        max_digits=9, decimal_places=6, null=True, blank=True
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ParkingSpotQuerySet.as_manager()
+
     class Meta:
         unique_together = ["parking_lot", "spot_number"]
 
     def __str__(self):
         return f"{self.parking_lot.name} - Spot {self.spot_number}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        spot = super().from_db(db, field_names, values)
+        spot._counted = spot._counted_state()
+        return spot
+
+    def _counted_state(self):
+        """(lot id, occupied, reserved) as loaded, or None if any is deferred"""
+        if any(name not in self.__dict__ for name in COUNTED_SPOT_FIELDS):
+            return None
+        return tuple(self.__dict__[name] for name in COUNTED_SPOT_FIELDS)
+
+    @staticmethod
+    def _adjust_lot(state, sign):
+        lot_id, occupied, reserved = state
+        ParkingLot.adjust_counters(
+            lot_id,
+            spots=sign,
+            occupied=sign * bool(occupied),
+            reserved=sign * bool(reserved),
+        )
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        saved = (
+            set(COUNTED_SPOT_FIELDS)
+            if update_fields is None
+            else {f if f != "parking_lot" else "parking_lot_id" for f in update_fields}
+            & set(COUNTED_SPOT_FIELDS)
+        )
+        if self._state.adding or not saved:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                if saved:
+                    current = tuple(getattr(self, n) for n in COUNTED_SPOT_FIELDS)
+                    self._adjust_lot(current, +1)
+                    self._counted = current
+                    self._notify_allocation(None, current)
+            return
+
+        with transaction.atomic():
+            previous = getattr(self, "_counted", None)
+            lot_ids = {self.parking_lot_id}
+            for _ in range(3):
+                if previous is None:
+                    # Deferred, stale or unknown state: read what the row holds now
+                    previous = (
+                        ParkingSpot.objects.filter(pk=self.pk)
+                        .values_list(*COUNTED_SPOT_FIELDS)
+                        .first()
+                    )
+                    if previous is None:
+                        break  # no row: the save below inserts it
+                lot_ids.add(previous[0])
+                current = tuple(
+                    getattr(self, name) if name in saved else old
+                    for name, old in zip(COUNTED_SPOT_FIELDS, previous)
+                )
+                # Counters follow only a transition this write actually made:
+                # a stale instance or a concurrent writer matches no row (even
+                # when ``current == previous``, the row may have moved on)
+                if ParkingSpot.objects.transition(self.pk, previous, current):
+                    break
+                previous = None
+            else:
+                # Lost the race every time: count the lots again instead
+                super().save(*args, **kwargs)
+                ParkingLot.recount(lot_ids)
+                self._counted = None
+                self._notify_allocation(None, None)
+                return
+
+            super().save(*args, **kwargs)
+            if previous is None:
+                current = tuple(getattr(self, n) for n in COUNTED_SPOT_FIELDS)
+                self._adjust_lot(current, +1)
+            elif current != previous:
+                self._adjust_lot(previous, -1)
+                self._adjust_lot(current, +1)
+            self._counted = current
+            self._notify_allocation(previous, current)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            state = (
+                ParkingSpot.objects.filter(pk=self.pk)
+                .values_list(*COUNTED_SPOT_FIELDS)
+                .first()
+            )
+            result = super().delete(*args, **kwargs)
+            if state is not None:
+                self._adjust_lot(state, -1)
+            self._notify_allocation(state, None)
+        return result
+
+    def _notify_allocation(self, previous, current):
+        """Feed the in-memory allocation pool once the write commits"""
+        from .allocation import invalidate_spot_pool, spot_changed
+
+        if previous is not None and previous == current:
+            return  # no transition: nothing for the pool to learn
+        if current is None or previous is None or previous[0] != current[0]:
+            # Created, deleted or moved to another lot
+            transaction.on_commit(invalidate_spot_pool)
+        else:
+            _, occupied, reserved = current
+            transaction.on_commit(
+                partial(spot_changed, self.pk, not (occupied or reserved))
+            )
+
 
 class Booking(models.Model):
     STATUS_CHOICES = [
@@ -107,6 +385,41 @@ class Booking(models.Model):
     completed_at = models.DateTimeField(
         null=True, blank=True, help_text="When the booking was completed"
     )
+    last_alert_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the last overtime alert was sent (shared by every process)",
+    )
+    charged_total = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        default=0,
+        help_text="Net wallet charges for this booking, maintained with each debit (null = not tracked, sum the ledger)",
+    )
+
+    class Meta:
+        # Keyset pagination walks history on (start_time, id), newest first
+        indexes = [
+            models.Index(fields=["user", "-start_time", "-id"]),
+            models.Index(fields=["-start_time", "-id"]),
+            # Overtime scheduler resyncs only recently updated active bookings
+            models.Index(fields=["status", "updated_at"]),
+        ]
+        # Booking creation relies on these instead of check-then-insert
+        constraints = [
+            models.UniqueConstraint(
+                fields=["parking_spot"],
+                condition=models.Q(status="active"),
+                name="unique_active_booking_per_spot",
+            ),
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=models.Q(status="active"),
+                name="unique_active_booking_per_user",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.parking_spot}"
@@ -150,11 +463,11 @@ class Booking(models.Model):
             overtime_duration = now - overtime_start
             overtime_minutes = max(0, int(overtime_duration.total_seconds() / 60))
 
-        # Calculate cost
-        overtime_hours = overtime_minutes / 60
+        # Overtime rate comes from the spot's tariff (see parking_app/tariffs.py)
+        from . import tariffs
 
-        # Calculate overtime cost at $1 per 30 seconds (consistent with main pricing)
-        overtime_cost = (overtime_minutes * 2) / 30
+        tariff = tariffs.tariff_for_spot(self.parking_spot)
+        overtime_cost = float(tariffs.overtime_cost(overtime_minutes, tariff))
 
         return overtime_minutes, overtime_cost
 
@@ -251,7 +564,7 @@ class Booking(models.Model):
         return False
 
     def save(self, *args, **kwargs):
-        # NOTE: total_cost is now calculated by the views using $1 per 30 seconds
+        # NOTE: total_cost is now calculated by the views from the tariff engine
         # based on actual parking time (timer_started to completion), not start_time/end_time
         # This old hourly rate calculation has been removed to prevent conflicts
 
@@ -262,6 +575,19 @@ class Booking(models.Model):
             # Recalculate total as base + overtime
             self.total_cost = base_cost + float(self.overtime_cost)
 
+        # charged_total is only changed by atomic UPDATEs in the wallet service;
+        # a full save of a stale instance must not write it back
+        if (
+            not self._state.adding
+            and kwargs.get("update_fields") is None
+            and not kwargs.get("force_insert")
+        ):
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "charged_total"
+            ]
+
         super().save(*args, **kwargs)
 
 
@@ -320,13 +646,44 @@ class WalletTransaction(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     method = models.CharField(max_length=50, blank=True, null=True)
     note = models.CharField(max_length=255, blank=True, null=True)
+    compacted_from = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Ids of the progressive charges merged into this summary row",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "-created_at"])]
+
     def __str__(self):
         reference = f" booking {self.booking_id}" if self.booking_id else ""
         return f"{self.type} {self.amount} for user {self.user_id}{reference}"
 
 
+class WalletBalanceSnapshot(models.Model):
+    """End-of-day wallet balance, written nightly by snapshot_wallet_balances"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    day = models.DateField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2)
+    as_of = models.DateTimeField(
+        help_text="End of the day (next local midnight); later ledger rows are excluded"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "day"], name="unique_wallet_snapshot_per_day"
+            )
+        ]
+        indexes = [models.Index(fields=["user", "-as_of"])]
+
+    def __str__(self):
+        return f"{self.user_id} {self.day}: {self.balance}"
+
+
 class UserReport(models.Model):
     REPORT_TYPES = (
         ("user_report", "User Report"),
@@ -348,3 +705,74 @@ class UserReport(models.Model):
     def __str__(self):
         short = (self.message or "").strip().splitlines()[0][:40]
         return f"{self.get_type_display()} · {short}"
+
+
+class NotificationOutbox(models.Model):
+    """Outbound message persisted by request handlers, delivered by the dispatcher"""
+
+    CHANNELS = (("whatsapp", "WhatsApp"),)
+    STATUSES = (
+        ("pending", "Pending"),
+        ("sending", "Sending"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+    )
+
+    channel = models.CharField(max_length=16, choices=CHANNELS, default="whatsapp")
+    to = models.CharField(max_length=64)
+    body = models.TextField()
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    booking = models.ForeignKey(
+        Booking, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    status = models.CharField(max_length=16, choices=STATUSES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(
+        null=True, blank=True, help_text="When a dispatcher took the row for sending"
+    )
+    claim_token = models.CharField(max_length=32, blank=True, null=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    provider_id = models.CharField(
+        max_length=64, blank=True, null=True, help_text="Provider message id (SID)"
+    )
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    def __str__(self):
+        return f"{self.channel} to {self.to} ({self.status})"
+
+
+class Reservation(models.Model):
+    """A future-dated hold on one spot for [start_time, end_time)"""
+
+    STATUSES = (
+        ("confirmed", "Confirmed"),
+        ("cancelled", "Cancelled"),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    parking_spot = models.ForeignKey(ParkingSpot, on_delete=models.CASCADE)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    status = models.CharField(max_length=16, choices=STATUSES, default="confirmed")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=Q(end_time__gt=F("start_time")),
+                name="reservation_ends_after_start",
+            )
+        ]
+        # Overlap checks and the startup rebuild read a spot's upcoming rows
+        indexes = [
+            models.Index(fields=["parking_spot", "status", "end_time"]),
+            models.Index(fields=["user", "-start_time"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - spot {self.parking_spot_id} {self.start_time:%Y-%m-%d %H:%M}"
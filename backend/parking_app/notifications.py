@@ -5,6 +5,8 @@ Handles overtime alerts, booking completion, and user notifications
 """
 
 import json
+import threading
+from collections import OrderedDict, deque
 import requests
 from django.conf import settings
 from django.utils import timezone
@@ -13,13 +15,152 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_COALESCING = {
+    'window_seconds': 900,  # one message per (user, booking) per window
+    'per_user_limit': 6,  # messages per user per window, across bookings
+    'max_keys': 10000,  # bound on remembered (user, booking) keys
+}
+
+# Higher priority notifications may break through a lower one's window
+PRIORITY_WARNING = 1
+PRIORITY_ALERT = 2
+
+
+class NotificationCoalescer:
+    """Suppresses repeated notifications per (user, booking) within a window.
+
+    ``_sent`` is an OrderedDict of key -> (sent_at, priority, merged) kept in
+    send order, so expired keys are pruned from the front in O(1) each and
+    the index never grows past ``max_keys``. Suppressed updates are counted
+    and folded into the next message for that key instead of being sent.
+    The index lives in process memory: long-running workers (scheduler,
+    runserver) share it across ticks; a one-shot process starts empty.
+    """
+
+    def __init__(self, window_seconds=900, per_user_limit=6, max_keys=10000):
+        self.window = float(window_seconds)
+        self.per_user_limit = per_user_limit
+        self.max_keys = max_keys
+        self._sent = OrderedDict()
+        self._user_sent = {}  # user_id -> deque of send timestamps
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        horizon = now - self.window
+        while self._sent:
+            (user_id, _), (sent_at, _, _) = next(iter(self._sent.items()))
+            if sent_at > horizon and len(self._sent) <= self.max_keys:
+                break
+            self._sent.popitem(last=False)
+            self._prune_user(user_id, horizon)
+
+    def _prune_user(self, user_id, horizon):
+        times = self._user_sent.get(user_id)
+        while times and times[0] <= horizon:
+            times.popleft()
+        if times is not None and not times:
+            del self._user_sent[user_id]
+
+    def admit(self, user_id, booking_id, priority=PRIORITY_ALERT, now=None, record=True):
+        """Decide whether to send now.
+
+        Returns ``(True, merged)`` where ``merged`` is the number of updates
+        suppressed since the last message for this key, or ``(False, 0)``.
+        With ``record=False`` an admitted send is not recorded (nor counted
+        against the user) until ``record`` is called.
+        """
+        now = (now or timezone.now()).timestamp()
+        key = (user_id, booking_id)
+        with self._lock:
+            # Read before pruning: an expired key still carries its merged count
+            entry = self._sent.get(key)
+            self._prune(now)
+            self._prune_user(user_id, now - self.window)
+            merged = entry[2] if entry else 0
+            in_window = entry is not None and now - entry[0] < self.window
+            limited = len(self._user_sent.get(user_id, ())) >= self.per_user_limit
+            if (in_window and priority <= entry[1]) or limited:
+                if key in self._sent:
+                    self._sent[key] = (entry[0], entry[1], merged + 1)
+                return False, 0
+            if record:
+                self._record(key, priority, now)
+            return True, merged
+
+    def _record(self, key, priority, now):
+        self._sent[key] = (now, priority, 0)
+        self._sent.move_to_end(key)
+        self._user_sent.setdefault(key[0], deque()).append(now)
+
+    def record(self, user_id, booking_id, priority=PRIORITY_ALERT, now=None):
+        """Record a send admitted with ``record=False`` that actually went out"""
+        now = (now or timezone.now()).timestamp()
+        with self._lock:
+            self._record((user_id, booking_id), priority, now)
+
+    def forget(self, user_id, booking_id):
+        """Drop a finished booking's key (its completion message is not coalesced)"""
+        with self._lock:
+            self._sent.pop((user_id, booking_id), None)
+
+    def forget_many(self, keys):
+        """``forget`` for many (user_id, booking_id) keys under one lock"""
+        with self._lock:
+            for key in keys:
+                self._sent.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._sent.clear()
+            self._user_sent.clear()
+
+
+def _coalescing_config():
+    config = dict(DEFAULT_COALESCING)
+    config.update(getattr(settings, 'NOTIFICATION_COALESCING', {}) or {})
+    return config
+
+
+coalescer = NotificationCoalescer(**_coalescing_config())
+
+
 class NotificationService:
     """Service for sending notifications to users"""
     
+    @staticmethod
+    def _claim_overtime_alert(booking, now):
+        """Record this alert on the booking unless one went out within the window.
+
+        The conditional UPDATE is the cross-process guard: cron runs and
+        schedulers each start with an empty coalescer, but only one of them
+        can move last_alert_at forward per window.
+        """
+        from django.db.models import Q
+        from parking_app.models import Booking
+
+        horizon = now - timedelta(seconds=coalescer.window)
+        claimed = Booking.objects.filter(
+            Q(last_alert_at__isnull=True) | Q(last_alert_at__lte=horizon),
+            pk=booking.pk,
+        ).update(last_alert_at=now)
+        if claimed:
+            booking.last_alert_at = now
+        return bool(claimed)
+
     @staticmethod
     def send_overtime_alert(booking):
-        """Send overtime alert notification"""
+        """Send overtime alert notification (coalesced per user and booking)"""
         try:
+            # Checked first so suppressed repeats cost no pricing work
+            now = timezone.now()
+            if booking.last_alert_at and now - booking.last_alert_at < timedelta(seconds=coalescer.window):
+                return False
+            allowed, merged = coalescer.admit(booking.user_id, booking.id, PRIORITY_ALERT, now=now, record=False)
+            if not allowed or not NotificationService._claim_overtime_alert(booking, now):
+                return False
+            # Only a won claim spends the user's in-memory budget
+            coalescer.record(booking.user_id, booking.id, PRIORITY_ALERT, now=now)
+
             # Calculate overtime
             overtime_minutes, overtime_cost = booking.calculate_overtime()
             
@@ -35,6 +176,7 @@ class NotificationService:
                     'overtime_minutes': overtime_minutes,
                     'overtime_cost': float(overtime_cost),
                     'total_cost': float(booking.total_cost or 0),
+                    'merged_updates': merged,
                     'timestamp': timezone.now().isoformat()
                 }
             }
@@ -51,25 +193,29 @@ class NotificationService:
             logger.error(f"Failed to send overtime alert for booking {booking.id}: {e}")
             return False
     
+    @staticmethod
+    def _completion_data(booking):
+        total_cost = float(booking.total_cost or 0) + float(booking.overtime_cost or 0)
+        return {
+            'type': 'booking_completion',
+            'title': '✅ Parking Session Complete',
+            'body': f'Your parking session at spot {booking.parking_spot.spot_number} has ended. '
+                   f'Total cost: ${total_cost:.2f}',
+            'data': {
+                'booking_id': booking.id,
+                'spot_number': booking.parking_spot.spot_number,
+                'total_cost': total_cost,
+                'overtime_cost': float(booking.overtime_cost or 0),
+                'timestamp': timezone.now().isoformat()
+            }
+        }
+
     @staticmethod
     def send_booking_completion_notification(booking):
         """Send notification when booking is completed"""
         try:
-            total_cost = float(booking.total_cost or 0) + float(booking.overtime_cost or 0)
-            
-            notification_data = {
-                'type': 'booking_completion',
-                'title': '✅ Parking Session Complete',
-                'body': f'Your parking session at spot {booking.parking_spot.spot_number} has ended. '
-                       f'Total cost: ${total_cost:.2f}',
-                'data': {
-                    'booking_id': booking.id,
-                    'spot_number': booking.parking_spot.spot_number,
-                    'total_cost': total_cost,
-                    'overtime_cost': float(booking.overtime_cost or 0),
-                    'timestamp': timezone.now().isoformat()
-                }
-            }
+            coalescer.forget(booking.user_id, booking.id)
+            notification_data = NotificationService._completion_data(booking)
             
             # Send to user's device
             NotificationService._send_push_notification(booking.user, notification_data)
@@ -90,6 +236,10 @@ class NotificationService:
             warning_time = booking.end_time - timedelta(minutes=minutes_before_expiry)
             
             if timezone.now() >= warning_time:
+                allowed, merged = coalescer.admit(booking.user_id, booking.id, PRIORITY_WARNING)
+                if not allowed:
+                    return False
+
                 notification_data = {
                     'type': 'overtime_warning',
                     'title': '⚠️ Parking Time Ending Soon',
@@ -100,6 +250,7 @@ class NotificationService:
                         'spot_number': booking.parking_spot.spot_number,
                         'minutes_remaining': minutes_before_expiry,
                         'expiry_time': booking.end_time.isoformat(),
+                        'merged_updates': merged,
                         'timestamp': timezone.now().isoformat()
                     }
                 }
@@ -116,6 +267,27 @@ class NotificationService:
             logger.error(f"Failed to send overtime warning for booking {booking.id}: {e}")
             return False
     
+    @staticmethod
+    def send_booking_completion_notifications(bookings):
+        """Send completion notifications for many bookings as one push batch.
+
+        Returns the number of notifications sent.
+        """
+        try:
+            bookings = list(bookings)
+            coalescer.forget_many((booking.user_id, booking.id) for booking in bookings)
+            notifications = [
+                (booking.user, NotificationService._completion_data(booking))
+                for booking in bookings
+            ]
+            NotificationService._send_push_notifications(notifications)
+            logger.info(f"Booking completion notifications sent for {len(notifications)} bookings")
+            return len(notifications)
+
+        except Exception as e:
+            logger.error(f"Failed to send booking completion notifications: {e}")
+            return 0
+
     @staticmethod
     def _send_push_notification(user, notification_data):
         """Send push notification to user's device"""
@@ -137,6 +309,21 @@ class NotificationService:
             logger.error(f"Failed to send push notification: {e}")
             return False
     
+    @staticmethod
+    def _send_push_notifications(notifications):
+        """Send many (user, notification_data) pushes in one provider request"""
+        try:
+            # Push providers accept batched messages (e.g. FCM send_each);
+            # for now, log the batch like single notifications
+            logger.info(f"Push notification batch: {len(notifications)} message(s)")
+            for user, notification_data in notifications:
+                logger.debug(f"Push notification for user {user.username}: {notification_data['title']}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to send push notification batch: {e}")
+            return False
+    
     @staticmethod
     def send_iot_status_update(spot_number, status, message):
         """Send IoT status update notification"""
@@ -171,18 +358,15 @@ def send_overtime_notifications():
             status='active'
         ).exclude(
             end_time__gt=timezone.now()
-        )
+        ).select_related('parking_spot__parking_lot', 'user')
         
         notifications_sent = 0
         
         for booking in expired_bookings:
-            # Send overtime alert
+            # One message per booking: the alert supersedes the expiry
+            # warning, which the coalescer would suppress anyway
             if NotificationService.send_overtime_alert(booking):
                 notifications_sent += 1
-            
-            # Send warning if within 5 minutes of expiry
-            if NotificationService.send_overtime_warning(booking, 5):
-                notifications_sent += 1
         
         logger.info(f"Sent {notifications_sent} overtime notifications")
         return notifications_sent
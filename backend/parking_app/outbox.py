@@ -0,0 +1,300 @@
+"""
+Outbound notification outbox
+Request handlers only insert a NotificationOutbox row (``enqueue_whatsapp``);
+the dispatcher claims due rows, sends them from a small thread pool through
+one reused transport (a single Twilio client and HTTP session per process) and
+records delivery status. Failures are retried with exponential backoff, so
+request latency never depends on the messaging provider.
+"""
+
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import NotificationOutbox
+
+DEFAULT_OUTBOX = {
+    "autostart": True,  # run a background dispatcher inside runserver
+    "transport": "twilio",  # or "stub" (records messages, sends nothing)
+    "workers": 4,  # concurrent provider requests
+    "batch_size": 50,  # rows claimed per dispatch pass
+    "max_attempts": 5,
+    "backoff_seconds": 15,  # doubled after every failed attempt
+    "backoff_max_seconds": 900,
+    "poll_seconds": 5,  # also woken immediately by enqueue in this process
+    "claim_timeout_seconds": 120,  # reclaim rows of a crashed dispatcher
+}
+
+
+def get_outbox_config():
+    config = dict(DEFAULT_OUTBOX)
+    config.update(getattr(settings, "NOTIFICATION_OUTBOX", {}) or {})
+    return config
+
+
+class PermanentDeliveryError(Exception):
+    """Delivery can never succeed (bad number, rejected content); do not retry"""
+
+
+def format_whatsapp_number(to_phone):
+    """Normalize a phone number to Twilio's ``whatsapp:+<digits>`` form"""
+    if to_phone.startswith("whatsapp:"):
+        return to_phone
+    to_phone = to_phone.replace(" ", "").replace("-", "")
+    # South African numbers (0713291359 -> +27713291359)
+    if to_phone.startswith("0") and len(to_phone) == 10:
+        to_phone = "27" + to_phone[1:]
+    if not to_phone.startswith("+"):
+        to_phone = f"+{to_phone}"
+    return f"whatsapp:{to_phone}"
+
+
+class TwilioTransport:
+    """Sends WhatsApp messages through one lazily created Twilio client"""
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                from twilio.rest import Client
+
+                account_sid = getattr(settings, "TWILIO_ACCOUNT_SID", None)
+                auth_token = getattr(settings, "TWILIO_AUTH_TOKEN", None)
+                if not account_sid or not auth_token:
+                    raise PermanentDeliveryError("Twilio credentials not configured")
+                # The client keeps one pooled HTTP session for every send
+                self._client = Client(account_sid, auth_token)
+            return self._client
+
+    def send(self, to, body):
+        """Send one message; returns the provider message id"""
+        from twilio.base.exceptions import TwilioRestException
+
+        from_number = getattr(settings, "TWILIO_WHATSAPP_NUMBER", "+14155238886")
+        try:
+            message = self._get_client().messages.create(
+                body=body,
+                from_=f"whatsapp:{from_number.replace('whatsapp:', '')}",
+                to=format_whatsapp_number(to),
+            )
+        except TwilioRestException as e:
+            # 4xx other than rate limiting will fail the same way again
+            if 400 <= (e.status or 0) < 500 and e.status != 429:
+                raise PermanentDeliveryError(str(e))
+            raise
+        return message.sid
+
+
+class StubTransport:
+    """Local transport for tests and development: records instead of sending"""
+
+    def __init__(self, fail_with=None):
+        self.sent = []
+        self.fail_with = fail_with
+        self._lock = threading.Lock()
+
+    def send(self, to, body):
+        if self.fail_with is not None:
+            raise self.fail_with
+        with self._lock:
+            self.sent.append((format_whatsapp_number(to), body))
+            return f"stub-{len(self.sent)}"
+
+
+TRANSPORTS = {"twilio": TwilioTransport, "stub": StubTransport}
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name=None):
+    """Process-wide transport instance (so the Twilio client is reused)"""
+    name = name or get_outbox_config()["transport"]
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = TRANSPORTS[name]()
+        return _transports[name]
+
+
+def enqueue_whatsapp(to_phone, body, user=None, booking=None):
+    """Persist a WhatsApp message for delivery; returns the outbox row"""
+    entry = NotificationOutbox.objects.create(
+        channel="whatsapp", to=to_phone, body=body, user=user, booking=booking
+    )
+    # Wake an in-process dispatcher once the row is visible to it
+    transaction.on_commit(_wake_dispatcher)
+    return entry
+
+
+def _backoff(attempts, config):
+    delay = config["backoff_seconds"] * 2 ** max(attempts - 1, 0)
+    return timedelta(seconds=min(delay, config["backoff_max_seconds"]))
+
+
+def _claim(now, config):
+    """Atomically take up to batch_size due rows for this dispatcher"""
+    stale = now - timedelta(seconds=config["claim_timeout_seconds"])
+    due = Q(status="pending", next_attempt_at__lte=now) | Q(
+        status="sending", claimed_at__lt=stale
+    )
+    ids = list(
+        NotificationOutbox.objects.filter(due)
+        .order_by("next_attempt_at", "id")
+        .values_list("id", flat=True)[: config["batch_size"]]
+    )
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    # Re-checking the due condition makes concurrent claims exclusive
+    NotificationOutbox.objects.filter(due, id__in=ids).update(
+        status="sending", claimed_at=now, claim_token=token
+    )
+    return list(NotificationOutbox.objects.filter(claim_token=token, status="sending"))
+
+
+def _deliver(transport, entry):
+    try:
+        return entry, transport.send(entry.to, entry.body), None
+    except Exception as e:
+        return entry, None, e
+
+
+def dispatch_pending(now=None, transport=None, config=None):
+    """Send one batch of due messages; returns {"sent", "retrying", "failed"}"""
+    config = config or get_outbox_config()
+    transport = transport or get_transport(config["transport"])
+    now = now or timezone.now()
+    summary = {"sent": 0, "retrying": 0, "failed": 0}
+
+    entries = _claim(now, config)
+    if not entries:
+        return summary
+
+    # Workers only talk to the provider; results are written back in one pass
+    with ThreadPoolExecutor(max_workers=config["workers"]) as pool:
+        outcomes = list(pool.map(lambda e: _deliver(transport, e), entries))
+
+    finished = timezone.now()
+    for entry, provider_id, error in outcomes:
+        entry.attempts += 1
+        entry.claimed_at = None
+        entry.claim_token = None
+        if error is None:
+            entry.status = "sent"
+            entry.sent_at = finished
+            entry.provider_id = provider_id
+            entry.last_error = None
+            summary["sent"] += 1
+        elif (
+            isinstance(error, PermanentDeliveryError)
+            or entry.attempts >= config["max_attempts"]
+        ):
+            entry.status = "failed"
+            entry.last_error = str(error)
+            summary["failed"] += 1
+            print(f"❌ [Outbox] Giving up on message {entry.id} to {entry.to}: {error}")
+        else:
+            entry.status = "pending"
+            entry.next_attempt_at = now + _backoff(entry.attempts, config)
+            entry.last_error = str(error)
+            summary["retrying"] += 1
+    NotificationOutbox.objects.bulk_update(
+        entries,
+        [
+            "status",
+            "attempts",
+            "next_attempt_at",
+            "claimed_at",
+            "claim_token",
+            "sent_at",
+            "provider_id",
+            "last_error",
+        ],
+    )
+    return summary
+
+
+def seconds_until_next_due(now=None):
+    """Seconds until the earliest pending retry (None if nothing is queued)"""
+    now = now or timezone.now()
+    next_at = (
+        NotificationOutbox.objects.filter(status="pending")
+        .order_by("next_attempt_at")
+        .values_list("next_attempt_at", flat=True)
+        .first()
+    )
+    if next_at is None:
+        return None
+    return max(0.0, (next_at - now).total_seconds())
+
+
+class OutboxDispatcher:
+    """Drains the outbox until stopped; enqueue in this process wakes it early"""
+
+    def __init__(self, config=None, transport=None):
+        self.config = config or get_outbox_config()
+        self.transport = transport
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def run_forever(self, on_summary=None):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                summary = dispatch_pending(transport=self.transport, config=self.config)
+                if any(summary.values()) and on_summary:
+                    on_summary(summary)
+                if summary["sent"] + summary["retrying"] + summary["failed"] >= (
+                    self.config["batch_size"]
+                ):
+                    continue  # a full batch: more is probably waiting
+                wait = seconds_until_next_due()
+            except Exception as e:
+                print(f"❌ Outbox dispatcher error: {e}")
+                wait = None
+            poll = self.config["poll_seconds"]
+            self._wake.clear()
+            self._wake.wait(timeout=poll if wait is None else min(wait, poll))
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def _wake_dispatcher():
+    if _dispatcher is not None:
+        _dispatcher.wake()
+
+
+def start_background_dispatcher():
+    """Run a process-wide dispatcher in a daemon thread (idempotent)"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = OutboxDispatcher()
+            threading.Thread(
+                target=_dispatcher.run_forever, name="outbox-dispatcher", daemon=True
+            ).start()
+            print("📤 Notification outbox dispatcher started")
+    return _dispatcher
+
+
+def autostart_dispatcher():
+    """Start the dispatcher with the dev server when NOTIFICATION_OUTBOX enables it"""
+    if get_outbox_config()["autostart"]:
+        start_background_dispatcher()
@@ -0,0 +1,460 @@
+"""
+Overtime and expiry processing for active bookings
+``process_overtime_bookings`` is the shared per-batch step used by the API,
+the one-shot command and the long-running ``OvertimeScheduler``. The scheduler
+keeps a min-heap of booking deadlines, sleeps until the next one is due and
+reschedules overtime ticks instead of rescanning every expired booking.
+``expire_bookings`` completes a whole backlog of expired sessions with
+vectorized overtime and set-based writes.
+"""
+
+import heapq
+import threading
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import tariffs
+from .models import Booking, ParkingLot, ParkingSpot
+from .notifications import NotificationService
+
+DEFAULT_SCHEDULER = {
+    "autostart": True,  # start a background scheduler with runserver
+    "overtime_delay_seconds": 5,  # red light delay after end_time
+    "tick_seconds": 60,  # overtime billing / occupancy re-check cadence
+    "resync_seconds": 30,  # pick up bookings created by other processes
+    "reconcile_seconds": 3600,  # recount per-lot spot counters (drift repair)
+    "batch_size": 200,
+}
+
+
+# Booking.update_overtime_billing starts overtime 5 seconds after expiry
+OVERTIME_DELAY_SECONDS = 5
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_scheduler_config():
+    config = dict(DEFAULT_SCHEDULER)
+    config.update(getattr(settings, "OVERTIME_SCHEDULER", {}) or {})
+    return config
+
+
+def _set_led(spot_number, led_state):
+    from .views import trigger_esp32_booking_led
+
+    try:
+        trigger_esp32_booking_led(spot_number, led_state)
+    except Exception as e:
+        print(f"⚠️  Failed to set LED for {spot_number}: {e}")
+
+
+def process_overtime_bookings(bookings, now=None, send_alerts=True, dry_run=False):
+    """Bill overtime for expired active bookings and complete those whose car left.
+
+    ``send_alerts`` may be a bool or a set of booking ids to alert. Returns a
+    list of result dicts with ``status`` "overtime_billing" or "completed".
+    """
+    from iot_integration.occupancy import OccupancySnapshot
+
+    from .views import check_if_car_still_parked
+
+    now = now or timezone.now()
+    results = []
+    snapshot = None  # sensor state, read once per sweep when first needed
+    for booking in bookings:
+        try:
+            if booking.status != "active" or booking.end_time > now:
+                continue
+            overtime_minutes, overtime_cost = booking.calculate_overtime()
+            if overtime_minutes <= 0:
+                continue
+            result = {
+                "booking_id": booking.id,
+                "spot_number": booking.parking_spot.spot_number,
+                "overtime_minutes": overtime_minutes,
+                "overtime_cost": float(overtime_cost),
+                "total_cost": float(booking.total_cost or 0),
+            }
+            if dry_run:
+                results.append({**result, "status": "pending_check"})
+                continue
+
+            booking.update_overtime_billing()
+            if snapshot is None:
+                snapshot = OccupancySnapshot.take()
+            if check_if_car_still_parked(booking.parking_spot, snapshot):
+                alert = (
+                    booking.id in send_alerts
+                    if isinstance(send_alerts, (set, frozenset))
+                    else send_alerts
+                )
+                # Repeats within the coalescing window are suppressed (per
+                # booking, persisted in last_alert_at)
+                if alert and NotificationService.send_overtime_alert(booking):
+                    # Turn on red light (overtime warning)
+                    _set_led(booking.parking_spot.spot_number, True)
+                results.append({**result, "status": "overtime_billing"})
+            else:
+                with transaction.atomic():
+                    booking.status = "completed"
+                    booking.completed_at = now
+                    booking.parking_spot.is_occupied = False
+                    booking.parking_spot.save(update_fields=["is_occupied"])
+                    booking.save()
+                NotificationService.send_booking_completion_notification(booking)
+                _set_led(booking.parking_spot.spot_number, False)
+                results.append({**result, "status": "completed"})
+        except Exception as e:
+            print(f"❌ Error processing overtime for booking {booking.id}: {e}")
+    return results
+
+
+def expired_active_bookings(now=None):
+    """Active bookings past their end_time, with spot and user preloaded"""
+    now = now or timezone.now()
+    return Booking.objects.filter(status="active", end_time__lte=now).select_related(
+        "parking_spot__parking_lot", "user"
+    )
+
+
+class OvertimeScheduler:
+    """Min-heap of booking deadlines processed exactly when they fall due.
+
+    Heap entries are (due_at, booking_id). A booking enters the heap at
+    end_time + overtime delay; while it stays in overtime it is rescheduled
+    every ``tick_seconds``. Stale entries (extended or finished bookings) are
+    dropped when popped.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_scheduler_config()
+        self._heap = []
+        self._scheduled = {}  # booking_id -> earliest due_at in the heap
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._next_resync = None
+        self._resync_since = None  # updated_at cursor of incremental resyncs
+        self._next_reconcile = None
+
+    # Scheduling -------------------------------------------------------------
+
+    def schedule(self, booking_id, due_at):
+        """Add or move up a deadline; safe to call from other threads"""
+        with self._lock:
+            current = self._scheduled.get(booking_id)
+            if current is not None and current <= due_at:
+                return
+            self._scheduled[booking_id] = due_at
+            heapq.heappush(self._heap, (due_at, booking_id))
+        self._wake.set()
+
+    def schedule_booking(self, booking):
+        delay = timedelta(seconds=self.config["overtime_delay_seconds"])
+        self.schedule(booking.id, booking.end_time + delay)
+
+    def resync(self, now=None):
+        """Load deadlines of active bookings not yet in the heap (one query).
+
+        The first call reads every active booking; later calls only read those
+        updated since the previous call (overlapping by ``resync_seconds`` for
+        transactions that committed late), so an idle system costs one
+        indexed query per interval instead of a scan of every session.
+        """
+        now = now or timezone.now()
+        started = timezone.now()
+        interval = timedelta(seconds=self.config["resync_seconds"])
+        delay = timedelta(seconds=self.config["overtime_delay_seconds"])
+        bookings = Booking.objects.filter(status="active")
+        if self._resync_since is not None:
+            bookings = bookings.filter(updated_at__gte=self._resync_since)
+        for booking_id, end_time in bookings.values_list("id", "end_time"):
+            if booking_id not in self._scheduled:
+                self.schedule(booking_id, end_time + delay)
+        self._resync_since = started - interval
+        self._next_resync = now + interval
+
+    def reconcile(self, now=None):
+        """Recount per-lot spot counters (reconcile_lot_counters) on a cadence"""
+        now = now or timezone.now()
+        for lot_id, stored, actual in ParkingLot.recount():
+            print(f"🔧 Lot {lot_id} counters drifted: {stored} -> {actual}")
+        self._next_reconcile = now + timedelta(seconds=self.config["reconcile_seconds"])
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, booking_id = heapq.heappop(self._heap)
+                if self._scheduled.get(booking_id) != due_at:
+                    continue  # superseded entry
+                del self._scheduled[booking_id]
+                due.append(booking_id)
+                if len(due) >= self.config["batch_size"]:
+                    break
+        return due
+
+    def seconds_until_next(self, now):
+        with self._lock:
+            next_due = self._heap[0][0] if self._heap else None
+        deadlines = [
+            d
+            for d in (next_due, self._next_resync, self._next_reconcile)
+            if d is not None
+        ]
+        if not deadlines:
+            return None
+        return max(0.0, (min(deadlines) - now).total_seconds())
+
+    # Processing -------------------------------------------------------------
+
+    def run_due(self, now=None):
+        """Process every booking whose deadline has passed; returns results"""
+        now = now or timezone.now()
+        if self._next_resync is None or now >= self._next_resync:
+            self.resync(now)
+        if self._next_reconcile is None or now >= self._next_reconcile:
+            self.reconcile(now)
+
+        results = []
+        while True:
+            due_ids = self._pop_due(now)
+            if not due_ids:
+                break
+            bookings = list(
+                Booking.objects.filter(id__in=due_ids, status="active").select_related(
+                    "parking_spot__parking_lot", "user"
+                )
+            )
+            delay = timedelta(seconds=self.config["overtime_delay_seconds"])
+            # Extended bookings go back into the heap at their new deadline
+            expired = []
+            for booking in bookings:
+                if booking.end_time + delay > now:
+                    self.schedule_booking(booking)
+                else:
+                    expired.append(booking)
+
+            batch = process_overtime_bookings(expired, now=now)
+            completed = {r["booking_id"] for r in batch if r["status"] == "completed"}
+            tick = timedelta(seconds=self.config["tick_seconds"])
+            for booking in expired:
+                # Still parked (or under a minute of overtime): check again next tick
+                if booking.id not in completed:
+                    self.schedule(booking.id, now + tick)
+            results.extend(batch)
+        return results
+
+    def run_forever(self, on_results=None):
+        """Sleep until the next deadline, process it, repeat until stop()"""
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                results = self.run_due()
+                if results and on_results:
+                    on_results(results)
+            except Exception as e:
+                print(f"❌ Overtime scheduler error: {e}")
+                # Deadlines popped by the failed run may be lost: reload them all
+                self._resync_since = None
+            wait = self.seconds_until_next(timezone.now())
+            self._wake.clear()
+            self._wake.wait(timeout=wait)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler (created on first use)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = OvertimeScheduler()
+        return _scheduler
+
+
+def start_background_scheduler():
+    """Run the process-wide scheduler in a daemon thread (idempotent)"""
+    scheduler = get_scheduler()
+    with _scheduler_lock:
+        if getattr(scheduler, "_thread", None) is None:
+            scheduler._thread = threading.Thread(
+                target=scheduler.run_forever, name="overtime-scheduler", daemon=True
+            )
+            scheduler._thread.start()
+            print("⏰ Overtime scheduler started")
+    return scheduler
+
+
+def autostart_scheduler():
+    """Start the scheduler with the dev server when OVERTIME_SCHEDULER enables it"""
+    if get_scheduler_config()["autostart"]:
+        start_background_scheduler()
+
+
+def notify_booking_scheduled(booking):
+    """Let an in-process scheduler know about a new or extended booking"""
+    if _scheduler is not None and booking.status == "active":
+        _scheduler.schedule_booking(booking)
+
+
+def _micros(values):
+    """Datetimes -> int64 epoch microseconds (NaT-like -1 for None)"""
+    return np.array(
+        [
+            (value - EPOCH) // timedelta(microseconds=1) if value else -1
+            for value in values
+        ],
+        dtype=np.int64,
+    )
+
+
+def _from_micros(value):
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def compute_final_overtime(bookings, now):
+    """Vectorized Booking.update_overtime_billing() for a set of expired bookings.
+
+    Returns (eligible, overtime_start, iot_start, minutes) arrays; rows
+    that expired less than the red-light delay ago are not eligible and keep
+    their overtime fields.
+    """
+    delay = OVERTIME_DELAY_SECONDS * 1_000_000
+    now_us = (now - EPOCH) // timedelta(microseconds=1)
+    end = _micros(b.end_time for b in bookings)
+    overtime_start = _micros(b.overtime_start_time for b in bookings)
+    iot_start = _micros(b.iot_overtime_start for b in bookings)
+    iot_end = _micros(b.iot_overtime_end for b in bookings)
+
+    eligible = now_us - end >= delay
+    overtime_start = np.where(
+        eligible & (overtime_start < 0), end + delay, overtime_start
+    )
+    iot_start = np.where(eligible & (iot_start < 0), now_us, iot_start)
+    # Car left (green light seen): overtime ends there, otherwise it runs to now
+    stop = np.where(iot_end >= 0, iot_end, now_us)
+    seconds = (stop - iot_start) / 1_000_000
+    minutes = np.where(eligible, np.trunc(seconds / 60), 0).astype(np.int64)
+    return eligible, overtime_start, iot_start, minutes
+
+
+def release_slot_leds(spot_numbers):
+    """Turn off booking LEDs for many slots with one device metadata write"""
+    from iot_integration.models import DeviceLog, IoTDevice
+
+    slots = {"Slot A": "slot1", "Slot B": "slot2"}
+    prefixes = sorted({slots[n] for n in spot_numbers if n in slots})
+    if not prefixes:
+        return
+    device = IoTDevice.objects.filter(device_type="sensor").first()
+    if not device:
+        return
+    metadata = device.metadata or {}
+    for prefix in prefixes:
+        metadata[f"{prefix}_booked"] = False
+        metadata[f"{prefix}_led_state"] = "off"
+    device.metadata = metadata
+    device.save(update_fields=["metadata"])
+    DeviceLog.objects.create(
+        device=device,
+        log_type="info",
+        message=f"Booking state updated: {', '.join(sorted(n for n in spot_numbers if n in slots))} = Available (LED: off)",
+    )
+
+
+def expire_bookings(now=None, user=None, batch_size=1000, dry_run=False, notify=True):
+    """Complete every expired active booking with set-based writes.
+
+    Per batch: one SELECT, one vectorized overtime pass, one UPDATE per
+    distinct final overtime value, one UPDATE of spots, then LED and
+    notification events emitted together. Returns the expired booking ids.
+    """
+    now = now or timezone.now()
+    delay = timedelta(seconds=OVERTIME_DELAY_SECONDS)
+    expired_ids = []
+    last_id = 0
+    while True:
+        batch = Booking.objects.filter(
+            status="active", end_time__lt=now, id__gt=last_id
+        )
+        if user is not None:
+            batch = batch.filter(user=user)
+        bookings = list(
+            batch.select_related("parking_spot__parking_lot", "user").order_by("id")[
+                :batch_size
+            ]
+        )
+        if not bookings:
+            break
+        last_id = bookings[-1].id
+
+        eligible, overtime_start, iot_start, minutes = compute_final_overtime(
+            bookings, now
+        )
+        booking_tariffs = tariffs.tariffs_for_spots(b.parking_spot for b in bookings)
+        for i, booking in enumerate(bookings):
+            if eligible[i]:
+                booking.overtime_start_time = _from_micros(overtime_start[i])
+                booking.iot_overtime_start = _from_micros(iot_start[i])
+                booking.overtime_minutes = int(minutes[i])
+                booking.overtime_cost = tariffs.overtime_cost(
+                    int(minutes[i]), booking_tariffs[i]
+                )
+                booking.is_overtime = True
+            booking.status = "completed"
+            booking.completed_at = booking.completed_at or now
+        expired_ids.extend(b.id for b in bookings)
+        if dry_run:
+            continue
+
+        # Rows sharing a final overtime value are written with one UPDATE;
+        # per-row timestamps are derived in SQL from each row's own columns
+        groups = {}
+        for i, booking in enumerate(bookings):
+            cost = booking.overtime_cost if eligible[i] else None
+            key = (bool(eligible[i]), int(minutes[i]), cost)
+            groups.setdefault(key, []).append(booking.id)
+
+        with transaction.atomic():
+            for (is_eligible, group_minutes, group_cost), ids in groups.items():
+                values = {
+                    "status": "completed",
+                    "completed_at": Coalesce(F("completed_at"), Value(now)),
+                    "updated_at": now,
+                }
+                if is_eligible:
+                    values.update(
+                        overtime_start_time=Coalesce(
+                            F("overtime_start_time"),
+                            F("end_time") + Value(delay),
+                        ),
+                        iot_overtime_start=Coalesce(
+                            F("iot_overtime_start"), Value(now)
+                        ),
+                        overtime_minutes=group_minutes,
+                        overtime_cost=group_cost,
+                        is_overtime=True,
+                    )
+                Booking.objects.filter(id__in=ids, status="active").update(**values)
+            ParkingSpot.objects.filter(
+                id__in={b.parking_spot_id for b in bookings}
+            ).update(is_occupied=False, updated_at=now)
+
+        release_slot_leds({b.parking_spot.spot_number for b in bookings})
+        if notify:
+            # One push batch per database batch
+            NotificationService.send_booking_completion_notifications(bookings)
+    return expired_ids
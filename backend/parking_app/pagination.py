@@ -0,0 +1,179 @@
+"""
+Keyset pagination for booking history (and other newest-first histories)
+Pages are keyed on (start_time, id), newest first: the cursor carries the last
+row's key and the next page is the rows strictly after it, so every page costs
+one indexed range scan regardless of how much history a user (or the whole
+system, for admins) has. Used by the REST, chatbot and admin booking lists;
+the wallet statement uses the same helpers keyed on created_at.
+
+Query params: cursor, page_size, status=<s>[,<s>...], from/to=<date or datetime>
+Clients that send neither ``cursor`` nor ``page_size`` keep the legacy
+un-paginated response (filters still apply).
+"""
+
+import base64
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+CURSOR_PARAM = "cursor"
+PAGE_SIZE_PARAM = "page_size"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class PaginationError(ValueError):
+    """Malformed cursor, page size or filter value (maps to HTTP 400)"""
+
+
+def wants_page(params):
+    """True if the client opted into paginated responses"""
+    return CURSOR_PARAM in params or PAGE_SIZE_PARAM in params
+
+
+def encode_cursor(row, field="start_time", extra=()):
+    """Cursor for a model instance or a values() row.
+
+    ``extra`` strings (e.g. a carried running balance) are stored after the key.
+    """
+    if isinstance(row, dict):
+        moment, row_id = row[field], row["id"]
+    else:
+        moment, row_id = getattr(row, field), row.id
+    raw = "|".join([moment.isoformat(), str(row_id), *extra])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(value, extra=0):
+    """Return the (moment, id) key stored in a cursor, then ``extra`` strings"""
+    try:
+        raw = base64.urlsafe_b64decode(value.encode()).decode()
+        moment, row_id, *rest = raw.split("|")
+        if len(rest) != extra:
+            raise ValueError(value)
+        moment = parse_datetime(moment)
+        row_id = int(row_id)
+    except (ValueError, UnicodeError):
+        raise PaginationError("Invalid cursor")
+    if moment is None:
+        raise PaginationError("Invalid cursor")
+    return (moment, row_id, *rest)
+
+
+def _parse_bound(value, name, end_of_day=False):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise PaginationError(f"Invalid '{name}' (use YYYY-MM-DD or ISO datetime)")
+        # A bare ``to`` date includes that whole day
+        moment = datetime.combine(day + timedelta(days=int(end_of_day)), time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def date_bounds(params):
+    """(from, to) datetimes from the optional ``from``/``to`` params; ``to`` is exclusive"""
+    since = _parse_bound(params["from"], "from") if params.get("from") else None
+    until = (
+        _parse_bound(params["to"], "to", end_of_day=True) if params.get("to") else None
+    )
+    return since, until
+
+
+def filter_bookings(queryset, params):
+    """Apply the optional status and start-time window filters"""
+    statuses = [s.strip().lower() for s in params.get("status", "").split(",")]
+    statuses = [s for s in statuses if s]
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    since, until = date_bounds(params)
+    if since:
+        queryset = queryset.filter(start_time__gte=since)
+    if until:
+        queryset = queryset.filter(start_time__lt=until)
+    return queryset
+
+
+def ordered(queryset, field="start_time"):
+    """Newest-first history order the cursor is keyed on"""
+    return queryset.order_by(f"-{field}", "-id")
+
+
+def older_than(queryset, moment, row_id, field="start_time"):
+    """Rows strictly after the (moment, id) key in newest-first order"""
+    return queryset.filter(
+        Q(**{f"{field}__lt": moment}) | Q(**{field: moment, "id__lt": row_id})
+    )
+
+
+def page_size_from(params, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    value = params.get(PAGE_SIZE_PARAM)
+    if not value:
+        return default
+    try:
+        size = int(value)
+    except ValueError:
+        raise PaginationError("Invalid page_size")
+    if size < 1:
+        raise PaginationError("Invalid page_size")
+    return min(size, maximum)
+
+
+def paginate_bookings(
+    queryset, params, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE
+):
+    """Return (rows, next_cursor) for one page of ``queryset``.
+
+    Works on model or values() querysets.
+    ``next_cursor`` is None on the last page. One extra row is fetched to
+    detect whether another page exists, so no COUNT query is needed.
+    """
+    size = page_size_from(params, default, maximum)
+    queryset = ordered(queryset)
+    if params.get(CURSOR_PARAM):
+        start_time, booking_id = decode_cursor(params[CURSOR_PARAM])
+        queryset = older_than(queryset, start_time, booking_id)
+    rows = list(queryset[: size + 1])
+    if len(rows) > size:
+        return rows[:size], encode_cursor(rows[size - 1])
+    return rows, None
+
+
+def next_page_url(request, next_cursor):
+    """Absolute URL of the following page (None on the last page)"""
+    if not next_cursor:
+        return None
+    url = request.build_absolute_uri()
+    return replace_query_param(url, CURSOR_PARAM, next_cursor)
+
+
+class BookingKeysetPagination(BasePagination):
+    """DRF adapter: opt-in keyset pages for generic booking list views"""
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if not wants_page(params):
+            return None
+        self.request = request
+        try:
+            page, self.next_cursor = paginate_bookings(queryset, params)
+        except PaginationError as e:
+            raise ParseError(str(e))
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": next_page_url(self.request, self.next_cursor),
+                "next_cursor": self.next_cursor,
+                "results": data,
+            }
+        )
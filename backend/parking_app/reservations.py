@@ -0,0 +1,307 @@
+"""
+Advance reservations
+Confirmed reservations of a spot never overlap, so each spot's upcoming
+reservations are kept in memory as parallel lists sorted by start time. A
+[start, end) query bisects for the last reservation starting before ``end``
+and only has to compare its end, so "is spot S free" is O(log n) and "which
+spots are free" is O(spots * log n). The book is built from the database on
+first use and at least every ``rebuild_seconds`` (other processes); writes go
+through ``reserve`` / ``cancel``, which check overlap in the database under a
+spot lock and update this process's book after commit. Active bookings are
+checked against the same spot lock in both directions: ``reserve`` refuses an
+interval a running booking overlaps, and ``create_active_booking`` refuses a
+spot reserved by someone else during the booking.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Booking, ParkingSpot, Reservation
+
+DEFAULT_RESERVATIONS = {
+    "rebuild_seconds": 300,
+    "max_days_ahead": 30,
+    # Open-ended (pay-per-use) bookings are assumed to need the spot this long
+    "walk_in_minutes": 60,
+}
+
+
+def get_reservation_config():
+    config = dict(DEFAULT_RESERVATIONS)
+    config.update(getattr(settings, "PARKING_RESERVATIONS", {}) or {})
+    return config
+
+
+class ReservationConflict(Exception):
+    """The spot is already reserved or booked for part of the interval"""
+
+    def __init__(self, existing=None, reason="reservation"):
+        # reason is "reservation" or "booking"; existing is the conflicting id
+        super().__init__(f"spot already taken ({reason})")
+        self.reason = reason
+        self.existing = existing
+
+
+class SpotSchedule:
+    """One spot's non-overlapping intervals, sorted by start (epoch seconds)"""
+
+    __slots__ = ("starts", "ends", "ids")
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.ids = []
+
+    def conflict(self, start, end):
+        """Id of a reservation overlapping [start, end), or None"""
+        i = bisect_left(self.starts, end) - 1
+        if i >= 0 and self.ends[i] > start:
+            return self.ids[i]
+        return None
+
+    def add(self, start, end, reservation_id):
+        i = bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.ids.insert(i, reservation_id)
+
+    def remove(self, start, reservation_id):
+        i = bisect_left(self.starts, start)
+        while i < len(self.starts) and self.starts[i] == start:
+            if self.ids[i] == reservation_id:
+                del self.starts[i], self.ends[i], self.ids[i]
+                return
+            i += 1
+
+
+class ReservationBook:
+    """Per-spot schedules of confirmed reservations"""
+
+    def __init__(self, rows=()):
+        # rows: (reservation_id, spot_id, start, end) with epoch-second bounds
+        self._schedules = {}
+        self._lock = threading.Lock()
+        for reservation_id, spot_id, start, end in sorted(
+            rows, key=lambda row: (row[1], row[2])
+        ):
+            schedule = self._schedules.setdefault(spot_id, SpotSchedule())
+            schedule.starts.append(start)
+            schedule.ends.append(end)
+            schedule.ids.append(reservation_id)
+
+    def __len__(self):
+        return sum(len(s.ids) for s in self._schedules.values())
+
+    def conflict(self, spot_id, start, end):
+        # Reads hold the lock too: an insert shifts the parallel lists
+        with self._lock:
+            schedule = self._schedules.get(spot_id)
+            return schedule.conflict(start, end) if schedule else None
+
+    def is_free(self, spot_id, start, end):
+        return self.conflict(spot_id, start, end) is None
+
+    def free_spots(self, spot_ids, start, end):
+        """The subset of ``spot_ids`` with no reservation in [start, end)"""
+        with self._lock:
+            return [
+                spot_id
+                for spot_id in spot_ids
+                if spot_id not in self._schedules
+                or self._schedules[spot_id].conflict(start, end) is None
+            ]
+
+    def add(self, spot_id, start, end, reservation_id):
+        with self._lock:
+            self._schedules.setdefault(spot_id, SpotSchedule()).add(
+                start, end, reservation_id
+            )
+
+    def remove(self, spot_id, start, reservation_id):
+        with self._lock:
+            schedule = self._schedules.get(spot_id)
+            if schedule is not None:
+                schedule.remove(start, reservation_id)
+
+
+_book = None
+_built_at = 0.0
+_lock = threading.Lock()
+
+
+def build_reservation_book(now=None):
+    """Load every confirmed reservation that has not ended yet"""
+    now = now or timezone.now()
+    rows = Reservation.objects.filter(status="confirmed", end_time__gt=now).values_list(
+        "id", "parking_spot_id", "start_time", "end_time"
+    )
+    return ReservationBook(
+        (reservation_id, spot_id, start.timestamp(), end.timestamp())
+        for reservation_id, spot_id, start, end in rows.iterator(chunk_size=5000)
+    )
+
+
+def get_reservation_book():
+    """Process-wide book, rebuilt when invalidated or stale"""
+    global _book, _built_at
+    config = get_reservation_config()
+    with _lock:
+        if _book is None or time.monotonic() - _built_at >= config["rebuild_seconds"]:
+            _book = build_reservation_book()
+            _built_at = time.monotonic()
+        return _book
+
+
+def invalidate_reservation_book():
+    global _book
+    with _lock:
+        _book = None
+
+
+def overlapping_bookings(start, end):
+    """Active bookings overlapping [start, end).
+
+    An open-ended booking (end_time == start_time) has no end to compare: it
+    holds the spot until at least now, and is taken to need it for
+    ``walk_in_minutes`` beyond max(its start, now).
+    """
+    walk_in = timedelta(minutes=get_reservation_config()["walk_in_minutes"])
+    open_ended = Q(end_time=F("start_time"))
+    if start >= timezone.now() + walk_in:
+        # Only bookings started within walk_in of the interval still reach it
+        open_ended &= Q(start_time__gt=start - walk_in)
+    return Booking.objects.filter(status="active", start_time__lt=end).filter(
+        Q(end_time__gt=start) | open_ended
+    )
+
+
+def booking_window(start_time, end_time):
+    """The [start, end) a new booking needs the spot for"""
+    start_time = start_time or timezone.now()
+    if end_time and end_time > start_time:
+        return start_time, end_time
+    walk_in = timedelta(minutes=get_reservation_config()["walk_in_minutes"])
+    return start_time, start_time + walk_in
+
+
+def lock_spot(spot_id):
+    """Lock a spot row for the current transaction; False if it does not exist.
+
+    A row write locks it on every backend (SQLite has no FOR UPDATE), so
+    reservations and bookings of one spot are serialized.
+    """
+    return bool(
+        ParkingSpot.objects.filter(id=spot_id).update(updated_at=F("updated_at"))
+    )
+
+
+def reserved_by_others(spot_id, start, end, user):
+    """Id of another user's confirmed reservation overlapping [start, end)"""
+    # Checked in the database, not the book: it may lag other processes
+    return (
+        Reservation.objects.filter(
+            parking_spot_id=spot_id,
+            status="confirmed",
+            start_time__lt=end,
+            end_time__gt=start,
+        )
+        .exclude(user=user)
+        .values_list("id", flat=True)
+        .first()
+    )
+
+
+def is_spot_free(spot_id, start, end):
+    """Is ``spot_id`` free of reservations and bookings during [start, end)?"""
+    if not get_reservation_book().is_free(spot_id, start.timestamp(), end.timestamp()):
+        return False
+    return not overlapping_bookings(start, end).filter(parking_spot_id=spot_id).exists()
+
+
+def free_spots(start, end, lot_id=None, spot_type=None):
+    """Active-lot spots (optionally of one lot / type) free during [start, end)"""
+    spots = ParkingSpot.objects.filter(parking_lot__is_active=True)
+    if lot_id is not None:
+        spots = spots.filter(parking_lot_id=lot_id)
+    if spot_type:
+        spots = spots.filter(spot_type=spot_type)
+    spots = spots.exclude(
+        id__in=overlapping_bookings(start, end).values("parking_spot_id")
+    )
+    spots = list(spots.order_by("id").values("id", "parking_lot_id", "spot_number"))
+    free = set(
+        get_reservation_book().free_spots(
+            [spot["id"] for spot in spots], start.timestamp(), end.timestamp()
+        )
+    )
+    return [spot for spot in spots if spot["id"] in free]
+
+
+def _book_add(spot_id, start, end, reservation_id):
+    if _book is not None:
+        _book.add(spot_id, start.timestamp(), end.timestamp(), reservation_id)
+
+
+def _book_remove(spot_id, start, reservation_id):
+    if _book is not None:
+        _book.remove(spot_id, start.timestamp(), reservation_id)
+
+
+def reserve(user, spot_id, start, end):
+    """Create a confirmed reservation, raising ReservationConflict on overlap
+    with another reservation or an active booking.
+
+    Raises ParkingSpot.DoesNotExist for an unknown spot.
+    """
+    with transaction.atomic():
+        if not lock_spot(spot_id):
+            raise ParkingSpot.DoesNotExist(f"Parking spot {spot_id} not found")
+        # Checked in the database, not the book: it may lag other processes
+        existing = (
+            Reservation.objects.filter(
+                parking_spot_id=spot_id,
+                status="confirmed",
+                start_time__lt=end,
+                end_time__gt=start,
+            )
+            .values_list("id", flat=True)
+            .first()
+        )
+        if existing is not None:
+            raise ReservationConflict(existing)
+        booking = (
+            overlapping_bookings(start, end)
+            .filter(parking_spot_id=spot_id)
+            .values_list("id", flat=True)
+            .first()
+        )
+        if booking is not None:
+            raise ReservationConflict(booking, reason="booking")
+        reservation = Reservation.objects.create(
+            user=user, parking_spot_id=spot_id, start_time=start, end_time=end
+        )
+        transaction.on_commit(partial(_book_add, spot_id, start, end, reservation.id))
+    return reservation
+
+
+def cancel(reservation):
+    """Cancel a confirmed reservation and free its interval"""
+    Reservation.objects.filter(id=reservation.id).update(status="cancelled")
+    reservation.status = "cancelled"
+    transaction.on_commit(
+        partial(
+            _book_remove,
+            reservation.parking_spot_id,
+            reservation.start_time,
+            reservation.id,
+        )
+    )
+    return reservation
@@ -159,3 +159,82 @@ class UserReportSerializer(serializers.ModelSerializer):
         except Exception:
             pass
         return None
+
+
+# Slim read-only booking rows for list endpoints (?fields=...). Rows come from
+# .values() so no model instances, nested users/spots or balance lookups are
+# built; each public name maps to its values() lookup and output format.
+BOOKING_LIST_FIELDS = {
+    "id": ("id", serializers.IntegerField()),
+    "status": ("status", serializers.CharField()),
+    "start_time": ("start_time", serializers.DateTimeField()),
+    "end_time": ("end_time", serializers.DateTimeField()),
+    "duration_minutes": ("duration_minutes", serializers.IntegerField()),
+    "total_cost": (
+        "total_cost",
+        serializers.DecimalField(max_digits=8, decimal_places=2),
+    ),
+    "charged_total": (
+        "charged_total",
+        serializers.DecimalField(max_digits=10, decimal_places=2),
+    ),
+    "vehicle_name": ("vehicle_name", serializers.CharField()),
+    "number_plate": ("number_plate", serializers.CharField()),
+    "is_overtime": ("is_overtime", serializers.BooleanField()),
+    "overtime_minutes": ("overtime_minutes", serializers.IntegerField()),
+    "overtime_cost": (
+        "overtime_cost",
+        serializers.DecimalField(max_digits=8, decimal_places=2),
+    ),
+    "timer_started": ("timer_started", serializers.DateTimeField()),
+    "completed_at": ("completed_at", serializers.DateTimeField()),
+    "created_at": ("created_at", serializers.DateTimeField()),
+    "parking_spot_id": ("parking_spot_id", serializers.IntegerField()),
+    "spot_number": ("parking_spot__spot_number", serializers.CharField()),
+    "parking_lot": ("parking_spot__parking_lot__name", serializers.CharField()),
+    "user_id": ("user_id", serializers.IntegerField()),
+    "username": ("user__username", serializers.CharField()),
+}
+DEFAULT_BOOKING_LIST_FIELDS = [
+    "id",
+    "spot_number",
+    "start_time",
+    "end_time",
+    "status",
+    "total_cost",
+]
+
+
+def parse_booking_fields(value):
+    """Validate a comma-separated ?fields= value (blank = default columns)"""
+    fields = [name.strip() for name in (value or "").split(",") if name.strip()]
+    if not fields:
+        return list(DEFAULT_BOOKING_LIST_FIELDS)
+    unknown = [name for name in fields if name not in BOOKING_LIST_FIELDS]
+    if unknown:
+        raise serializers.ValidationError(
+            {
+                "fields": f"Unknown field(s): {', '.join(unknown)}. "
+                f"Available: {', '.join(BOOKING_LIST_FIELDS)}"
+            }
+        )
+    return list(dict.fromkeys(fields))
+
+
+def booking_list_values(queryset, fields):
+    """values() queryset for ``fields`` (id/start_time kept for cursors)"""
+    lookups = {BOOKING_LIST_FIELDS[name][0] for name in fields}
+    lookups.update(("id", "start_time"))
+    return queryset.values(*sorted(lookups))
+
+
+def serialize_booking_rows(rows, fields):
+    """Format values() rows like BookingSerializer would, keeping only ``fields``"""
+    columns = [(name, *BOOKING_LIST_FIELDS[name]) for name in fields]
+    return [
+        {
+            name: None if row[lookup] is None else field.to_representation(row[lookup])
+            for name, lookup, field in columns
+        }
+        for row in rows
+    ]
@@ -0,0 +1,234 @@
+"""
+Tariff engine
+Prices parking time from the PARKING_TARIFFS rate tables: a unit price per lot
+and spot type, optional time-of-day bands and a separate overtime rate. Each
+tariff is an immutable daily schedule of cumulative cost, so an interval costs
+F(end) - F(start) and thousands of (start, end, spot) intervals are priced in
+one NumPy pass. Resolved tariffs are cached per (lot, spot type) until the
+PARKING_TARIFFS setting changes.
+"""
+
+from dataclasses import dataclass
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+CENTS = Decimal("0.01")
+DAY_SECONDS = 86400
+
+DEFAULT_TARIFFS = {
+    # Billing granularity shared by every tariff (progressive deductions)
+    "unit_seconds": 30,
+    "unit_price": "1.00",
+    # Overtime is priced pro rata: $1 per 15 minutes
+    "overtime_unit_seconds": 900,
+    "overtime_unit_price": "1.00",
+    "bands": [],
+    "spot_types": {},
+    "lots": {},
+}
+RATE_KEYS = ("unit_price", "overtime_unit_seconds", "overtime_unit_price", "bands")
+
+
+def _config():
+    return {**DEFAULT_TARIFFS, **getattr(settings, "PARKING_TARIFFS", {})}
+
+
+def unit_seconds():
+    """Length of one billing unit in seconds"""
+    return int(_config()["unit_seconds"])
+
+
+def _seconds_of_day(value):
+    hours, minutes = (int(part) for part in value.split(":"))
+    return hours * 3600 + minutes * 60
+
+
+@dataclass(frozen=True)
+class Tariff:
+    """Resolved rates for one (lot, spot type), with its daily cost schedule"""
+
+    unit_seconds: int
+    unit_price: Decimal
+    overtime_unit_seconds: int
+    overtime_unit_price: Decimal
+    # Breakpoints (seconds of day) and the cumulative cost reached at each
+    edges: tuple
+    cumulative: tuple
+
+    @classmethod
+    def from_rates(cls, rates, unit_seconds):
+        unit_price = Decimal(str(rates["unit_price"]))
+        base_rate = float(unit_price) / unit_seconds
+        bands = [
+            (
+                _seconds_of_day(band["start"]),
+                _seconds_of_day(band["end"]),
+                float(Decimal(str(band["unit_price"]))) / unit_seconds,
+            )
+            for band in rates.get("bands") or []
+        ]
+        edges = sorted({0, DAY_SECONDS, *(b[0] for b in bands), *(b[1] for b in bands)})
+        cumulative = [0.0]
+        for start, end in zip(edges, edges[1:]):
+            middle = (start + end) / 2
+            rate = base_rate
+            for band_start, band_end, band_rate in bands:
+                # A band whose end is before its start wraps past midnight
+                inside = (
+                    band_start <= middle < band_end
+                    if band_start < band_end
+                    else middle >= band_start or middle < band_end
+                )
+                if inside:
+                    rate = band_rate
+            cumulative.append(cumulative[-1] + rate * (end - start))
+        return cls(
+            unit_seconds=unit_seconds,
+            unit_price=unit_price,
+            overtime_unit_seconds=int(rates["overtime_unit_seconds"]),
+            overtime_unit_price=Decimal(str(rates["overtime_unit_price"])),
+            edges=tuple(edges),
+            cumulative=tuple(cumulative),
+        )
+
+    def cost_until(self, days, seconds):
+        """Cumulative cost from a reference midnight (vectorized)"""
+        day_total = self.cumulative[-1]
+        return days * day_total + np.interp(seconds, self.edges, self.cumulative)
+
+
+@lru_cache(maxsize=256)
+def get_tariff(lot_name=None, spot_type=None):
+    """Resolve the tariff for a lot and spot type (cached, Tariff is immutable).
+
+    Rates layer: defaults, then ``spot_types[type]``, then ``lots[name]``,
+    then ``lots[name]["spot_types"][type]``.
+    """
+    config = _config()
+    rates = {key: config[key] for key in RATE_KEYS}
+    layers = [config["spot_types"].get(spot_type, {})]
+    lot = config["lots"].get(lot_name, {})
+    layers += [lot, lot.get("spot_types", {}).get(spot_type, {})]
+    for layer in layers:
+        rates.update({key: layer[key] for key in RATE_KEYS if key in layer})
+    return Tariff.from_rates(rates, int(config["unit_seconds"]))
+
+
+@receiver(setting_changed)
+def _clear_tariff_cache(setting, **kwargs):
+    if setting == "PARKING_TARIFFS":
+        get_tariff.cache_clear()
+
+
+def tariff_for_spot(spot):
+    """Tariff for a ParkingSpot (or the default tariff for None)"""
+    if spot is None:
+        return get_tariff()
+    return get_tariff(spot.parking_lot.name, spot.spot_type)
+
+
+def tariffs_for_spots(spots):
+    """One tariff per spot, resolving each distinct (lot, spot type) once"""
+    resolved = {}
+    tariffs = []
+    for spot in spots:
+        key = (spot.parking_lot.name, spot.spot_type) if spot else (None, None)
+        if key not in resolved:
+            resolved[key] = get_tariff(*key)
+        tariffs.append(resolved[key])
+    return tariffs
+
+
+def _local_seconds(values):
+    """Local wall-clock seconds since the epoch for aware datetimes"""
+    stamps = np.fromiter(
+        (value.timestamp() for value in values), dtype=np.float64, count=len(values)
+    )
+    zone = timezone.get_current_timezone()
+    if timezone.get_current_timezone_name() in ("UTC", "Etc/UTC"):
+        return stamps
+    offsets = np.fromiter(
+        (value.astimezone(zone).utcoffset().total_seconds() for value in values),
+        dtype=np.float64,
+        count=len(values),
+    )
+    return stamps + offsets
+
+
+def _split_days(local, reference):
+    """(whole days since reference midnight, seconds into that day)"""
+    elapsed = local - reference
+    days = np.floor(elapsed / DAY_SECONDS)
+    return days, elapsed - days * DAY_SECONDS
+
+
+def quote_cents(starts, ends, tariffs=None):
+    """Vectorized cost in cents of each [start, end) interval.
+
+    ``starts`` and ``ends`` are sequences of aware datetimes. ``tariffs`` is
+    None (default tariff), one Tariff for every interval, or a sequence with
+    one Tariff per interval. Returns an int64 array; empty intervals cost 0.
+    """
+    count = len(starts)
+    if not count:
+        return np.zeros(0, dtype=np.int64)
+    local_starts = _local_seconds(starts)
+    local_ends = np.maximum(_local_seconds(ends), local_starts)
+    # Days are counted from the earliest start's midnight to keep precision
+    reference = np.floor(local_starts.min() / DAY_SECONDS) * DAY_SECONDS
+    start_days, start_seconds = _split_days(local_starts, reference)
+    end_days, end_seconds = _split_days(local_ends, reference)
+
+    if tariffs is None or isinstance(tariffs, Tariff):
+        groups = {tariffs or get_tariff(): slice(None)}
+    else:
+        indices = {}
+        for i, tariff in enumerate(tariffs):
+            indices.setdefault(tariff, []).append(i)
+        groups = {tariff: np.array(idx) for tariff, idx in indices.items()}
+
+    amounts = np.zeros(count, dtype=np.float64)
+    for tariff, idx in groups.items():
+        amounts[idx] = tariff.cost_until(
+            end_days[idx], end_seconds[idx]
+        ) - tariff.cost_until(start_days[idx], start_seconds[idx])
+    # Round half up to cents; the epsilon absorbs float noise at exact halves
+    return np.floor(amounts * 100 + 0.5 + 1e-7).astype(np.int64)
+
+
+def quote(starts, ends, tariffs=None):
+    """Like quote_cents, returning a list of Decimal amounts"""
+    return [
+        (Decimal(int(cents)) / 100).quantize(CENTS)
+        for cents in quote_cents(starts, ends, tariffs)
+    ]
+
+
+def session_cost(start, end, spot=None):
+    """Cost of one parked interval on ``spot``'s tariff"""
+    return quote([start], [end], tariff_for_spot(spot))[0]
+
+
+def overtime_cost(minutes, tariff=None):
+    """Overtime charge for whole minutes beyond the booking (pro rata)"""
+    tariff = tariff or get_tariff()
+    amount = (
+        Decimal(int(minutes) * 60)
+        * tariff.overtime_unit_price
+        / tariff.overtime_unit_seconds
+    )
+    return amount.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def minimum_balance(tariff=None, at=None):
+    """Price of the first billing unit from ``at``: what starting a session needs"""
+    tariff = tariff or get_tariff()
+    at = at or timezone.now()
+    return quote([at], [at + timedelta(seconds=tariff.unit_seconds)], tariff)[0]
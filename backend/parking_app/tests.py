@@ -1,3 +1,2152 @@
-from django.test import TestCase
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError, close_old_connections, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from iot_integration import calibration, occupancy
+from iot_integration.occupancy import OccupancySnapshot, SlotDebouncer
+
+from . import allocation, billing, geo, outbox, overtime, reservations, tariffs, wallet
+from .bookings import (
+    BookingConflict,
+    create_active_booking,
+    find_duplicate_active_bookings,
+)
+from .models import (
+    Booking,
+    NotificationOutbox,
+    ParkingLot,
+    ParkingSpot,
+    UserProfile,
+    WalletBalanceSnapshot,
+    WalletTransaction,
+)
+from .notifications import (
+    PRIORITY_ALERT,
+    PRIORITY_WARNING,
+    NotificationCoalescer,
+    NotificationService,
+    coalescer,
+)
+from .serializers import (
+    BOOKING_LIST_FIELDS,
+    DEFAULT_BOOKING_LIST_FIELDS,
+    BookingSerializer,
+    booking_list_values,
+    serialize_booking_rows,
+)
+
+
+class WalletConcurrencyTest(TransactionTestCase):
+    """Parallel debits and credits must not lose balance updates"""
+
+    THREADS = 8
+    OPERATIONS = 25
+
+    def setUp(self):
+        self.user = User.objects.create(username="wallet_stress")
+        UserProfile.objects.create(user=self.user, balance=Decimal("100.00"))
+
+    def _worker(self, index, errors, barrier):
+        try:
+            barrier.wait()
+            for n in range(self.OPERATIONS):
+                while True:
+                    try:
+                        if (index + n) % 2:
+                            wallet.credit(self.user, Decimal("1.25"))
+                        else:
+                            wallet.debit(self.user, Decimal("0.75"))
+                        break
+                    except OperationalError as e:
+                        # SQLite serializes writers; retry a busy lock, not a lost update
+                        if "locked" not in str(e):
+                            raise
+        except Exception as e:
+            errors.append(e)
+        finally:
+            close_old_connections()
+            connection.close()
+
+    def test_parallel_debits_and_credits(self):
+        errors = []
+        barrier = threading.Barrier(self.THREADS)
+        threads = [
+            threading.Thread(target=self._worker, args=(i, errors, barrier))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        credits = WalletTransaction.objects.filter(user=self.user, type="topup")
+        debits = WalletTransaction.objects.filter(user=self.user, type="parking_charge")
+        total_ops = self.THREADS * self.OPERATIONS
+        self.assertEqual(credits.count() + debits.count(), total_ops)
+
+        expected = (
+            Decimal("100.00")
+            + Decimal("1.25") * credits.count()
+            - Decimal("0.75") * debits.count()
+        )
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.balance, expected)
+
+    def test_returns_new_balance(self):
+        balance, entry = wallet.debit(self.user, Decimal("130.00"), note="Overdraft")
+        self.assertEqual(balance, Decimal("-30.00"))
+        self.assertEqual(entry.amount, Decimal("130.00"))
+        balance, entry = wallet.credit(self.user, "30", method="Card")
+        self.assertEqual(balance, Decimal("0.00"))
+        self.assertEqual(entry.type, "topup")
+
+
+class NotificationOutboxTest(TestCase):
+    """Queued messages are delivered once, retried with backoff, then given up"""
+
+    CONFIG = {
+        **outbox.DEFAULT_OUTBOX,
+        "workers": 2,
+        "max_attempts": 3,
+        "backoff_seconds": 10,
+        "backoff_max_seconds": 15,
+    }
+
+    def test_delivers_queued_messages_once(self):
+        for n in range(3):
+            outbox.enqueue_whatsapp("0713291359", f"message {n}")
+        transport = outbox.StubTransport()
+
+        summary = outbox.dispatch_pending(transport=transport, config=self.CONFIG)
+
+        self.assertEqual(summary, {"sent": 3, "retrying": 0, "failed": 0})
+        self.assertEqual(len(transport.sent), 3)
+        self.assertEqual(transport.sent[0][0], "whatsapp:+27713291359")
+        entry = NotificationOutbox.objects.first()
+        self.assertEqual(entry.status, "sent")
+        self.assertEqual(entry.attempts, 1)
+        self.assertTrue(entry.provider_id.startswith("stub-"))
+        # Nothing is due any more
+        outbox.dispatch_pending(transport=transport, config=self.CONFIG)
+        self.assertEqual(len(transport.sent), 3)
+
+    def test_retries_with_backoff_then_fails(self):
+        entry = outbox.enqueue_whatsapp("+27713291359", "hello")
+        transport = outbox.StubTransport(fail_with=ConnectionError("timeout"))
+
+        delays = []
+        now = timezone.now()
+        for _ in range(self.CONFIG["max_attempts"]):
+            outbox.dispatch_pending(now=now, transport=transport, config=self.CONFIG)
+            entry.refresh_from_db()
+            if entry.status == "pending":
+                delays.append(round((entry.next_attempt_at - now).total_seconds()))
+                # Not due again until the backoff has elapsed
+                summary = outbox.dispatch_pending(
+                    now=now, transport=transport, config=self.CONFIG
+                )
+                self.assertEqual(summary["retrying"], 0)
+                now = entry.next_attempt_at
+
+        self.assertEqual(delays, [10, 15])
+        self.assertEqual(entry.status, "failed")
+        self.assertEqual(entry.attempts, 3)
+        self.assertEqual(entry.last_error, "timeout")
+
+    def test_permanent_errors_are_not_retried(self):
+        entry = outbox.enqueue_whatsapp("+27713291359", "hello")
+        transport = outbox.StubTransport(
+            fail_with=outbox.PermanentDeliveryError("invalid number")
+        )
+
+        summary = outbox.dispatch_pending(transport=transport, config=self.CONFIG)
+
+        self.assertEqual(summary["failed"], 1)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts), ("failed", 1))
+
+    def test_reclaims_stale_sending_rows(self):
+        entry = outbox.enqueue_whatsapp("+27713291359", "hello")
+        stale = timezone.now() - timedelta(hours=1)
+        NotificationOutbox.objects.filter(id=entry.id).update(
+            status="sending", claimed_at=stale, claim_token="crashed"
+        )
+        transport = outbox.StubTransport()
+
+        outbox.dispatch_pending(transport=transport, config=self.CONFIG)
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, "sent")
+
+
+class NotificationCoalescerTest(TestCase):
+    """Repeated overtime notifications collapse into one per window"""
+
+    def setUp(self):
+        self.coalescer = NotificationCoalescer(window_seconds=900, per_user_limit=3)
+        self.now = timezone.now()
+
+    def at(self, seconds):
+        return self.now + timedelta(seconds=seconds)
+
+    def test_suppresses_repeats_and_merges_them_into_the_next_message(self):
+        admit = self.coalescer.admit
+        self.assertEqual(admit(1, 10, now=self.at(0)), (True, 0))
+        # Every minute for the rest of the window: suppressed
+        for minute in range(1, 15):
+            self.assertEqual(admit(1, 10, now=self.at(60 * minute)), (False, 0))
+        self.assertEqual(admit(1, 10, now=self.at(900)), (True, 14))
+
+    def test_warning_does_not_repeat_an_alert_but_an_alert_escalates(self):
+        admit = self.coalescer.admit
+        self.assertTrue(admit(1, 10, PRIORITY_WARNING, now=self.at(0))[0])
+        self.assertTrue(admit(1, 10, PRIORITY_ALERT, now=self.at(1))[0])
+        self.assertFalse(admit(1, 10, PRIORITY_WARNING, now=self.at(2))[0])
+
+    def test_per_user_limit_across_bookings(self):
+        admit = self.coalescer.admit
+        sent = [admit(1, booking, now=self.at(booking))[0] for booking in range(5)]
+        self.assertEqual(sent, [True, True, True, False, False])
+        self.assertTrue(admit(2, 99, now=self.at(5))[0])
+        self.assertTrue(admit(1, 7, now=self.at(901))[0])
+
+    def test_index_is_bounded(self):
+        coalescer = NotificationCoalescer(per_user_limit=10**6, max_keys=100)
+        for booking in range(1000):
+            coalescer.admit(1, booking, now=self.at(booking))
+        self.assertLessEqual(len(coalescer._sent), 101)
+
+
+class SlotDebouncerTest(SimpleTestCase):
+    """A spot flips on a consistent streak, or on a majority held long enough"""
+
+    def feed(self, debouncer, committed, readings):
+        """Feed (value, ms) readings; returns the committed state after each"""
+        states = []
+        for value, now_ms in readings:
+            committed = debouncer.update(committed, value, now_ms)
+            states.append(committed)
+        return states
+
+    def test_streak_commits_transition(self):
+        debouncer = SlotDebouncer(window=3, min_consistent=2, stable_ms=4000)
+        states = self.feed(debouncer, False, [(True, 0), (True, 100)])
+        self.assertEqual(states, [False, True])
+
+    def test_single_glitch_is_ignored(self):
+        debouncer = SlotDebouncer(window=3, min_consistent=2, stable_ms=4000)
+        states = self.feed(
+            debouncer, False, [(True, 0), (False, 100), (True, 200), (False, 300)]
+        )
+        self.assertEqual(states, [False, False, False, False])
+        self.assertIsNone(debouncer.candidate)
+        self.assertEqual(debouncer.streak, 0)
+
+    def test_majority_must_also_be_stable(self):
+        debouncer = SlotDebouncer(window=3, min_consistent=5, stable_ms=1000)
+        states = self.feed(debouncer, False, [(True, 0), (True, 500), (True, 1200)])
+        # Majority from the second reading, but only held long enough at the third
+        self.assertEqual(states, [False, False, True])
+
+    def test_stable_candidate_needs_majority(self):
+        debouncer = SlotDebouncer(window=5, min_consistent=10, stable_ms=1000)
+        self.feed(debouncer, False, [(False, -300), (False, -200), (False, -100)])
+        states = self.feed(debouncer, False, [(True, 0), (True, 2000), (True, 2100)])
+        # Held for 2 s after the second reading, but only 2 of 5 votes
+        self.assertEqual(states, [False, False, True])
+
+    @override_settings(
+        OCCUPANCY_DEBOUNCE={
+            "default": {"window": 3, "min_consistent": 2, "stable_ms": 4000},
+            "spots": {"Slot A": {"min_consistent": 1}},
+        }
+    )
+    def test_per_spot_override_and_reset(self):
+        class Spot:
+            def __init__(self, id, spot_number):
+                self.id = id
+                self.spot_number = spot_number
+                self.is_occupied = False
+
+        occupancy.reset_debounce_state()
+        fast, slow = Spot(1, "Slot A"), Spot(2, "Slot B")
+        self.assertTrue(occupancy.debounce_occupancy(fast, True, now_ms=0))
+        self.assertFalse(occupancy.debounce_occupancy(slow, True, now_ms=0))
+        occupancy.reset_debounce_state(slow.id)
+        # The buffered reading was dropped: a streak has to start over
+        self.assertFalse(occupancy.debounce_occupancy(slow, True, now_ms=100))
+        self.assertTrue(occupancy.debounce_occupancy(slow, True, now_ms=200))
+        self.assertFalse(occupancy.debounce_occupancy(slow, None))
+        occupancy.reset_debounce_state()
+
+
+class SensorCalibrationTest(TestCase):
+    """Calibration fits against raw firmware flags, never its own output"""
+
+    CONFIG = {**calibration.DEFAULT_CALIBRATION, "min_samples": 10}
+
+    def setUp(self):
+        from iot_integration.models import IoTDevice
+
+        lot = ParkingLot.objects.create(
+            name="Calibrated", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        self.spot = ParkingSpot.objects.create(parking_lot=lot, spot_number="K1")
+        self.device = IoTDevice.objects.create(
+            device_id="esp-cal",
+            device_type="sensor",
+            name="cal",
+            parking_spot=self.spot,
+        )
+
+    def test_fit_two_modes(self):
+        distances = [200.0] * 30 + [50.0] * 20
+        flags = [False] * 30 + [True] * 20
+        fitted = calibration.fit_spot(distances, flags, self.CONFIG)
+        self.assertEqual(fitted["threshold_cm"], 125.0)
+        self.assertEqual(fitted["agreement_rate"], 1.0)
+
+    def test_single_mode_needs_firmware_to_see_empty_floor(self):
+        distances = [200.0 + n % 3 for n in range(30)]
+        self.assertIsNone(calibration.fit_spot(distances, [True] * 30, self.CONFIG))
+        fitted = calibration.fit_spot(distances, [False] * 30, self.CONFIG)
+        self.assertIsNone(fitted["vehicle_distance_cm"])
+
+    def test_ingest_keeps_raw_flag_for_recalibration(self):
+        from iot_integration.models import SensorData, SpotCalibration
+
+        SpotCalibration.objects.create(parking_spot=self.spot, threshold_cm=100.0)
+        response = self.client.post(
+            "/api/iot/sensor/data/",
+            {"device_id": "esp-cal", "is_occupied": False, "distance_cm": 40},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        reading = SensorData.objects.get()
+        self.assertTrue(reading.is_occupied)  # derived from the calibration
+        self.assertFalse(reading.firmware_occupied)
+        distances, flags = calibration.load_distance_history([self.spot.id])[
+            self.spot.id
+        ]
+        self.assertEqual((list(distances), list(flags)), ([40.0], [False]))
+
+    def test_history_is_capped_per_spot_in_the_query(self):
+        from iot_integration.models import SensorData
+
+        now = timezone.now()
+        SensorData.objects.bulk_create(
+            SensorData(
+                device=self.device,
+                is_occupied=True,
+                firmware_occupied=n % 2 == 0,
+                distance_cm=float(n),
+                timestamp=now - timedelta(minutes=n),
+            )
+            for n in range(20)
+        )
+        config = {**self.CONFIG, "max_samples": 5}
+        with self.assertNumQueries(1):
+            history = calibration.load_distance_history(config=config)
+        distances, flags = history[self.spot.id]
+        self.assertEqual(sorted(distances), [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(sum(flags), 3)
+
+
+class SensorAnomalyTest(TestCase):
+    """Each anomaly opens one logged episode and clears past its hysteresis"""
+
+    def setUp(self):
+        from iot_integration.anomaly import SensorAnomalyDetector
+        from iot_integration.models import IoTDevice
+
+        self.device = IoTDevice.objects.create(
+            device_id="esp-anomaly", device_type="sensor", name="anomaly"
+        )
+        self.detector = SensorAnomalyDetector()
+        self.base = timezone.now() - timedelta(days=1)
+        self.count = 0
+
+    def feed(self, readings, **fields):
+        """Observe ``readings`` healthy readings (10 min apart) with overrides.
+
+        Values in ``fields`` may be callables of the reading number. Returns
+        the anomalies started by each reading.
+        """
+        from iot_integration.models import SensorData
+
+        started = []
+        for _ in range(readings):
+            n = self.count
+            values = {
+                "is_occupied": False,
+                "distance_cm": 200.0 + n % 5,
+                "battery_level": 80.0,
+                "signal_strength": -60.0,
+            }
+            values.update(
+                {key: v(n) if callable(v) else v for key, v in fields.items()}
+            )
+            reading = SensorData(
+                device=self.device,
+                timestamp=self.base + timedelta(minutes=10 * n),
+                **values,
+            )
+            started.append(self.detector.observe(self.device, reading))
+            self.count += 1
+        return started
+
+    def logs(self):
+        from iot_integration.models import DeviceLog
+
+        return list(
+            DeviceLog.objects.filter(device=self.device, log_type="warning")
+            .order_by("id")
+            .values_list("message", flat=True)
+        )
+
+    def active(self):
+        return self.detector.active_anomalies().get(self.device.id, [])
+
+    def test_healthy_stream_raises_nothing(self):
+        self.assertFalse(any(self.feed(60)))
+        self.assertEqual(self.logs(), [])
+
+    def test_each_anomaly_opens_one_episode(self):
+        streams = {
+            "stuck": {"distance_cm": 150.0},
+            "battery": {"battery_level": lambda n: 80.0 - n * 5 / 6},  # -5 %/h
+            "weak_signal": {"signal_strength": -95.0},
+        }
+        for name, fields in streams.items():
+            with self.subTest(name):
+                self.detector.reset()
+                self.count = 0
+                before = len(self.logs())
+                started = self.feed(150, **fields)
+                opened = [i for i, found in enumerate(started) if found]
+                self.assertEqual(len(opened), 1)
+                self.assertEqual(list(started[opened[0]]), [name])
+                self.assertEqual(self.active(), [name])
+                self.assertEqual(len(self.logs()), before + 1)
+        self.assertTrue(self.logs()[0].startswith("Sensor stuck"))
+        self.assertTrue(self.logs()[1].startswith("Battery dying"))
+        self.assertTrue(self.logs()[2].startswith("Weak signal"))
+
+    def test_stuck_needs_enough_identical_readings(self):
+        started = self.feed(130, distance_cm=150.0)
+        self.assertEqual(
+            [i for i, found in enumerate(started) if found],
+            [119],  # the 120th identical reading
+        )
+
+    def test_flapping_clears_past_hysteresis_and_fires_again(self):
+        flapping = {"is_occupied": lambda n: n % 2 == 0}
+        started = self.feed(40, **flapping)
+        self.assertEqual(sum("flapping" in found for found in started), 1)
+        self.assertEqual(self.active(), ["flapping"])
+
+        # Below the 0.3 trigger but above the 0.15 recovery level: still open
+        self.feed(15)
+        rate = self.detector._stats[self.device.id].transition_rate
+        self.assertLess(rate, 0.3)
+        self.assertGreater(rate, 0.15)
+        self.assertEqual(self.active(), ["flapping"])
+
+        self.feed(10)
+        self.assertEqual(self.active(), [])
+        started = self.feed(40, **flapping)
+        self.assertEqual(sum("flapping" in found for found in started), 1)
+        logs = self.logs()
+        self.assertEqual(len(logs), 2)
+        self.assertTrue(all(log.startswith("Sensor flapping") for log in logs))
+
+
+class SensorBackfillReplayTest(TestCase):
+    """Replayed departures complete bookings, charge them and free the spot"""
+
+    def setUp(self):
+        from iot_integration.models import IoTDevice
+
+        self.lot = ParkingLot.objects.create(
+            name="Replay", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        self.spot = ParkingSpot.objects.create(
+            parking_lot=self.lot, spot_number="K1", is_occupied=True
+        )
+        self.device = IoTDevice.objects.create(
+            device_id="esp-replay",
+            device_type="sensor",
+            name="replay",
+            parking_spot=self.spot,
+        )
+        self.user = User.objects.create(username="replayed")
+        UserProfile.objects.create(user=self.user, balance=Decimal("100.00"))
+        self.t0 = timezone.now().replace(microsecond=0) - timedelta(minutes=10)
+        self.booking = Booking.objects.create(
+            user=self.user,
+            parking_spot=self.spot,
+            status="active",
+            start_time=self.t0,
+            end_time=self.t0 + timedelta(hours=12),
+            duration_minutes=0,
+            timer_started=self.t0,
+            last_billing_at=self.t0,
+        )
+
+    def readings(self, *pairs):
+        return [
+            {
+                "timestamp": (self.t0 + timedelta(seconds=seconds)).isoformat(),
+                "is_occupied": occupied,
+                "distance_cm": 40.0 if occupied else 200.0,
+            }
+            for seconds, occupied in pairs
+        ]
+
+    def test_departure_completes_charges_and_releases(self):
+        from iot_integration.backfill import ingest_backfill
+
+        readings = self.readings(
+            (10, True), (20, True), (60, False), (70, False), (80, False)
+        )
+        result = ingest_backfill(self.device, readings)
+        self.assertEqual(result["inserted"], 5)
+
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.status, "completed")
+        # Debounced: the second free reading commits the departure
+        self.assertEqual(self.booking.completed_at, self.t0 + timedelta(seconds=70))
+        self.assertEqual(self.booking.total_cost, Decimal("2.33"))
+        self.assertEqual(wallet.booking_charged_total(self.booking), Decimal("2.33"))
+        self.assertEqual(
+            UserProfile.objects.get(user=self.user).balance, Decimal("97.67")
+        )
+        self.spot.refresh_from_db()
+        self.assertFalse(self.spot.is_occupied)
+        self.lot.refresh_from_db()
+        self.assertEqual(self.lot.occupied_count, 0)
+
+        # A re-upload is recognised and changes nothing
+        again = ingest_backfill(self.device, readings)
+        self.assertEqual((again["inserted"], again["duplicates"]), (0, 5))
+        self.assertEqual(again["bookings"], [])
+        self.assertEqual(
+            UserProfile.objects.get(user=self.user).balance, Decimal("97.67")
+        )
+
+    def test_distinct_readings_sharing_a_timestamp_are_kept(self):
+        from iot_integration.backfill import ingest_backfill
+
+        ingest_backfill(self.device, self.readings((10, True)))
+        result = ingest_backfill(self.device, self.readings((10, True), (10, False)))
+        self.assertEqual((result["inserted"], result["duplicates"]), (1, 1))
+
+    def test_car_back_by_window_end_keeps_spot_occupied(self):
+        from iot_integration.backfill import ingest_backfill
+
+        ingest_backfill(
+            self.device,
+            self.readings(
+                (10, True), (60, False), (70, False), (100, True), (110, True)
+            ),
+        )
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.status, "completed")
+        self.spot.refresh_from_db()
+        self.assertTrue(self.spot.is_occupied)
+
+
+class DeviceProvisioningTest(TestCase):
+    """Bulk registration validates the batch and parses flags explicitly"""
+
+    URL = "/api/iot/devices/register/bulk/"
+
+    def setUp(self):
+        self.lot = ParkingLot.objects.create(
+            name="Provisioned", address="-", total_spots=2, hourly_rate=Decimal("1.00")
+        )
+
+    def devices(self, *ids):
+        return [
+            {
+                "device_id": device_id,
+                "lot_name": "Provisioned",
+                "spot_number": device_id,
+            }
+            for device_id in ids
+        ]
+
+    def test_string_false_is_not_a_dry_run(self):
+        from iot_integration.models import IoTDevice
+
+        response = self.client.post(
+            self.URL,
+            {"devices": self.devices("P1", "P2"), "dry_run": "false"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.json()["dry_run"])
+        self.assertEqual(IoTDevice.objects.count(), 2)
+        self.assertEqual(ParkingSpot.objects.filter(parking_lot=self.lot).count(), 2)
+
+    def test_dry_run_and_create_spots_flags(self):
+        from iot_integration.models import IoTDevice
+
+        response = self.client.post(
+            self.URL + "?dry_run=yes",
+            {"devices": self.devices("P1")},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["spots_created"], 1)
+        self.assertFalse(IoTDevice.objects.exists())
+
+        response = self.client.post(
+            self.URL,
+            {"devices": self.devices("P1"), "create_spots": "False"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Parking spot not found", str(response.json()["rows"]))
+
+    def test_whole_batch_errors_are_reported(self):
+        response = self.client.post(
+            self.URL,
+            {"devices": self.devices("P1", "P1") + [{"device_type": "toaster"}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        rows = response.json()["rows"]
+        self.assertEqual([row["row"] for row in rows], [1, 2])
+
+
+class OccupancySnapshotTest(TestCase):
+    """One snapshot answers occupancy for every spot in constant queries"""
+
+    def setUp(self):
+        from iot_integration.models import IoTDevice, SensorData
+
+        lot = ParkingLot.objects.create(
+            name="Lot", address="-", total_spots=3, hourly_rate=Decimal("1.00")
+        )
+        self.spots = {
+            number: ParkingSpot.objects.create(
+                parking_lot=lot, spot_number=number, is_occupied=occupied
+            )
+            for number, occupied in (("Slot A", False), ("Slot B", True), ("C1", True))
+        }
+        devices = [
+            IoTDevice.objects.create(device_id=f"esp{n}", device_type="sensor", name=n)
+            for n in range(2)
+        ]
+        now = timezone.now()
+        for device in devices:
+            SensorData.objects.create(
+                device=device,
+                is_occupied=False,
+                timestamp=now - timedelta(minutes=5),
+            )
+        # Only the first device is online; its dual sensor reports per slot
+        SensorData.objects.create(
+            device=devices[0],
+            is_occupied=False,
+            slot1_occupied=True,
+            slot2_occupied=False,
+            timestamp=now,
+        )
+
+    def test_constant_queries_and_home_page_rules(self):
+        with self.assertNumQueries(3):
+            snapshot = OccupancySnapshot.take()
+        with self.assertNumQueries(0):
+            occupied = {n: snapshot.is_occupied(s) for n, s in self.spots.items()}
+        # Slot A: fresh sensor; Slot B: its device is stale; C1: no device
+        self.assertEqual(occupied, {"Slot A": True, "Slot B": True, "C1": True})
+
+    def test_offline_sensors_use_spot_status(self):
+        from iot_integration.models import SensorData
+
+        SensorData.objects.update(timestamp=timezone.now() - timedelta(hours=1))
+        with self.assertNumQueries(1):
+            snapshot = OccupancySnapshot.take()
+        self.assertFalse(snapshot.is_occupied(self.spots["Slot A"]))
+
+
+class WalletStatementTest(TestCase):
+    """Running balances are consistent across pages, ranges and exports"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="statement")
+        UserProfile.objects.create(user=self.user, balance=Decimal("50.00"))
+        self.start = timezone.now() - timedelta(days=10)
+        self.expected = []  # (id, balance_after), oldest first
+        balance = Decimal("50.00")
+        for day in range(10):
+            if day % 3:
+                balance, entry = wallet.debit(self.user, Decimal("7.50"))
+            else:
+                balance, entry = wallet.credit(self.user, Decimal("20.00"))
+            WalletTransaction.objects.filter(id=entry.id).update(
+                created_at=self.start + timedelta(days=day)
+            )
+            self.expected.append((entry.id, balance))
+
+    def test_pages_carry_the_running_balance(self):
+        seen, params = [], {"page_size": "3"}
+        while True:
+            rows, cursor, _ = wallet.statement_page(self.user.id, params)
+            seen += [(row["id"], row["balance_after"]) for row in rows]
+            if not cursor:
+                break
+            params = {"page_size": "3", "cursor": cursor}
+        self.assertEqual(seen, self.expected[::-1])
+
+    def test_date_range_anchors_on_the_balance_at_its_end(self):
+        until = (self.start + timedelta(days=6)).isoformat()
+        since = (self.start + timedelta(days=2)).isoformat()
+        rows, cursor, closing = wallet.statement_page(
+            self.user.id, {"from": since, "to": until}
+        )
+        self.assertIsNone(cursor)
+        self.assertEqual(closing, self.expected[5][1])
+        self.assertEqual(
+            [(row["id"], row["balance_after"]) for row in rows],
+            self.expected[2:6][::-1],
+        )
+
+    def test_export_streams_the_same_balances(self):
+        self.client.force_login(self.user)
+        response = self.client.get("/api/wallet/statement/export/?output=ndjson")
+        self.assertEqual(response.status_code, 200)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        balances = [json.loads(line)["balance_after"] for line in lines]
+        self.assertEqual(balances, [float(b) for _, b in self.expected[::-1]])
+
+
+class WalletBalanceSnapshotTest(TestCase):
+    """Historical balances agree with and without end-of-day snapshots"""
+
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.users = []
+        for name, opening in (("saver", "40.00"), ("debtor", "5.00")):
+            user = User.objects.create(username=name)
+            UserProfile.objects.create(user=user, balance=Decimal(opening))
+            self.users.append(user)
+        UserProfile.objects.update(
+            created_at=wallet.end_of_day(self.today - timedelta(days=10))
+        )
+        # Day -6: both top up; day -4: debtor overdraws; day -1: debtor repays
+        self._entry(-6, self.users[0], "credit", "10.00")
+        self._entry(-6, self.users[1], "credit", "5.00")
+        self._entry(-4, self.users[1], "debit", "25.00")
+        self._entry(-1, self.users[1], "credit", "30.00")
+        UserProfile.objects.update(
+            updated_at=wallet.end_of_day(self.today - timedelta(days=10))
+        )
+
+    def _entry(self, days, user, kind, amount):
+        _, entry = getattr(wallet, kind)(user, Decimal(amount))
+        moment = wallet.end_of_day(self.today + timedelta(days=days)) - timedelta(
+            hours=12
+        )
+        WalletTransaction.objects.filter(id=entry.id).update(created_at=moment)
+
+    def _balances(self, days):
+        moment = wallet.end_of_day(self.today + timedelta(days=days))
+        return [wallet.balance_at(user.id, moment) for user in self.users]
+
+    def test_snapshots_match_ledger_replay(self):
+        expected = {days: self._balances(days) for days in range(-8, 0)}
+        self.assertEqual(expected[-5], [Decimal("50.00"), Decimal("10.00")])
+        self.assertEqual(expected[-3], [Decimal("50.00"), Decimal("-15.00")])
+
+        # First run is a baseline for everyone; later days only cover activity
+        written = [
+            wallet.snapshot_balances(self.today + timedelta(days=days))
+            for days in range(-8, 0)
+        ]
+        self.assertEqual(written, [2, 0, 2, 0, 1, 0, 0, 1])
+        for days, balances in expected.items():
+            self.assertEqual(self._balances(days), balances)
+
+    def test_compacting_a_session_across_midnight_keeps_snapshots(self):
+        lot = ParkingLot.objects.create(
+            name="Night", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        spot = ParkingSpot.objects.create(parking_lot=lot, spot_number="N1")
+        saver = self.users[0]
+        midnight = wallet.end_of_day(self.today - timedelta(days=3))
+        booking = Booking.objects.create(
+            user=saver,
+            parking_spot=spot,
+            status="completed",
+            start_time=midnight - timedelta(minutes=2),
+            end_time=midnight + timedelta(minutes=2),
+            duration_minutes=4,
+        )
+        # $3 charged before midnight, $2 after
+        for seconds in (-90, -60, -30, 30, 60):
+            _, entry = wallet.debit(saver, "1.00", booking=booking)
+            WalletTransaction.objects.filter(id=entry.id).update(
+                created_at=midnight + timedelta(seconds=seconds)
+            )
+        days = range(-8, 0)
+        for days_ago in days:
+            wallet.snapshot_balances(self.today + timedelta(days=days_ago))
+        before = {d: self._balances(d) for d in days}
+        self.assertEqual(before[-3][0], Decimal("47.00"))
+        self.assertEqual(before[-2][0], Decimal("45.00"))
+
+        wallet.compact_booking_charges()
+        self.assertEqual(WalletTransaction.objects.filter(booking=booking).count(), 2)
+        self.assertEqual({d: self._balances(d) for d in days}, before)
+        # Re-running the snapshots after compaction writes the same balances
+        stored = list(
+            WalletBalanceSnapshot.objects.order_by("id").values_list("balance")
+        )
+        for days_ago in days:
+            wallet.snapshot_balances(self.today + timedelta(days=days_ago))
+        self.assertEqual(
+            list(WalletBalanceSnapshot.objects.order_by("id").values_list("balance")),
+            stored,
+        )
+
+    def test_negative_balances_as_of_a_past_day(self):
+        for days in range(-8, 0):
+            wallet.snapshot_balances(self.today + timedelta(days=days))
+        admin = User.objects.create(username="finance", is_staff=True)
+        self.client.force_login(admin)
+        day = self.today - timedelta(days=3)
+        response = self.client.get(f"/api/admin/users/negative-balance/?as_of={day}")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["total_negative_balance"], -15.0)
+        self.assertEqual([u["username"] for u in data["users"]], ["debtor"])
+        # Nobody is negative now
+        self.assertEqual(
+            self.client.get("/api/admin/users/negative-balance/").json(), []
+        )
+
+
+class LotCounterTest(TestCase):
+    """Per-lot spot counters follow every kind of spot write"""
+
+    def setUp(self):
+        self.lot = ParkingLot.objects.create(
+            name="Counted", address="-", total_spots=4, hourly_rate=Decimal("1.00")
+        )
+        self.other = ParkingLot.objects.create(
+            name="Other", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        self.spots = [
+            ParkingSpot.objects.create(parking_lot=self.lot, spot_number=f"S{n}")
+            for n in range(4)
+        ]
+
+    def assertCounters(self, lot, expected):
+        lot.refresh_from_db()
+        counters = tuple(getattr(lot, field) for field in ParkingLot.COUNTER_FIELDS)
+        self.assertEqual(counters, expected)
+        self.assertEqual(ParkingLot.recount([lot.id]), [])
+
+    def test_instance_saves(self):
+        self.spots[0].is_occupied = True
+        self.spots[0].save()
+        self.spots[1].is_reserved = True
+        self.spots[1].is_occupied = True
+        self.spots[1].save(update_fields=["is_reserved"])  # occupied not written
+        self.assertCounters(self.lot, (4, 1, 1))
+
+        spot = ParkingSpot.objects.only("id", "spot_number").get(pk=self.spots[0].pk)
+        spot.is_occupied = False
+        spot.save()
+        self.assertCounters(self.lot, (4, 0, 1))
+
+        self.spots[1].parking_lot = self.other
+        self.spots[1].save()
+        self.assertCounters(self.lot, (3, 0, 0))
+        self.assertCounters(self.other, (1, 1, 1))
+
+        self.spots[2].delete()
+        self.assertCounters(self.lot, (2, 0, 0))
+
+    def test_stale_instances_count_a_transition_once(self):
+        first = ParkingSpot.objects.get(pk=self.spots[0].pk)
+        second = ParkingSpot.objects.get(pk=self.spots[0].pk)
+        first.is_occupied = True
+        first.save()
+        # Loaded before the first write: it holds no transition of its own
+        second.is_occupied = True
+        second.save()
+        self.assertCounters(self.lot, (4, 1, 0))
+        second.is_reserved = True
+        second.save(update_fields=["is_reserved"])
+        self.assertCounters(self.lot, (4, 1, 1))
+
+        # A stale "free" instance really frees the spot once
+        stale = self.spots[0]
+        stale.is_occupied = False
+        stale.is_reserved = False
+        stale.save()
+        self.assertCounters(self.lot, (4, 0, 0))
+
+    def test_bulk_writes(self):
+        ParkingSpot.objects.filter(spot_number__in=["S0", "S1"]).update(
+            is_occupied=True
+        )
+        self.assertCounters(self.lot, (4, 2, 0))
+        ParkingSpot.objects.bulk_create(
+            [ParkingSpot(parking_lot=self.other, spot_number="B1", is_occupied=True)]
+        )
+        self.assertCounters(self.other, (1, 1, 0))
+        ParkingSpot.objects.filter(spot_number="S0").delete()
+        self.assertCounters(self.lot, (3, 1, 0))
+
+    def test_reconcile_fixes_drift(self):
+        ParkingLot.objects.filter(id=self.lot.id).update(occupied_count=7)
+        self.assertEqual(ParkingLot.recount(), [(self.lot.id, (4, 7, 0), (4, 0, 0))])
+        self.assertCounters(self.lot, (4, 0, 0))
+
+    def test_overtime_scheduler_reconciles_on_its_cadence(self):
+        scheduler = overtime.OvertimeScheduler(dict(overtime.DEFAULT_SCHEDULER))
+        now = timezone.now()
+        ParkingLot.objects.filter(id=self.lot.id).update(occupied_count=7)
+        scheduler.run_due(now)
+        self.assertCounters(self.lot, (4, 0, 0))
+
+        ParkingLot.objects.filter(id=self.lot.id).update(occupied_count=7)
+        scheduler.run_due(now + timedelta(minutes=1))
+        self.lot.refresh_from_db()
+        self.assertEqual(self.lot.occupied_count, 7)  # not due yet
+        scheduler.run_due(now + timedelta(hours=1))
+        self.assertCounters(self.lot, (4, 0, 0))
+
+    def test_lot_list_has_no_per_lot_queries(self):
+        with self.assertNumQueries(1):
+            data = self.client.get("/api/parking-lots/").json()
+        self.assertEqual(
+            {lot["name"]: lot["available_spots"] for lot in data},
+            {"Counted": 4, "Other": 0},
+        )
+
+
+class NearbySearchTest(TestCase):
+    """Grid lookups agree with a brute-force scan and skip full lots"""
+
+    def test_grid_order_matches_brute_force(self):
+        rng = random.Random(48)
+        points = [
+            (n, -26.2 + rng.uniform(-0.3, 0.3), 28.04 + rng.uniform(-0.3, 0.3))
+            for n in range(500)
+        ]
+        index = geo.GridIndex(points, 0.01)
+        for lat, lng, max_km in [
+            (-26.2, 28.04, None),
+            (-26.0, 28.3, 5),
+            (-30, 20, None),
+        ]:
+            expected = sorted(
+                (geo.haversine_km(lat, lng, p_lat, p_lng), lot_id)
+                for lot_id, p_lat, p_lng in points
+            )
+            if max_km is not None:
+                expected = [pair for pair in expected if pair[0] <= max_km]
+            self.assertEqual(list(index.nearest(lat, lng, max_km)), expected)
+
+    def test_endpoint_skips_full_lots(self):
+        lots = {}
+        for name, offset in [("Near", 0.001), ("Full", 0.002), ("Far", 0.05)]:
+            lots[name] = ParkingLot.objects.create(
+                name=name,
+                address="-",
+                total_spots=1,
+                hourly_rate=Decimal("1.00"),
+                latitude=Decimal("-26.2") + Decimal(str(offset)),
+                longitude=Decimal("28.04"),
+            )
+            ParkingSpot.objects.create(
+                parking_lot=lots[name], spot_number="A1", is_occupied=name == "Full"
+            )
+        geo.invalidate_lot_index()
+
+        data = self.client.get(
+            "/api/parking-lots/nearby/", {"lat": -26.2, "lng": 28.04, "k": 5}
+        ).json()
+        self.assertEqual([row["name"] for row in data], ["Near", "Far"])
+        self.assertLess(data[0]["distance_km"], data[1]["distance_km"])
+
+        data = self.client.get(
+            "/api/parking-lots/nearby/",
+            {"lat": -26.2, "lng": 28.04, "radius_km": 1},
+        ).json()
+        self.assertEqual([row["name"] for row in data], ["Near"])
+        response = self.client.get("/api/parking-lots/nearby/", {"lat": "x"})
+        self.assertEqual(response.status_code, 400)
+
+
+class SpotAllocationTest(TestCase):
+    """Allocation pops free spots in order and steps over stale candidates"""
+
+    def setUp(self):
+        self.lot = ParkingLot.objects.create(
+            name="Alloc", address="-", total_spots=4, hourly_rate=Decimal("1.00")
+        )
+        self.spots = {
+            number: ParkingSpot.objects.create(
+                parking_lot=self.lot, spot_number=number, spot_type=spot_type
+            )
+            for number, spot_type in [
+                ("A10", "regular"),
+                ("A2", "regular"),
+                ("A3", "regular"),
+                ("E1", "electric"),
+            ]
+        }
+        self.user = User.objects.create(username="alloc")
+        UserProfile.objects.create(user=self.user, balance=Decimal("10.00"))
+        allocation.invalidate_spot_pool()
+
+    def book(self, user, spot):
+        now = timezone.now()
+        return Booking.objects.create(
+            user=user,
+            parking_spot=spot,
+            status="active",
+            start_time=now,
+            end_time=now,
+            duration_minutes=0,
+        )
+
+    def test_pool_pops_in_spot_order_and_follows_transitions(self):
+        pool = allocation.get_spot_pool()
+        self.assertEqual(pool.pop(self.lot.id, "regular"), self.spots["A2"].id)
+        pool.take(self.spots["A3"].id)
+        self.assertEqual(pool.pop(self.lot.id, "regular"), self.spots["A10"].id)
+        self.assertIsNone(pool.pop(self.lot.id, "regular"))
+        allocation.spot_changed(self.spots["A3"].id, True)
+        self.assertEqual(pool.pop(self.lot.id, "regular"), self.spots["A3"].id)
+        self.assertEqual(pool.pop(self.lot.id, "electric"), self.spots["E1"].id)
+
+    def test_allocation_skips_spots_taken_elsewhere(self):
+        allocation.get_spot_pool()
+        # Booked and occupied behind the pool's back (another process)
+        self.book(User.objects.create(username="other"), self.spots["A2"])
+        ParkingSpot.objects.filter(id=self.spots["A3"].id).update(is_occupied=True)
+
+        self.client.force_login(self.user)
+        response = self.client.post(
+            "/api/bookings/allocate/", {"lot_id": self.lot.id}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["parking_spot"]["spot_number"], "A10")
+
+        response = self.client.post(
+            "/api/bookings/allocate/",
+            {"lot_id": self.lot.id, "spot_type": "electric"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)  # one active booking per user
+        # The candidate goes back to the pool
+        pool = allocation.get_spot_pool()
+        self.assertEqual(pool.pop(self.lot.id, "electric"), self.spots["E1"].id)
+
+    def test_chatbot_booking_updates_pool_incrementally(self):
+        pool = allocation.get_spot_pool()
+        self.client.force_login(self.user)
+        with mock.patch.object(ParkingLot, "recount") as recount:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    "/api/chatbot/reserve/",
+                    {"slot_id": self.spots["A2"].id},
+                    format="json",
+                )
+        self.assertEqual(response.status_code, 201)
+        recount.assert_not_called()
+        self.assertIs(allocation.get_spot_pool(), pool)  # not rebuilt
+        self.assertEqual(pool.pop(self.lot.id, "regular"), self.spots["A3"].id)
+        self.lot.refresh_from_db()
+        self.assertEqual(self.lot.occupied_count, 1)
+
+    def test_no_free_spot(self):
+        self.book(self.user, self.spots["E1"])
+        with self.assertRaises(allocation.NoSpotAvailable):
+            allocation.allocate_spot(
+                User.objects.create(username="late"), self.lot.id, "electric"
+            )
+
+    def test_booked_spot_stays_out_of_pool_when_freed(self):
+        pool = allocation.get_spot_pool()
+        with self.captureOnCommitCallbacks(execute=True):
+            create_active_booking(
+                User.objects.create(username="walk-in"),
+                self.spots["A2"].id,
+                start_time=timezone.now(),
+                end_time=timezone.now(),
+                duration_minutes=0,
+            )
+        # The sensor reports the spot free while its booking is still running
+        allocation.spot_changed(self.spots["A2"].id, True)
+        self.assertEqual(pool.pop(self.lot.id, "regular"), self.spots["A3"].id)
+
+    def test_unexpected_error_returns_spot_to_pool(self):
+        pool = allocation.get_spot_pool()
+        with mock.patch.object(
+            allocation, "create_active_booking", side_effect=RuntimeError("db down")
+        ):
+            with self.assertRaises(RuntimeError):
+                allocation.allocate_spot(self.user, self.lot.id, "regular")
+        self.assertEqual(pool.pop(self.lot.id, "regular"), self.spots["A2"].id)
+
+    @override_settings(PARKING_TARIFFS={"lots": {"Alloc": {"unit_price": "5.00"}}})
+    def test_minimum_balance_follows_lot_tariff(self):
+        UserProfile.objects.filter(user=self.user).update(balance=Decimal("4.00"))
+        self.client.force_login(self.user)
+        response = self.client.post(
+            "/api/bookings/allocate/", {"lot_id": self.lot.id}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Booking.objects.filter(user=self.user).exists())
+
+
+class ReservationTest(TestCase):
+    """Interval lookups match a brute-force scan; the API rejects overlaps"""
+
+    def setUp(self):
+        self.lot = ParkingLot.objects.create(
+            name="Ahead", address="-", total_spots=2, hourly_rate=Decimal("1.00")
+        )
+        self.spots = [
+            ParkingSpot.objects.create(parking_lot=self.lot, spot_number=f"R{n}")
+            for n in range(2)
+        ]
+        self.user = User.objects.create(username="planner")
+        self.client.force_login(self.user)
+        reservations.invalidate_reservation_book()
+        self.base = timezone.now().replace(microsecond=0) + timedelta(days=1)
+
+    def test_book_matches_brute_force(self):
+        rng = random.Random(50)
+        rows, moment = [], 0.0
+        for n in range(300):
+            moment += rng.uniform(0, 50)
+            length = rng.uniform(1, 100)
+            rows.append((n, n % 3, moment, moment + length))
+            moment += length
+        book = reservations.ReservationBook(rows)
+        book.remove(1, rows[4][2], rows[4][0])
+        live = rows[:4] + rows[5:]
+        for _ in range(500):
+            spot_id, t1 = rng.randrange(3), rng.uniform(0, moment)
+            t2 = t1 + rng.uniform(0.5, 80)
+            expected = not any(
+                s == spot_id and start < t2 and end > t1 for _, s, start, end in live
+            )
+            self.assertEqual(book.is_free(spot_id, t1, t2), expected)
+
+    def reserve(self, spot, start_hours, end_hours):
+        return self.client.post(
+            "/api/reservations/",
+            {
+                "parking_spot_id": spot.id,
+                "start_time": (self.base + timedelta(hours=start_hours)).isoformat(),
+                "end_time": (self.base + timedelta(hours=end_hours)).isoformat(),
+            },
+            format="json",
+        )
+
+    def interval(self, start_hours, end_hours):
+        return {
+            "start": (self.base + timedelta(hours=start_hours)).isoformat(),
+            "end": (self.base + timedelta(hours=end_hours)).isoformat(),
+        }
+
+    def test_reserve_check_and_cancel(self):
+        spot = self.spots[0]
+        created = self.reserve(spot, 1, 3)
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(self.reserve(spot, 2, 4).status_code, 409)
+        self.assertEqual(self.reserve(spot, 3, 4).status_code, 201)  # [start, end)
+
+        url = f"/api/parking-spots/{spot.id}/availability/"
+        self.assertFalse(self.client.get(url, self.interval(0, 2)).json()["is_free"])
+        self.assertTrue(self.client.get(url, self.interval(4, 5)).json()["is_free"])
+        spots = self.client.get(
+            "/api/parking-spots/available/",
+            {**self.interval(2, 3), "lot_id": self.lot.id},
+        ).json()["spots"]
+        self.assertEqual([row["id"] for row in spots], [self.spots[1].id])
+
+        cancel = f"/api/reservations/{created.json()['id']}/cancel/"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(cancel).status_code, 200)
+        self.assertTrue(self.client.get(url, self.interval(1, 2)).json()["is_free"])
+        self.assertEqual(self.reserve(spot, 1, 2).status_code, 201)
+
+    def test_bookings_and_reservations_exclude_each_other(self):
+        driver = User.objects.create(username="driver")
+        booked = create_active_booking(
+            driver,
+            self.spots[0].id,
+            start_time=self.base - timedelta(hours=1),
+            end_time=self.base + timedelta(hours=2),
+        )
+        response = self.reserve(self.spots[0], 1, 3)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["conflicting_booking"], booked.id)
+        self.assertEqual(self.reserve(self.spots[0], 2, 3).status_code, 201)
+        url = f"/api/parking-spots/{self.spots[0].id}/availability/"
+        self.assertFalse(self.client.get(url, self.interval(0, 1)).json()["is_free"])
+        spots = self.client.get(
+            "/api/parking-spots/available/",
+            {**self.interval(0, 1), "lot_id": self.lot.id},
+        ).json()["spots"]
+        self.assertEqual([row["id"] for row in spots], [self.spots[1].id])
+
+        # An open-ended booking now would run into a reservation soon after
+        now = timezone.now()
+        reserved = reservations.reserve(
+            self.user,
+            self.spots[1].id,
+            now + timedelta(minutes=30),
+            now + timedelta(hours=2),
+        )
+        walk_in = {"start_time": now, "end_time": now}
+        with self.assertRaises(BookingConflict) as raised:
+            create_active_booking(
+                User.objects.create(username="walk-in"), self.spots[1].id, **walk_in
+            )
+        self.assertEqual(raised.exception.reason, "reservation")
+        self.assertEqual(raised.exception.existing.id, reserved.id)
+        # The holder of the reservation may start it
+        create_active_booking(self.user, self.spots[1].id, **walk_in)
+
+        # An open-ended booking parked beyond walk_in still holds its spot
+        long_stay = ParkingSpot.objects.create(parking_lot=self.lot, spot_number="R2")
+        started = now - timedelta(minutes=90)
+        booked = create_active_booking(
+            User.objects.create(username="long-stay"),
+            long_stay.id,
+            start_time=started,
+            end_time=started,
+        )
+        later = now + timedelta(hours=1)
+        self.assertFalse(reservations.is_spot_free(long_stay.id, now, later))
+        with self.assertRaises(reservations.ReservationConflict) as raised:
+            reservations.reserve(self.user, long_stay.id, now, later)
+        self.assertEqual(raised.exception.existing, booked.id)
+        self.assertEqual(
+            [row["id"] for row in reservations.free_spots(now, later, self.lot.id)],
+            [self.spots[0].id],
+        )
+
+    def test_rejects_invalid_intervals(self):
+        self.assertEqual(self.reserve(self.spots[0], 2, 1).status_code, 400)
+        self.assertEqual(self.reserve(self.spots[0], -48, -47).status_code, 400)
+        self.assertEqual(
+            self.client.get("/api/parking-spots/available/").status_code, 400
+        )
+
+
+class BillingTickTest(TestCase):
+    """The tick bills whole units once and advances each booking's cursor"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Billed", address="-", total_spots=2, hourly_rate=Decimal("1.00")
+        )
+        self.spots = [
+            ParkingSpot.objects.create(parking_lot=lot, spot_number=f"B{n}")
+            for n in range(2)
+        ]
+        self.t0 = timezone.now().replace(microsecond=0) - timedelta(hours=1)
+        self.users = []
+        for n in range(2):
+            user = User.objects.create(username=f"billed{n}")
+            UserProfile.objects.create(user=user, balance=Decimal("100.00"))
+            self.users.append(user)
+
+    def start(self, user, spot, end_after=None):
+        return Booking.objects.create(
+            user=user,
+            parking_spot=spot,
+            status="active",
+            start_time=self.t0,
+            # end_time == start_time: pay per use, billed until the car leaves
+            end_time=self.t0 + end_after if end_after else self.t0,
+            duration_minutes=0,
+            timer_started=self.t0,
+            last_billing_at=self.t0,
+            charged_total=Decimal("0.00"),
+        )
+
+    def balance(self, user):
+        return UserProfile.objects.get(user=user).balance
+
+    def test_repeated_ticks_do_not_double_charge(self):
+        booking = self.start(self.users[0], self.spots[0])
+        at = self.t0 + timedelta(seconds=95)
+
+        summary = billing.run_billing_tick(now=at)
+        self.assertEqual((summary["units"], summary["amount"]), (3, Decimal("3.00")))
+        booking.refresh_from_db()
+        # The cursor advances by whole units; the 5 s remainder carries over
+        self.assertEqual(booking.last_billing_at, self.t0 + timedelta(seconds=90))
+        self.assertEqual(booking.charged_total, Decimal("3.00"))
+
+        self.assertEqual(billing.run_billing_tick(now=at)["bookings_billed"], 0)
+        self.assertEqual(
+            billing.run_billing_tick(now=at + timedelta(seconds=20))["units"], 0
+        )
+        self.assertEqual(
+            billing.run_billing_tick(now=at + timedelta(seconds=25))["units"], 1
+        )
+        booking.refresh_from_db()
+        self.assertEqual(booking.last_billing_at, self.t0 + timedelta(seconds=120))
+        self.assertEqual(booking.charged_total, Decimal("4.00"))
+        self.assertEqual(self.balance(self.users[0]), Decimal("96.00"))
+        self.assertEqual(WalletTransaction.objects.filter(booking=booking).count(), 2)
+
+    def test_fixed_end_and_user_filter(self):
+        fixed = self.start(self.users[0], self.spots[0], timedelta(seconds=60))
+        open_ended = self.start(self.users[1], self.spots[1])
+        at = self.t0 + timedelta(minutes=5)
+
+        summary = billing.run_billing_tick(now=at, user=self.users[0])
+        self.assertEqual(summary["units"], 2)  # stops at end_time
+        open_ended.refresh_from_db()
+        self.assertEqual(open_ended.last_billing_at, self.t0)
+
+        summary = billing.run_billing_tick(now=at)
+        self.assertEqual((summary["bookings_billed"], summary["units"]), (1, 10))
+        self.assertEqual(self.balance(self.users[0]), Decimal("98.00"))
+        self.assertEqual(self.balance(self.users[1]), Decimal("90.00"))
+        fixed.refresh_from_db()
+        self.assertEqual(fixed.charged_total, Decimal("2.00"))
+
+    def test_booking_list_is_a_pure_read(self):
+        # A fixed booking past its end and a pay-per-use timer, both unbilled
+        bookings = [
+            self.start(self.users[0], self.spots[0], timedelta(minutes=30)),
+            self.start(self.users[1], self.spots[1]),
+        ]
+        ParkingSpot.objects.filter(id=self.spots[0].id).update(is_occupied=True)
+
+        def state():
+            return (
+                list(
+                    Booking.objects.order_by("id").values_list(
+                        "status", "charged_total", "last_billing_at", "total_cost"
+                    )
+                ),
+                [self.balance(user) for user in self.users],
+                list(
+                    ParkingSpot.objects.order_by("id").values_list(
+                        "is_occupied", "is_reserved"
+                    )
+                ),
+                WalletTransaction.objects.count(),
+            )
+
+        before = state()
+        with mock.patch("parking_app.views.trigger_esp32_booking_led") as led:
+            for user, booking in zip(self.users, bookings):
+                self.client.force_login(user)
+                # Session, user, then the bookings with spot and profile joined
+                with self.assertNumQueries(3):
+                    response = self.client.get("/api/bookings/")
+                self.assertEqual([row["id"] for row in response.json()], [booking.id])
+        led.assert_not_called()
+        self.assertEqual(state(), before)
+
+
+class AutostartTest(SimpleTestCase):
+    """Background threads start only in the serving runserver process"""
+
+    def test_should_autostart(self):
+        from .apps import should_autostart
+
+        with mock.patch.dict("os.environ", {"RUN_MAIN": "true"}):
+            self.assertTrue(should_autostart(["manage.py", "runserver"]))
+            self.assertFalse(should_autostart(["manage.py", "migrate"]))
+            self.assertFalse(should_autostart(["script.py"]))
+            self.assertFalse(should_autostart([]))
+        with mock.patch.dict("os.environ", {}, clear=True):
+            self.assertFalse(should_autostart(["manage.py", "runserver"]))
+            self.assertTrue(should_autostart(["manage.py", "runserver", "--noreload"]))
+
+    def test_ready_skips_plain_scripts(self):
+        from django.apps import apps
+
+        starters = [
+            mock.patch.object(billing, "start_background_billing"),
+            mock.patch.object(outbox, "start_background_dispatcher"),
+            mock.patch.object(overtime, "start_background_scheduler"),
+        ]
+        with mock.patch("sys.argv", ["script.py"]):
+            mocks = [starter.start() for starter in starters]
+            try:
+                apps.get_app_config("parking_app").ready()
+            finally:
+                for starter in starters:
+                    starter.stop()
+        for started in mocks:
+            started.assert_not_called()
+
+    def test_run_billing_tick_once(self):
+        out = StringIO()
+        with mock.patch.object(
+            billing,
+            "run_billing_tick",
+            return_value={"bookings_billed": 2, "units": 5, "amount": Decimal("5.00")},
+        ) as tick:
+            call_command("run_billing_tick", "--once", stdout=out)
+        tick.assert_called_once_with()
+        self.assertIn("Billed 2 booking(s), 5 unit(s), $5.00", out.getvalue())
+
+
+class BookingPaginationTest(TestCase):
+    """Keyset pages walk history exactly once; clients opt in"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Paged", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        self.spot = ParkingSpot.objects.create(parking_lot=lot, spot_number="P1")
+        self.user = User.objects.create(username="history")
+        self.client.force_login(self.user)
+        self.base = timezone.now().replace(microsecond=0) - timedelta(days=3)
+        # Seven bookings over three start times: ties are broken on id
+        self.bookings = self.create_bookings(
+            self.user, [self.base - timedelta(hours=n // 3) for n in range(7)]
+        )
+
+    def create_bookings(self, user, starts):
+        return Booking.objects.bulk_create(
+            Booking(
+                user=user,
+                parking_spot=self.spot,
+                start_time=start,
+                end_time=start + timedelta(hours=1),
+                status="completed" if n % 2 else "cancelled",
+            )
+            for n, start in enumerate(starts)
+        )
+
+    def newest_first(self, bookings):
+        return [
+            b.id for b in sorted(bookings, key=lambda b: (b.start_time, b.id))[::-1]
+        ]
+
+    def walk(self, url, params):
+        ids, cursor, pages = [], None, 0
+        while True:
+            query = dict(params, **({"cursor": cursor} if cursor else {}))
+            response = self.client.get(url, query)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            ids += [row["id"] for row in body["results"]]
+            pages += 1
+            cursor = body["next_cursor"]
+            if cursor is None:
+                return ids, pages
+
+    def test_walks_every_page_across_tied_start_times(self):
+        ids, pages = self.walk("/api/bookings/", {"page_size": 2})
+        self.assertEqual(ids, self.newest_first(self.bookings))
+        self.assertEqual(pages, 4)
+        ids, _ = self.walk("/api/chatbot/booking-history/", {"page_size": 3})
+        self.assertEqual(ids, self.newest_first(self.bookings))
+
+    def test_rejects_malformed_cursor_and_page_size(self):
+        for params in [
+            {"cursor": "not-a-cursor"},
+            {"cursor": "bm90fGE="},  # base64 of a key without a valid moment/id
+            {"page_size": "0"},
+            {"page_size": "-3"},
+            {"page_size": "many"},
+        ]:
+            with self.subTest(params):
+                for url in ["/api/bookings/", "/api/chatbot/booking-history/"]:
+                    self.assertEqual(self.client.get(url, params).status_code, 400)
+        # Oversized pages are capped rather than rejected
+        response = self.client.get("/api/bookings/", {"page_size": "1000"})
+        self.assertEqual(len(response.json()["results"]), 7)
+
+    def test_filters_combine_with_cursor(self):
+        params = {
+            "status": "completed",
+            "from": (self.base - timedelta(hours=1)).isoformat(),
+            "to": self.base.isoformat(),  # exclusive
+            "page_size": 1,
+        }
+        ids, _ = self.walk("/api/bookings/", params)
+        expected = [
+            b
+            for b in self.bookings
+            if b.status == "completed"
+            and self.base - timedelta(hours=1) <= b.start_time < self.base
+        ]
+        self.assertEqual(ids, self.newest_first(expected))
+        self.assertEqual(len(ids), 2)
+
+    def test_admin_pages_are_capped_at_500(self):
+        admin = User.objects.create(username="root", is_staff=True, is_superuser=True)
+        self.create_bookings(
+            admin, [self.base - timedelta(minutes=n) for n in range(500)]
+        )
+        response = self.client.get("/api/chatbot/admin/bookings/", {"page_size": 1000})
+        body = response.json()
+        self.assertEqual(len(body["bookings"]), 500)
+        self.assertIsNotNone(body["next_cursor"])
+        rest = self.client.get(
+            "/api/chatbot/admin/bookings/", {"cursor": body["next_cursor"]}
+        ).json()
+        self.assertEqual(len(rest["bookings"]), 7)
+        self.assertIsNone(rest["next_cursor"])
+
+        self.client.force_login(admin)
+        response = self.client.get("/api/admin/bookings/", {"page_size": 1000})
+        self.assertEqual(len(response.json()["results"]), 100)  # MAX_PAGE_SIZE
+
+    def test_legacy_response_without_opt_in(self):
+        response = self.client.get("/api/bookings/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.json(), list)
+        self.assertEqual(
+            [row["id"] for row in response.json()], self.newest_first(self.bookings)
+        )
+        response = self.client.get("/api/bookings/", {"status": "completed"})
+        self.assertEqual(len(response.json()), 3)
+
+
+class BookingFieldsTest(TestCase):
+    """?fields= rows are validated and formatted like BookingSerializer"""
+
+    def setUp(self):
+        self.lot = ParkingLot.objects.create(
+            name="Slim", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        spot = ParkingSpot.objects.create(parking_lot=self.lot, spot_number="F1")
+        self.user = User.objects.create(username="slim")
+        self.client.force_login(self.user)
+        start = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        self.bookings = Booking.objects.bulk_create(
+            Booking(
+                user=self.user,
+                parking_spot=spot,
+                start_time=start - timedelta(hours=n),
+                end_time=start - timedelta(hours=n) + timedelta(minutes=90),
+                duration_minutes=90,
+                status="completed",
+                total_cost=Decimal("2.5"),
+                charged_total=Decimal("1.25"),
+                overtime_cost=Decimal("0"),
+                number_plate="AB 123" if n % 2 else None,
+                timer_started=start - timedelta(hours=n, seconds=-7),
+                completed_at=start - timedelta(hours=n) + timedelta(minutes=90),
+            )
+            for n in range(5)
+        )
+
+    def test_unknown_field_is_rejected(self):
+        for url in [
+            "/api/bookings/",
+            "/api/chatbot/booking-history/",
+        ]:
+            with self.subTest(url):
+                response = self.client.get(url, {"fields": "id,password"})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("password", response.json()["fields"])
+
+    def test_blank_fields_give_default_columns(self):
+        rows = self.client.get("/api/bookings/", {"fields": ""}).json()
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(list(rows[0]), DEFAULT_BOOKING_LIST_FIELDS)
+
+    def test_rows_match_booking_serializer(self):
+        fields = list(BOOKING_LIST_FIELDS)
+        bookings = Booking.objects.select_related("user", "parking_spot").order_by("id")
+        rows = serialize_booking_rows(
+            booking_list_values(bookings, fields).order_by("id"), fields
+        )
+        for booking, row in zip(bookings, rows):
+            data = BookingSerializer(booking).data
+            expected = {
+                name: data[name]
+                for name in fields
+                if name in data and not isinstance(data[name], dict)
+            }
+            expected.update(
+                parking_spot_id=data["parking_spot"]["id"],
+                spot_number=data["parking_spot"]["spot_number"],
+                parking_lot=self.lot.name,
+                user_id=data["user"]["id"],
+                username=data["user"]["username"],
+            )
+            self.assertEqual(row, expected)
+        self.assertEqual(rows[0]["total_cost"], "2.50")
+        self.assertIsNone(rows[0]["number_plate"])
+
+    def test_fields_with_cursor_pages(self):
+        ids, cursor = [], None
+        while True:
+            params = {"fields": "id,status", "page_size": 2}
+            if cursor:
+                params["cursor"] = cursor
+            body = self.client.get("/api/bookings/", params).json()
+            self.assertTrue(
+                all(list(row) == ["id", "status"] for row in body["results"])
+            )
+            ids += [row["id"] for row in body["results"]]
+            cursor = body["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(ids, [b.id for b in self.bookings])  # newest first
+
+
+class ChargedTotalTest(TestCase):
+    """Booking.charged_total follows the ledger across debits, ticks and completion"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Charged", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        self.spot = ParkingSpot.objects.create(
+            parking_lot=lot, spot_number="C1", is_occupied=True
+        )
+        self.user = User.objects.create(username="charged")
+        UserProfile.objects.create(user=self.user, balance=Decimal("100.00"))
+        self.t0 = timezone.now().replace(microsecond=0) - timedelta(seconds=95)
+        self.booking = Booking.objects.create(
+            user=self.user,
+            parking_spot=self.spot,
+            status="active",
+            start_time=self.t0,
+            end_time=self.t0,
+            duration_minutes=0,
+            timer_started=self.t0,
+            last_billing_at=self.t0,
+            charged_total=Decimal("0.00"),
+        )
+
+    def charged(self):
+        self.booking.refresh_from_db()
+        return self.booking.charged_total
+
+    def test_debits_and_booking_adjustments(self):
+        wallet.debit(self.user, "2.00", booking=self.booking)
+        self.assertEqual(self.charged(), Decimal("2.00"))
+        wallet.credit(self.user, "0.50", type="adjustment", booking=self.booking)
+        self.assertEqual(self.charged(), Decimal("1.50"))
+        wallet.credit(self.user, "5.00")  # top-up: not a booking charge
+        self.assertEqual(self.charged(), Decimal("1.50"))
+
+    def test_untracked_total_is_rebuilt_from_the_ledger(self):
+        Booking.objects.filter(id=self.booking.id).update(charged_total=None)
+        WalletTransaction.objects.create(
+            user=self.user,
+            booking=self.booking,
+            type="parking_charge",
+            amount=Decimal("3.00"),
+        )
+        self.booking.refresh_from_db()
+        self.assertEqual(wallet.booking_charged_total(self.booking), Decimal("3.00"))
+        wallet.debit(self.user, "1.00", booking=self.booking)
+        self.assertEqual(self.charged(), Decimal("4.00"))
+
+    def test_completion_charges_only_what_ticks_have_not(self):
+        billing.run_billing_tick(now=self.t0 + timedelta(seconds=90))
+        self.assertEqual(self.charged(), Decimal("3.00"))
+
+        self.client.force_login(self.user)
+        response = self.client.post(f"/api/bookings/{self.booking.id}/complete/")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.status, "completed")
+        # The completion debit is added to, not overwritten by, the final save
+        final = Decimal(str(data["total_cost"])).quantize(Decimal("0.01"))
+        self.assertEqual(self.booking.charged_total, final)
+        self.assertEqual(
+            Decimal(str(data["deduction"]["remaining_deducted"])),
+            final - Decimal("3.00"),
+        )
+        self.assertEqual(
+            UserProfile.objects.get(user=self.user).balance, Decimal("100.00") - final
+        )
+        # Nothing is left for a late tick to bill
+        self.assertEqual(billing.run_billing_tick()["bookings_billed"], 0)
+        # Compaction is left to the nightly command
+        self.assertEqual(
+            WalletTransaction.objects.filter(booking=self.booking).count(), 2
+        )
+
+
+class LedgerCompactionTest(TestCase):
+    """Compaction merges a session's ticks per day and changes no totals"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Compact", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        spot = ParkingSpot.objects.create(parking_lot=lot, spot_number="L1")
+        self.user = User.objects.create(username="compacted")
+        UserProfile.objects.create(user=self.user, balance=Decimal("20.00"))
+        self.midnight = wallet.end_of_day(timezone.localdate() - timedelta(days=2))
+        self.booking = Booking.objects.create(
+            user=self.user,
+            parking_spot=spot,
+            status="completed",
+            start_time=self.midnight - timedelta(minutes=2),
+            end_time=self.midnight + timedelta(minutes=1),
+            duration_minutes=3,
+            charged_total=Decimal("0.00"),
+        )
+        # Three ticks before midnight, two after
+        for seconds in (-90, -60, -30, 0, 30):
+            _, entry = wallet.debit(self.user, "1.00", booking=self.booking)
+            WalletTransaction.objects.filter(id=entry.id).update(
+                created_at=self.midnight + timedelta(seconds=seconds)
+            )
+
+    def rows(self):
+        return list(
+            WalletTransaction.objects.filter(booking=self.booking)
+            .order_by("created_at")
+            .values_list("created_at", "amount")
+        )
+
+    def test_never_merges_across_midnight(self):
+        results = wallet.compact_booking_charges()
+        self.assertEqual(
+            [(r["day"], r["rows_merged"]) for r in results],
+            [
+                (timezone.localdate(self.midnight) - timedelta(days=1), 3),
+                (timezone.localdate(self.midnight), 2),
+            ],
+        )
+        self.assertEqual(
+            self.rows(),
+            [
+                (self.midnight - timedelta(seconds=30), Decimal("3.00")),
+                (self.midnight + timedelta(seconds=30), Decimal("2.00")),
+            ],
+        )
+        self.booking.refresh_from_db()
+        self.assertEqual(self.booking.charged_total, Decimal("5.00"))
+        self.assertEqual(
+            UserProfile.objects.get(user=self.user).balance, Decimal("15.00")
+        )
+        self.assertEqual(wallet.compact_booking_charges(), [])
+
+    def test_command_dry_run_and_batches(self):
+        before = self.rows()
+        out = StringIO()
+        call_command("compact_wallet_ledger", "--dry-run", stdout=out)
+        self.assertIn("Would merge 5 ledger row(s) into 2", out.getvalue())
+        self.assertEqual(self.rows(), before)
+
+        # A second session is picked up by the next batch
+        other = Booking.objects.create(
+            user=self.user,
+            parking_spot=self.booking.parking_spot,
+            status="completed",
+            start_time=self.booking.start_time,
+            end_time=self.booking.end_time,
+            duration_minutes=3,
+            charged_total=Decimal("0.00"),
+        )
+        for _ in range(2):
+            wallet.debit(self.user, "1.00", booking=other)
+        out = StringIO()
+        call_command("compact_wallet_ledger", "--batch-size", "1", stdout=out)
+        self.assertIn("Merged 7 ledger row(s) into 3", out.getvalue())
+        self.assertEqual(len(self.rows()), 2)
+        self.assertEqual(WalletTransaction.objects.filter(booking=other).count(), 1)
+
+
+class OvertimeSchedulerTest(TestCase):
+    """Deadline heap ordering, rescheduling and incremental resync"""
+
+    def setUp(self):
+        self.lot = ParkingLot.objects.create(
+            name="Overtime", address="-", total_spots=3, hourly_rate=Decimal("1.00")
+        )
+        self.now = timezone.now().replace(microsecond=0)
+        self.scheduler = overtime.OvertimeScheduler(dict(overtime.DEFAULT_SCHEDULER))
+
+    def book(self, number, ends_in, occupied=True):
+        spot = ParkingSpot.objects.create(
+            parking_lot=self.lot, spot_number=f"O{number}", is_occupied=occupied
+        )
+        user = User.objects.create(username=f"overtime{number}")
+        UserProfile.objects.create(user=user, balance=Decimal("50.00"))
+        return Booking.objects.create(
+            user=user,
+            parking_spot=spot,
+            status="active",
+            start_time=self.now - timedelta(hours=1),
+            end_time=self.now + ends_in,
+            duration_minutes=60,
+        )
+
+    def test_pops_in_deadline_order_and_keeps_the_earliest(self):
+        at = [self.now + timedelta(seconds=n) for n in range(4)]
+        self.scheduler.schedule(1, at[3])
+        self.scheduler.schedule(2, at[1])
+        self.scheduler.schedule(3, at[2])
+        self.scheduler.schedule(1, at[0])  # moved up: old entry goes stale
+        self.scheduler.schedule(2, at[3])  # later: ignored
+        self.assertEqual(self.scheduler._pop_due(at[3]), [1, 2, 3])
+        self.assertEqual(self.scheduler._pop_due(at[3]), [])
+        self.assertIsNone(self.scheduler.seconds_until_next(at[3]))
+
+    def test_resync_after_the_first_only_reads_recent_updates(self):
+        old = self.book(1, timedelta(hours=1))
+        self.scheduler.resync(self.now)
+        self.assertIn(old.id, self.scheduler._scheduled)
+
+        # Rows untouched since the last resync are not read again
+        self.scheduler._scheduled.clear()
+        self.scheduler._heap.clear()
+        Booking.objects.filter(id=old.id).update(
+            updated_at=self.now - timedelta(hours=1)
+        )
+        new = self.book(2, timedelta(hours=2))
+        self.scheduler.resync(self.now)
+        self.assertEqual(list(self.scheduler._scheduled), [new.id])
+
+    def test_extended_and_overtime_bookings_are_rescheduled(self):
+        extended = self.book(1, -timedelta(minutes=10))
+        parked = self.book(2, -timedelta(minutes=10))
+        self.scheduler.resync(self.now)
+        Booking.objects.filter(id=extended.id).update(
+            end_time=self.now + timedelta(hours=1)
+        )
+
+        results = self.scheduler.run_due(self.now)
+        self.assertEqual(
+            [(r["booking_id"], r["status"]) for r in results],
+            [(parked.id, "overtime_billing")],
+        )
+        delay = timedelta(seconds=overtime.DEFAULT_SCHEDULER["overtime_delay_seconds"])
+        tick = timedelta(seconds=overtime.DEFAULT_SCHEDULER["tick_seconds"])
+        self.assertEqual(
+            self.scheduler._scheduled,
+            {
+                extended.id: self.now + timedelta(hours=1) + delay,
+                parked.id: self.now + tick,
+            },
+        )
+        self.assertEqual(self.scheduler.run_due(self.now), [])
+
+
+class ExpireBookingsTest(TestCase):
+    """Set-based expiry walks the backlog in batches and honours dry runs"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Expiry", address="-", total_spots=6, hourly_rate=Decimal("1.00")
+        )
+        self.now = timezone.now().replace(microsecond=0)
+        self.expired = []
+        for n in range(6):
+            spot = ParkingSpot.objects.create(
+                parking_lot=lot, spot_number=f"E{n}", is_occupied=True
+            )
+            user = User.objects.create(username=f"expiry{n}")
+            # The last booking is still running
+            ends = self.now + (
+                timedelta(hours=1) if n == 5 else -timedelta(minutes=n + 1)
+            )
+            booking = Booking.objects.create(
+                user=user,
+                parking_spot=spot,
+                status="active",
+                start_time=self.now - timedelta(hours=2),
+                end_time=ends,
+                duration_minutes=60,
+            )
+            if n < 5:
+                self.expired.append(booking.id)
+
+    def statuses(self):
+        return list(Booking.objects.order_by("id").values_list("status", flat=True))
+
+    def test_batches_complete_and_notify_together(self):
+        with self.assertLogs("parking_app.notifications", level="INFO") as logs:
+            expired = overtime.expire_bookings(now=self.now, batch_size=2)
+        self.assertEqual(expired, self.expired)
+        self.assertEqual(self.statuses(), ["completed"] * 5 + ["active"])
+        self.assertEqual(ParkingSpot.objects.filter(is_occupied=True).count(), 1)
+        booking = Booking.objects.get(id=self.expired[-1])
+        self.assertTrue(booking.is_overtime)
+        self.assertEqual(
+            booking.overtime_start_time, booking.end_time + timedelta(seconds=5)
+        )
+        # One push batch per database batch of 2
+        sent = [line for line in logs.output if "notifications sent for" in line]
+        self.assertEqual(len(sent), 3)
+        self.assertTrue(sent[0].endswith("sent for 2 bookings"))
+
+    def test_command_dry_run_changes_nothing(self):
+        out = StringIO()
+        call_command(
+            "cleanup_expired_bookings", "--dry-run", "--batch-size", "2", stdout=out
+        )
+        self.assertIn("would expire 5 bookings", out.getvalue())
+        self.assertEqual(self.statuses(), ["active"] * 6)
+
+        out = StringIO()
+        call_command("cleanup_expired_bookings", "--batch-size", "2", stdout=out)
+        self.assertIn("processed 5 expired bookings", out.getvalue())
+        self.assertEqual(self.statuses(), ["completed"] * 5 + ["active"])
+
+
+class BookingConflictTest(TestCase):
+    """Constraint violations on insert are mapped back to the broken rule"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Single", address="-", total_spots=2, hourly_rate=Decimal("1.00")
+        )
+        self.spots = [
+            ParkingSpot.objects.create(parking_lot=lot, spot_number=f"S{n}")
+            for n in range(2)
+        ]
+        self.users = [User.objects.create(username=f"single{n}") for n in range(2)]
+        now = timezone.now()
+        self.fields = {"start_time": now, "end_time": now + timedelta(hours=1)}
+        self.booking = create_active_booking(
+            self.users[0], self.spots[0].id, **self.fields
+        )
+
+    def test_spot_and_user_conflicts(self):
+        with self.assertRaises(BookingConflict) as caught:
+            create_active_booking(self.users[1], self.spots[0].id, **self.fields)
+        self.assertEqual(caught.exception.reason, "spot")
+        self.assertEqual(caught.exception.existing, self.booking)
+
+        with self.assertRaises(BookingConflict) as caught:
+            create_active_booking(self.users[0], self.spots[1].id, **self.fields)
+        self.assertEqual(caught.exception.reason, "user")
+        self.assertEqual(caught.exception.existing, self.booking)
+
+        self.assertEqual(Booking.objects.filter(status="active").count(), 1)
+
+        # Once the session ends, both the spot and the user are free again
+        Booking.objects.filter(id=self.booking.id).update(status="completed")
+        create_active_booking(self.users[1], self.spots[0].id, **self.fields)
+        self.assertEqual(Booking.objects.filter(status="active").count(), 1)
+        self.assertEqual(find_duplicate_active_bookings(), [])
+
+
+class TariffTest(SimpleTestCase):
+    """Default rates, per-spot overrides and the resolved-tariff cache"""
+
+    OVERRIDES = {
+        "spot_types": {"electric": {"unit_price": "2.00"}},
+        "lots": {
+            "VIP": {
+                "unit_price": "3.00",
+                "overtime_unit_price": "2.00",
+                "spot_types": {"electric": {"unit_price": "4.00"}},
+            }
+        },
+    }
+
+    def setUp(self):
+        self.start = timezone.make_aware(datetime(2026, 3, 2, 12, 0))
+
+    def spot(self, lot_name, spot_type):
+        return ParkingSpot(parking_lot=ParkingLot(name=lot_name), spot_type=spot_type)
+
+    def cost(self, seconds, spot=None):
+        return tariffs.session_cost(
+            self.start, self.start + timedelta(seconds=seconds), spot
+        )
+
+    def test_defaults_reproduce_the_flat_rates(self):
+        # $1 per 30 s, pro rata
+        self.assertEqual(self.cost(30), Decimal("1.00"))
+        self.assertEqual(self.cost(90), Decimal("3.00"))
+        self.assertEqual(self.cost(95), Decimal("3.17"))
+        self.assertEqual(self.cost(3600), Decimal("120.00"))
+        # Overtime: $1 per 15 minutes, pro rata per minute
+        self.assertEqual(tariffs.overtime_cost(15), Decimal("1.00"))
+        self.assertEqual(tariffs.overtime_cost(45), Decimal("3.00"))
+        self.assertEqual(tariffs.overtime_cost(1), Decimal("0.07"))
+
+    @override_settings(PARKING_TARIFFS=OVERRIDES)
+    def test_spot_type_and_lot_overrides(self):
+        self.assertEqual(self.cost(30, self.spot("Main", "regular")), Decimal("1.00"))
+        self.assertEqual(self.cost(30, self.spot("Main", "electric")), Decimal("2.00"))
+        self.assertEqual(self.cost(30, self.spot("VIP", "regular")), Decimal("3.00"))
+        self.assertEqual(self.cost(30, self.spot("VIP", "electric")), Decimal("4.00"))
+        vip = tariffs.tariff_for_spot(self.spot("VIP", "regular"))
+        self.assertEqual(tariffs.overtime_cost(15, vip), Decimal("2.00"))
+
+    def test_tariffs_are_cached_per_setting_value(self):
+        self.assertIs(
+            tariffs.get_tariff("Main", "regular"), tariffs.get_tariff("Main", "regular")
+        )
+        default = tariffs.get_tariff("VIP", "electric")
+        with override_settings(PARKING_TARIFFS=self.OVERRIDES):
+            self.assertEqual(
+                tariffs.get_tariff("VIP", "electric").unit_price, Decimal("4.00")
+            )
+        self.assertEqual(tariffs.get_tariff("VIP", "electric"), default)
+        self.assertEqual(default.unit_price, Decimal("1.00"))
+
+
+class OvertimeAlertPersistenceTest(TestCase):
+    """Overtime alerts are rate-limited per booking across processes"""
+
+    def setUp(self):
+        lot = ParkingLot.objects.create(
+            name="Alerts", address="-", total_spots=1, hourly_rate=Decimal("1.00")
+        )
+        spot = ParkingSpot.objects.create(
+            parking_lot=lot, spot_number="A1", is_occupied=True
+        )
+        now = timezone.now()
+        self.booking = Booking.objects.create(
+            user=User.objects.create(username="alerted"),
+            parking_spot=spot,
+            status="active",
+            start_time=now - timedelta(hours=1),
+            end_time=now - timedelta(minutes=20),
+            duration_minutes=40,
+        )
+        coalescer.clear()
+        self.addCleanup(coalescer.clear)
+
+    def fresh_process(self):
+        """A new cron run: empty coalescer, booking read from the database"""
+        coalescer.clear()
+        return Booking.objects.get(id=self.booking.id)
+
+    def test_repeats_are_suppressed_without_the_in_memory_coalescer(self):
+        stale = Booking.objects.get(id=self.booking.id)
+        self.assertTrue(NotificationService.send_overtime_alert(self.fresh_process()))
+        self.assertFalse(NotificationService.send_overtime_alert(self.fresh_process()))
+        # Loaded before the alert went out: the conditional update refuses it
+        coalescer.clear()
+        self.assertFalse(NotificationService.send_overtime_alert(stale))
+
+        # A window later the next alert goes out
+        Booking.objects.filter(id=self.booking.id).update(
+            last_alert_at=timezone.now() - timedelta(seconds=coalescer.window)
+        )
+        self.assertTrue(NotificationService.send_overtime_alert(self.fresh_process()))
+
+    def test_lost_claim_keeps_the_user_budget(self):
+        stale = self.fresh_process()
+        # Another process alerted after this one loaded the booking
+        Booking.objects.filter(id=self.booking.id).update(last_alert_at=timezone.now())
+        with mock.patch.object(coalescer, "per_user_limit", 1):
+            self.assertFalse(NotificationService.send_overtime_alert(stale))
+            # The lost claim recorded nothing: the next alert is not limited
+            other = Booking.objects.create(
+                user=self.booking.user,
+                parking_spot=self.booking.parking_spot,
+                status="completed",
+                start_time=self.booking.start_time,
+                end_time=self.booking.end_time,
+                duration_minutes=40,
+            )
+            self.assertTrue(NotificationService.send_overtime_alert(other))
+            self.assertEqual(
+                coalescer.admit(self.booking.user_id, other.id + 1), (False, 0)
+            )
+
+    def test_cron_runs_alert_once_per_window(self):
+        with self.assertLogs("parking_app.notifications", level="INFO") as logs:
+            for _ in range(3):
+                coalescer.clear()
+                call_command("check_overtime_bookings", stdout=StringIO())
+        sent = [line for line in logs.output if "Overtime alert sent" in line]
+        self.assertEqual(len(sent), 1)
+        self.booking.refresh_from_db()
+        self.assertIsNotNone(self.booking.last_alert_at)
+        self.assertTrue(self.booking.is_overtime)
+
+
+class AdminBalanceAdjustmentTest(TestCase):
+    """Admin balance edits are ledger adjustments, not silent overwrites"""
+
+    AUTH = {"HTTP_AUTHORIZATION": "Token admin_authenticated"}
+
+    def setUp(self):
+        self.user = User.objects.create(username="adjusted")
+        UserProfile.objects.create(user=self.user, balance=Decimal("10.00"))
+        wallet.debit(self.user, "4.00")
+
+    def statement(self):
+        rows, _, _ = wallet.statement_page(self.user.id, {})
+        return [(row["type"], row["amount"], row["balance_after"]) for row in rows]
+
+    def test_set_balance_records_the_signed_difference(self):
+        self.assertEqual(wallet.set_balance(self.user, "20.00")[0], Decimal("20.00"))
+        self.assertEqual(wallet.set_balance(self.user, "15.50")[0], Decimal("15.50"))
+        self.assertEqual(wallet.set_balance(self.user, "15.50")[1], None)
+        self.assertEqual(
+            self.statement(),
+            [
+                ("adjustment", Decimal("-4.50"), Decimal("15.50")),
+                ("adjustment", Decimal("14.00"), Decimal("20.00")),
+                ("parking_charge", Decimal("4.00"), Decimal("6.00")),
+            ],
+        )
+
+    def test_admin_endpoints_adjust_through_the_ledger(self):
+        response = self.client.put(
+            f"/api/chatbot/admin/users/{self.user.id}/update/",
+            json.dumps({"phone": "123", "balance": 25}),
+            content_type="application/json",
+            **self.AUTH,
+        )
+        self.assertEqual(response.status_code, 200)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual((profile.phone, profile.balance), ("123", Decimal("25.00")))
+
+        admin = User.objects.create(username="root", is_superuser=True)
+        self.client.force_login(admin)
+        response = self.client.put(
+            f"/api/admin/users/{self.user.id}/update/",
+            json.dumps({"balance": "5.00"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row[:2] for row in self.statement()],
+            [
+                ("adjustment", Decimal("-20.00")),
+                ("adjustment", Decimal("19.00")),
+                ("parking_charge", Decimal("4.00")),
+            ],
+        )
+
+        response = self.client.post(
+            "/api/chatbot/admin/users/create/",
+            json.dumps({"username": "opened", "balance": "7.50"}),
+            content_type="application/json",
+            **self.AUTH,
+        )
+        self.assertEqual(response.status_code, 200)
+        opened = User.objects.get(username="opened")
+        self.assertEqual(wallet.balance_at(opened.id), Decimal("7.50"))
+        self.assertEqual(
+            WalletTransaction.objects.get(user=opened).amount, Decimal("7.50")
+        )
@@ -14,6 +14,11 @@ urlpatterns = [
     path("auth/forgot-password/", views.forgot_password, name="forgot_password"),
     # Parking lot endpoints
     path("parking-lots/", views.ParkingLotList.as_view(), name="parking_lot_list"),
+    path(
+        "parking-lots/nearby/",
+        views.parking_lots_nearby,
+        name="parking_lots_nearby",
+    ),
     path(
         "parking-lots/<int:pk>/",
         views.ParkingLotDetail.as_view(),
@@ -21,6 +26,16 @@ urlpatterns = [
     ),
     # Parking spot endpoints
     path("parking-spots/", views.ParkingSpotList.as_view(), name="parking_spot_list"),
+    path(
+        "parking-spots/available/",
+        views.available_spots_between,
+        name="available_spots_between",
+    ),
+    path(
+        "parking-spots/<int:pk>/availability/",
+        views.spot_availability,
+        name="spot_availability",
+    ),
     path(
         "parking-spots/<int:pk>/",
         views.ParkingSpotDetail.as_view(),
@@ -28,6 +43,14 @@ urlpatterns = [
     ),
     # Booking endpoints
     path("bookings/", views.BookingList.as_view(), name="booking_list"),
+    path("bookings/allocate/", views.allocate_booking, name="allocate_booking"),
+    # Advance reservations
+    path("reservations/", views.reservation_list, name="reservation_list"),
+    path(
+        "reservations/<int:reservation_id>/cancel/",
+        views.cancel_reservation,
+        name="cancel_reservation",
+    ),
     path("bookings/<int:pk>/", views.BookingDetail.as_view(), name="booking_detail"),
     path(
         "bookings/<int:booking_id>/extend/", views.extend_booking, name="extend_booking"
@@ -79,6 +102,12 @@ urlpatterns = [
     path("wallet/", views.get_wallet, name="get_wallet"),
     path("wallet/top-up/", views.wallet_top_up, name="wallet_top_up"),
     path("wallet/charge/", views.wallet_charge, name="wallet_charge"),
+    path("wallet/statement/", views.wallet_statement, name="wallet_statement"),
+    path(
+        "wallet/statement/export/",
+        views.wallet_statement_export,
+        name="wallet_statement_export",
+    ),
     # LED/RGB status endpoints
     path(
         "parking-spots/<str:spot_number>/led-status/",
@@ -93,6 +122,11 @@ urlpatterns = [
         views.get_negative_balance_users_admin,
         name="admin_users_negative_balance",
     ),
+    path(
+        "admin/wallet/export/",
+        views.export_wallet_ledger_admin,
+        name="admin_wallet_export",
+    ),
     path("admin/users/create/", views.create_user_admin, name="create_user_admin"),
     path(
         "admin/users/<int:user_id>/update/",
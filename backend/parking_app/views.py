@@ -4,6 +4,7 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.models import User
 from django.db import transaction
@@ -16,6 +17,7 @@ from .models import (
     Payment,
     WalletTransaction,
     UserReport,
+    Reservation,
 )
 from .serializers import (
     UserSerializer,
@@ -26,68 +28,29 @@ from .serializers import (
     PaymentSerializer,
     WalletTransactionSerializer,
     UserReportSerializer,
+    booking_list_values,
+    parse_booking_fields,
+    serialize_booking_rows,
 )
 from .notifications import NotificationService
+from .overtime import notify_booking_scheduled
+from .bookings import BookingConflict, create_active_booking
+from .pagination import (
+    BookingKeysetPagination,
+    PaginationError,
+    date_bounds,
+    filter_bookings,
+    next_page_url,
+    paginate_bookings,
+    wants_page,
+)
+from . import geo, reservations, tariffs, wallet
+from .allocation import NoSpotAvailable, allocate_spot
 from decimal import Decimal, ROUND_HALF_UP
-
-
-def _progress_booking_billing(booking):
-    try:
-        from django.utils import timezone
-
-        now = timezone.now()
-        # Billing only during active timer window
-        if not booking.timer_started or booking.status != "active":
-            return
-        # Determine end threshold: if end_time == start_time, it's a pay-per-use booking (no fixed duration)
-        # In that case, bill until now (car hasn't left yet)
-        if booking.end_time == booking.start_time:
-            # Pay-per-use booking: bill until current time (car still parked)
-            bill_until = now
-        else:
-            # Fixed duration booking: bill until end_time or now, whichever is earlier
-            bill_until = min(now, booking.end_time)
-        # Initialize last_billing_at
-        if (
-            not booking.last_billing_at
-            or booking.last_billing_at < booking.timer_started
-        ):
-            booking.last_billing_at = booking.timer_started
-        if bill_until <= booking.last_billing_at:
-            return
-        elapsed_seconds = (bill_until - booking.last_billing_at).total_seconds()
-        # Billing unit: 30 seconds counts as 1 minute charge unit
-        billing_units = int(elapsed_seconds // 30)
-        if billing_units <= 0:
-            return
-        # Fixed pricing: $1 per 30 seconds (do not surface in UI)
-        # billing_units are 30-second units, so simply charge $1 per unit
-        amount = Decimal("1.00") * Decimal(billing_units)
-        amount = amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        # Deduct from wallet (allow negative)
-        profile, _ = UserProfile.objects.get_or_create(user=booking.user)
-        profile.balance = (profile.balance or Decimal("0.00")) - amount
-        profile.save()
-        # Record transaction
-        WalletTransaction.objects.create(
-            user=booking.user,
-            booking=booking,
-            type="parking_charge",
-            amount=amount,
-            method="Wallet",
-            note=f"Progressive deduction {billing_units} units (30s each)",
-        )
-        # Advance last_billing_at by whole minutes billed
-        from datetime import timedelta
-
-        booking.last_billing_at = booking.last_billing_at + timedelta(
-            seconds=30 * billing_units
-        )
-        booking.save(update_fields=["last_billing_at"])
-    except Exception as e:
-        print(
-            f"Billing progression error for booking {booking.id if booking else 'unknown'}: {e}"
-        )
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
 
 
 def deduct_from_wallet(user, booking, amount, note="Parking charge"):
@@ -111,26 +74,12 @@ def deduct_from_wallet(user, booking, amount, note="Parking charge"):
         if not isinstance(amount, Decimal):
             amount = Decimal(str(amount))
 
-        # Get or create user profile
-        profile, _ = UserProfile.objects.get_or_create(user=user)
-
-        # Calculate new balance (allow negative)
-        old_balance = profile.balance or Decimal("0.00")
-        new_balance = old_balance - amount
-
-        # Update profile balance
-        profile.balance = new_balance
-        profile.save()
-
-        # Create transaction record
-        transaction = WalletTransaction.objects.create(
-            user=user,
-            booking=booking,
-            type="parking_charge",
-            amount=amount,
-            method="Wallet",
-            note=note,
+        # Atomic debit + ledger entry (allows negative balance)
+        new_balance, transaction = wallet.debit(
+            user, amount, booking=booking, note=note
         )
+        amount = transaction.amount
+        old_balance = new_balance + amount
 
         # Check if balance went negative and create admin alert
         if new_balance < Decimal("0.00") and old_balance >= Decimal("0.00"):
@@ -171,34 +120,14 @@ def deduct_from_wallet(user, booking, amount, note="Parking charge"):
             "success": False,
             "error": str(e),
             "new_balance": (
-                profile.balance if "profile" in locals() else Decimal("0.00")
+                UserProfile.objects.filter(user=user)
+                .values_list("balance", flat=True)
+                .first()
+                or Decimal("0.00")
             ),
         }
 
 
-# Global variable to store the current booking's total cost
-CURRENT_BOOKING_TOTAL_COST = None
-
-
-def compute_final_cost_for_seconds(seconds: int) -> Decimal:
-    """
-    Global function to compute total cost at $1 per 30 seconds for a given elapsed seconds.
-    This ensures consistent pricing calculation across all functions.
-    """
-    from decimal import Decimal, ROUND_HALF_UP
-
-    per_second_local = Decimal("1") / Decimal("30")
-    total_cost = (per_second_local * Decimal(str(max(0, int(seconds))))).quantize(
-        Decimal("0.01"), rounding=ROUND_HALF_UP
-    )
-
-    # Store globally for access by other functions
-    global CURRENT_BOOKING_TOTAL_COST
-    CURRENT_BOOKING_TOTAL_COST = total_cost
-
-    return total_cost
-
-
 def trigger_esp32_booking_led(slot_number, led_state):
     """Trigger ESP32 LED control for booking status"""
     try:
@@ -306,7 +235,10 @@ def wallet_charge(request):
             note=note,
         )
 
-        profile, _ = UserProfile.objects.get_or_create(user=request.user)
+        if result.get("success"):
+            balance = result["new_balance"]
+        else:
+            balance = result.get("new_balance") or 0
         return Response(
             {
                 "message": (
@@ -316,7 +248,7 @@ def wallet_charge(request):
                 ),
                 "success": bool(result.get("success")),
                 "amount_deducted": float(result.get("amount_deducted") or 0),
-                "balance": float(profile.balance or 0),
+                "balance": float(balance),
                 "transaction_id": result.get("transaction_id"),
             },
             status=(
@@ -856,11 +788,13 @@ def detect_car_parked(request, booking_id):
                         print(
                             f"📱 [WhatsApp] Sending parked notification to {test_phone} for booking {booking.id}"
                         )
-                        result = send_whatsapp_message(test_phone, message)
+                        result = send_whatsapp_message(
+                            test_phone, message, booking=booking
+                        )
                         if result:
-                            print(f"✅ [WhatsApp] Notification sent successfully")
+                            print(f"✅ [WhatsApp] Notification queued")
                         else:
-                            print(f"⚠️ [WhatsApp] Notification failed to send")
+                            print(f"⚠️ [WhatsApp] Notification could not be queued")
                     except Exception as e:
                         print(f"⚠️ [WhatsApp] Failed to send notification: {e}")
                         import traceback
@@ -1319,7 +1253,8 @@ def update_user_profile(request):
                     print(
                         f"[update_user_profile] Updated address/car_name: {profile_data['car_name']}"
                     )
-            profile.save()
+            # Never write balance here: it would clobber concurrent wallet changes
+            profile.save(update_fields=["phone", "address", "updated_at"])
             print(f"[update_user_profile] Profile saved successfully")
 
         return Response(
@@ -1967,6 +1902,59 @@ class ParkingLotDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [AllowAny]
 
 
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def parking_lots_nearby(request):
+    """Nearest active lots with free spots (?lat=&lng=[&k=][&radius_km=])"""
+    try:
+        config = geo.get_search_config()
+        try:
+            lat = float(request.query_params["lat"])
+            lng = float(request.query_params["lng"])
+            k = int(request.query_params.get("k", config["default_k"]))
+            radius_km = request.query_params.get("radius_km")
+            radius_km = float(radius_km) if radius_km else None
+        except KeyError:
+            return Response(
+                {"error": "lat and lng are required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except ValueError:
+            return Response(
+                {"error": "invalid lat, lng, k or radius_km"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or k < 1:
+            return Response(
+                {"error": "invalid lat, lng, k or radius_km"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        matches = geo.nearby_lots_with_space(
+            lat, lng, min(k, config["max_k"]), max_km=radius_km
+        )
+        return Response(
+            [
+                {
+                    "id": lot.id,
+                    "name": lot.name,
+                    "address": lot.address,
+                    "latitude": lot.latitude,
+                    "longitude": lot.longitude,
+                    "distance_km": round(distance, 3),
+                    "spot_count": lot.spot_count,
+                    "available_spots": lot.available_spots,
+                    "hourly_rate": lot.hourly_rate,
+                }
+                for lot, distance in matches
+            ],
+            status=status.HTTP_200_OK,
+        )
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class ParkingSpotList(generics.ListCreateAPIView):
     queryset = ParkingSpot.objects.all()
     serializer_class = ParkingSpotSerializer
@@ -1983,63 +1971,50 @@ class BookingList(generics.ListCreateAPIView):
     serializer_class = BookingSerializer
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
-        user_bookings = Booking.objects.filter(user=self.request.user)
-        print(f"=== Fetching bookings for user {self.request.user.username} ===")
-        print(f"Found {user_bookings.count()} bookings")
-
-        # Check for expired bookings and mark them as completed
-        for booking in user_bookings.filter(status="active"):
-            if booking.mark_as_completed_if_expired():
-                print(f"  - Marked expired booking {booking.id} as completed")
-                # Handle LED control here to avoid circular imports
-                try:
-                    trigger_esp32_booking_led(booking.parking_spot.spot_number, False)
-                    print(
-                        f"🔵 Turned off blue LED for expired booking: {booking.parking_spot.spot_number}"
-                    )
-                except Exception as e:
-                    print(f"⚠️  Failed to turn off ESP32 LED: {e}")
+    pagination_class = BookingKeysetPagination
 
-        # Refresh the queryset after potential status changes
-        user_bookings = Booking.objects.filter(user=self.request.user)
-        for booking in user_bookings:
-            # Only run progressive billing for active bookings
-            if booking.status == "active":
-                try:
-                    _progress_booking_billing(booking)
-                except Exception as e:
-                    print(
-                        f"Wallet billing progression failed for booking {booking.id}: {e}"
-                    )
-            print(
-                f"  - Booking {booking.id}: {booking.parking_spot.spot_number} ({booking.status})"
-            )
-        return user_bookings
+    def get_queryset(self):
+        # Pure read: billing and expiry run in the background billing tick
+        # and overtime scheduler (autostarted with runserver), never on GET
+        bookings = Booking.objects.filter(user=self.request.user).select_related(
+            "parking_spot", "user__profile"
+        )
+        try:
+            return filter_bookings(bookings, self.request.query_params)
+        except PaginationError as e:
+            raise ParseError(str(e))
+
+    def list(self, request, *args, **kwargs):
+        if "fields" not in request.query_params:
+            return super().list(request, *args, **kwargs)
+        # ?fields= returns slim rows straight from values(), no nested serializers
+        fields = parse_booking_fields(request.query_params["fields"])
+        rows = booking_list_values(self.get_queryset(), fields)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serialize_booking_rows(page, fields))
+        return Response(serialize_booking_rows(rows, fields))
 
     def perform_create(self, serializer):
         try:
             print("=== Starting booking creation ===")
 
-            # Check if user already has an active booking
-            existing_active_booking = Booking.objects.filter(
-                user=self.request.user, status="active"
-            ).first()
-
-            if existing_active_booking:
-                print(f"User already has active booking: {existing_active_booking.id}")
-                raise serializers.ValidationError(
-                    {
-                        "non_field_errors": "You already have an active booking. Please cancel your current booking before making a new one."
-                    }
-                )
-
             # Get parking spot from parking_spot_id
             parking_spot_id = serializer.validated_data.get("parking_spot_id")
             print(f"Parking spot ID: {parking_spot_id}")
 
             try:
-                parking_spot = ParkingSpot.objects.get(id=parking_spot_id)
+                parking_spot = (
+                    ParkingSpot.objects.select_related("parking_lot")
+                    .only(
+                        "id",
+                        "spot_number",
+                        "is_occupied",
+                        "spot_type",
+                        "parking_lot__name",
+                    )
+                    .get(id=parking_spot_id)
+                )
                 print(f"Found parking spot: {parking_spot.spot_number}")
             except ParkingSpot.DoesNotExist:
                 print(f"Parking spot {parking_spot_id} not found")
@@ -2056,10 +2031,14 @@ class BookingList(generics.ListCreateAPIView):
                     }
                 )
 
-            # Balance check: require at least $1 (equivalent to 30 seconds)
-            min_required = 1.00
-            profile, _ = UserProfile.objects.get_or_create(user=self.request.user)
-            if float(profile.balance) < min_required:
+            # Balance check: require the price of the first billing unit
+            min_required = tariffs.minimum_balance(
+                tariffs.tariff_for_spot(parking_spot)
+            )
+            balance, number_plate = UserProfile.objects.filter(
+                user=self.request.user
+            ).values_list("balance", "number_plate").first() or (0, "")
+            if balance < min_required:
                 raise serializers.ValidationError(
                     {
                         "non_field_errors": "Insufficient funds. Please top up your wallet."
@@ -2076,26 +2055,45 @@ class BookingList(generics.ListCreateAPIView):
 
             default_window = now + timedelta(hours=12)
             booking_data = {
-                "user": self.request.user,
-                "parking_spot": parking_spot,
                 "start_time": now,
                 "end_time": default_window,
                 "duration_minutes": serializer.validated_data.get("duration_minutes", 0)
                 or 0,
                 "vehicle_name": serializer.validated_data.get("vehicle_name", ""),
-                "status": "active",
                 "grace_period_started": now,  # Start grace period; timer starts on detect
                 "timer_started": None,  # Timer will start when car is detected
-                "number_plate": (
-                    getattr(self.request.user.profile, "number_plate", "")
-                    if hasattr(self.request.user, "profile")
-                    else ""
-                ),
+                "number_plate": number_plate or "",
             }
 
+            # Single guarded insert: the one-active-booking constraints reject
+            # a second active booking for this user or spot, even under races
             print(f"Creating booking with data: {booking_data}")
-            booking = Booking.objects.create(**booking_data)
+            try:
+                booking = create_active_booking(
+                    self.request.user, parking_spot.id, **booking_data
+                )
+            except BookingConflict as conflict:
+                print(f"Booking conflict ({conflict.reason}): {conflict.existing.id}")
+                if conflict.reason == "user":
+                    raise serializers.ValidationError(
+                        {
+                            "non_field_errors": "You already have an active booking. Please cancel your current booking before making a new one."
+                        }
+                    )
+                if conflict.reason == "reservation":
+                    raise serializers.ValidationError(
+                        {
+                            "parking_spot_id": "This parking spot is reserved by another user and cannot be booked now."
+                        }
+                    )
+                raise serializers.ValidationError(
+                    {
+                        "parking_spot_id": "This parking spot is currently occupied and cannot be booked."
+                    }
+                )
+            booking.parking_spot = parking_spot
             print(f"✅ Booking created successfully: {booking.id}")
+            notify_booking_scheduled(booking)
             print(f"🕐 Grace period started at: {now}")
             print(
                 f"⏰ Timer will start when car is detected (within 20 seconds grace period)"
@@ -2118,6 +2116,236 @@ class BookingList(generics.ListCreateAPIView):
             raise
 
 
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def allocate_booking(request):
+    """Book any free spot of a type in a lot: {lot_id, spot_type?, vehicle_name?}"""
+    try:
+        lot_id = request.data.get("lot_id")
+        spot_type = request.data.get("spot_type") or "regular"
+        try:
+            lot_id = int(lot_id)
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "lot_id is required"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Balance check: require the price of the first billing unit
+        lot_name = (
+            ParkingLot.objects.filter(id=lot_id).values_list("name", flat=True).first()
+        )
+        balance, number_plate = UserProfile.objects.filter(
+            user=request.user
+        ).values_list("balance", "number_plate").first() or (0, "")
+        if balance < tariffs.minimum_balance(tariffs.get_tariff(lot_name, spot_type)):
+            return Response(
+                {"error": "Insufficient funds. Please top up your wallet."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        from django.utils import timezone
+        from datetime import timedelta
+
+        now = timezone.now()
+        try:
+            booking = allocate_spot(
+                request.user,
+                lot_id,
+                spot_type,
+                start_time=now,
+                end_time=now + timedelta(hours=12),
+                duration_minutes=0,
+                vehicle_name=request.data.get("vehicle_name", ""),
+                grace_period_started=now,  # Timer starts when the car is detected
+                timer_started=None,
+                number_plate=number_plate or "",
+            )
+        except NoSpotAvailable:
+            return Response(
+                {"error": f"No free {spot_type} spot in this parking lot"},
+                status=status.HTTP_409_CONFLICT,
+            )
+        except BookingConflict:
+            return Response(
+                {
+                    "error": "You already have an active booking. Please cancel your current booking before making a new one."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        print(
+            f"✅ Allocated spot {booking.parking_spot.spot_number} for booking {booking.id}"
+        )
+        notify_booking_scheduled(booking)
+        try:
+            trigger_esp32_booking_led(booking.parking_spot.spot_number, "blue")
+        except Exception as e:
+            print(f"⚠️  Failed to trigger ESP32 LED: {e}")
+
+        return Response(BookingSerializer(booking).data, status=status.HTTP_201_CREATED)
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _reservation_interval(params, names=("start", "end")):
+    """Aware (start, end) from two ISO datetime params; ValueError if invalid"""
+    from django.utils import timezone
+    from django.utils.dateparse import parse_datetime
+    from datetime import timedelta
+
+    bounds = []
+    for name in names:
+        moment = parse_datetime(str(params.get(name) or ""))
+        if moment is None:
+            raise ValueError(f"'{name}' must be an ISO datetime")
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        bounds.append(moment)
+    start, end = bounds
+    if end <= start:
+        raise ValueError(f"'{names[1]}' must be after '{names[0]}'")
+    max_days = reservations.get_reservation_config()["max_days_ahead"]
+    if end > timezone.now() + timedelta(days=max_days):
+        raise ValueError(f"Reservations can be made up to {max_days} days ahead")
+    return start, end
+
+
+def _reservation_data(reservation):
+    return {
+        "id": reservation.id,
+        "parking_spot_id": reservation.parking_spot_id,
+        "start_time": reservation.start_time,
+        "end_time": reservation.end_time,
+        "status": reservation.status,
+    }
+
+
+@api_view(["GET", "POST"])
+@permission_classes([IsAuthenticated])
+def reservation_list(request):
+    """Upcoming reservations (GET) or reserve a spot ahead (POST)"""
+    try:
+        from django.utils import timezone
+
+        if request.method == "GET":
+            upcoming = Reservation.objects.filter(
+                user=request.user, status="confirmed", end_time__gt=timezone.now()
+            ).order_by("start_time")
+            return Response(
+                [_reservation_data(r) for r in upcoming], status=status.HTTP_200_OK
+            )
+
+        try:
+            spot_id = int(request.data.get("parking_spot_id"))
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "parking_spot_id is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            start, end = _reservation_interval(request.data, ("start_time", "end_time"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if start < timezone.now():
+            return Response(
+                {"error": "Reservations must start in the future"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            reservation = reservations.reserve(request.user, spot_id, start, end)
+        except ParkingSpot.DoesNotExist:
+            return Response(
+                {"error": "Parking spot not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        except reservations.ReservationConflict as conflict:
+            if conflict.reason == "booking":
+                return Response(
+                    {
+                        "error": "This parking spot is booked for part of that time",
+                        "conflicting_booking": conflict.existing,
+                    },
+                    status=status.HTTP_409_CONFLICT,
+                )
+            return Response(
+                {
+                    "error": "This parking spot is already reserved for part of that time",
+                    "conflicting_reservation": conflict.existing,
+                },
+                status=status.HTTP_409_CONFLICT,
+            )
+        print(f"📅 Reservation {reservation.id} for spot {spot_id}: {start} - {end}")
+        return Response(_reservation_data(reservation), status=status.HTTP_201_CREATED)
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def cancel_reservation(request, reservation_id):
+    """Cancel one of the user's confirmed reservations"""
+    try:
+        reservation = Reservation.objects.filter(
+            id=reservation_id, user=request.user, status="confirmed"
+        ).first()
+        if reservation is None:
+            return Response(
+                {"error": "Reservation not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        reservations.cancel(reservation)
+        return Response(_reservation_data(reservation), status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def spot_availability(request, pk):
+    """Is the spot free of reservations and bookings during ?start=&end=?"""
+    try:
+        try:
+            start, end = _reservation_interval(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {
+                "parking_spot_id": pk,
+                "start": start,
+                "end": end,
+                "is_free": reservations.is_spot_free(pk, start, end),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def available_spots_between(request):
+    """Spots free of reservations and bookings during ?start=&end= [&lot_id=][&spot_type=]"""
+    try:
+        try:
+            start, end = _reservation_interval(request.query_params)
+            lot_id = request.query_params.get("lot_id")
+            lot_id = int(lot_id) if lot_id else None
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        spots = reservations.free_spots(
+            start, end, lot_id=lot_id, spot_type=request.query_params.get("spot_type")
+        )
+        return Response(
+            {"start": start, "end": end, "spots": spots}, status=status.HTTP_200_OK
+        )
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class BookingDetail(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = BookingSerializer
     permission_classes = [IsAuthenticated]
@@ -2149,6 +2377,142 @@ def get_wallet(request):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+STATEMENT_COLUMNS = [
+    "id",
+    "created_at",
+    "type",
+    "amount",
+    "delta",
+    "balance_after",
+    "method",
+    "note",
+    "booking",
+]
+
+
+def _statement_row(row):
+    """JSON shape of a wallet statement row (amounts as floats)"""
+    return {
+        "id": row["id"],
+        "created_at": row["created_at"],
+        "type": row["type"],
+        "amount": float(row["amount"] or 0),
+        "delta": float(row["delta"] or 0),
+        "balance_after": float(row["balance_after"] or 0),
+        "method": row["method"],
+        "note": row["note"],
+        "booking": row["booking_id"],
+    }
+
+
+class _Echo:
+    """File-like object whose write() returns the line for streaming"""
+
+    def write(self, value):
+        return value
+
+
+def _stream_statement(rows, output, filename, with_user=False):
+    """StreamingHttpResponse rendering statement rows as CSV or NDJSON"""
+    columns = (["user_id"] if with_user else []) + STATEMENT_COLUMNS
+
+    def shape(row):
+        data = _statement_row(row)
+        if with_user:
+            data = {"user_id": row["user_id"], **data}
+        return data
+
+    if output == "ndjson":
+        lines = (json.dumps(shape(row), cls=DjangoJSONEncoder) + "\n" for row in rows)
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+    else:
+        writer = csv.writer(_Echo())
+
+        def lines():
+            yield writer.writerow(columns)
+            for row in rows:
+                data = shape(row)
+                data["created_at"] = data["created_at"].isoformat()
+                yield writer.writerow([data[column] for column in columns])
+
+        response = StreamingHttpResponse(lines(), content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{output}"'
+    return response
+
+
+def _export_request(request):
+    """(output, since, until) from export query params; raises PaginationError"""
+    output = request.query_params.get("output", "csv").lower()
+    if output not in ("csv", "ndjson"):
+        raise PaginationError("Invalid 'output' (use csv or ndjson)")
+    since, until = date_bounds(request.query_params)
+    return output, since, until
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def wallet_statement(request):
+    """Paginated wallet statement with the balance after each transaction.
+
+    Query params: cursor, page_size, from, to (dates or ISO datetimes).
+    """
+    try:
+        rows, next_cursor, closing = wallet.statement_page(
+            request.user.id, request.query_params
+        )
+        return Response(
+            {
+                "closing_balance": float(closing),
+                "next": next_page_url(request, next_cursor),
+                "next_cursor": next_cursor,
+                "results": [_statement_row(row) for row in rows],
+            }
+        )
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def wallet_statement_export(request):
+    """Stream the user's whole statement (?output=csv|ndjson, from, to)"""
+    try:
+        output, since, until = _export_request(request)
+        rows = wallet.iter_statement(request.user.id, since, until)
+        return _stream_statement(rows, output, "wallet-statement")
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_wallet_ledger_admin(request):
+    """Stream every user's ledger with running balances (admin/staff only).
+
+    Query params: output (csv|ndjson), from, to, user_id.
+    """
+    try:
+        if not (request.user.is_superuser or request.user.is_staff):
+            return Response(
+                {"error": "Admin or staff access required"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        output, since, until = _export_request(request)
+        user_id = request.query_params.get("user_id")
+        if user_id is not None and not user_id.isdigit():
+            raise PaginationError("Invalid 'user_id'")
+        rows = wallet.iter_statement(int(user_id) if user_id else None, since, until)
+        return _stream_statement(rows, output, "wallet-ledger", with_user=True)
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def wallet_top_up(request):
@@ -2170,15 +2534,10 @@ def wallet_top_up(request):
                 {"error": "Amount must be positive"}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        profile, _ = UserProfile.objects.get_or_create(user=request.user)
-
-        profile.balance = (profile.balance or Decimal("0.00")) + amount
-        profile.save()
-
-        WalletTransaction.objects.create(
-            user=request.user,
+        new_balance, _ = wallet.credit(
+            request.user,
+            amount,
             type="topup",
-            amount=amount,
             method=method or "Unknown",
             note="User wallet top-up",
         )
@@ -2186,7 +2545,7 @@ def wallet_top_up(request):
         return Response(
             {
                 "message": f"You've successfully loaded ${amount.quantize(Decimal('0.01'))} via {method}",
-                "balance": float(profile.balance or Decimal("0.00")),
+                "balance": float(new_balance),
             },
             status=status.HTTP_200_OK,
         )
@@ -2204,93 +2563,101 @@ def complete_active_booking(request, booking_id):
     Always returns final total and updated wallet balance.
     """
     try:
+        from datetime import timedelta
         from django.utils import timezone
         from decimal import Decimal
 
-        booking = Booking.objects.get(id=booking_id, user=request.user)
+        with transaction.atomic():
+            # Locked so a concurrent billing tick cannot charge the same span
+            booking = Booking.objects.select_for_update().get(
+                id=booking_id, user=request.user
+            )
 
-        # Use global function to compute total cost at $1 per 30 seconds
+            # Determine elapsed seconds depending on status
+            if booking.timer_started is None:
+                # If timer never started, start it now and calculate cost from booking creation
+                now = timezone.now()
+                # Use start_time as the timer start if timer_started is missing
+                timer_start = booking.start_time or now
+                booking.timer_started = timer_start
+                print(
+                    f"⚠️ Timer never started for booking {booking_id}, using start_time as timer_started: {timer_start}"
+                )
 
-        # Determine elapsed seconds depending on status
-        if booking.timer_started is None:
-            # If timer never started, start it now and calculate cost from booking creation
+            # Calculate elapsed time and complete the booking
             now = timezone.now()
-            # Use start_time as the timer start if timer_started is missing
-            timer_start = booking.start_time or now
-            booking.timer_started = timer_start
-            booking.save()
-            print(
-                f"⚠️ Timer never started for booking {booking_id}, using start_time as timer_started: {timer_start}"
+            elapsed_seconds = max(0, int((now - booking.timer_started).total_seconds()))
+            final_cost = tariffs.session_cost(
+                booking.timer_started,
+                booking.timer_started + timedelta(seconds=elapsed_seconds),
+                booking.parking_spot,
             )
 
-        # Calculate elapsed time and complete the booking
-        now = timezone.now()
-        elapsed_seconds = max(0, int((now - booking.timer_started).total_seconds()))
-        final_cost = compute_final_cost_for_seconds(elapsed_seconds)
-
-        # Mark booking completed and persist completion details
-        booking.completed_at = now
-        booking.end_time = now
-        booking.status = "completed"
-        # Persist duration in minutes from timer start to completion
-        try:
-            booking.duration_minutes = int(elapsed_seconds // 60)
-        except Exception:
-            pass
-
-        # Calculate total amount to deduct
-        # Sum already deducted parking_charge txns for this booking
-        deducted_total = Decimal("0.00")
-        transactions = WalletTransaction.objects.filter(
-            user=request.user, booking=booking, type="parking_charge"
-        )
-        print(
-            f"🔍 Found {transactions.count()} parking charge transactions for booking {booking.id}"
-        )
-        for tx in transactions:
+            # Mark booking completed and persist completion details
+            booking.completed_at = now
+            booking.end_time = now
+            booking.status = "completed"
+            # Persist duration in minutes from timer start to completion
             try:
-                deducted_total += Decimal(str(tx.amount))
-                print(f"🔍 Transaction {tx.id}: ${tx.amount} - Note: {tx.note}")
-            except Exception as e:
-                print(f"🔍 Error processing transaction {tx.id}: {e}")
-                continue
-        print(f"🔍 Total already deducted: ${deducted_total}")
-
-        # Calculate remaining amount to deduct
-        remaining_to_deduct = (final_cost - deducted_total).quantize(
-            Decimal("0.01"), rounding=ROUND_HALF_UP
-        )
+                booking.duration_minutes = int(elapsed_seconds // 60)
+            except Exception:
+                pass
+            # Stop the timer before reading the charged total: billing ticks
+            # only bill active bookings, and on SQLite (no FOR UPDATE) this
+            # write is what serializes us with a tick already in flight
+            booking.save(
+                update_fields=[
+                    "timer_started",
+                    "completed_at",
+                    "end_time",
+                    "status",
+                    "duration_minutes",
+                    "updated_at",
+                ]
+            )
 
-        print(
-            f"🔍 Deduction calculation: Final cost: ${final_cost}, Already deducted: ${deducted_total}, Remaining: ${remaining_to_deduct}"
-        )
-        print(f"🔍 Total amount to return: ${deducted_total + remaining_to_deduct}")
+            # Calculate total amount to deduct
+            # Already-charged total is maintained on the booking with each
+            # debit; re-read it since a tick may have committed since the load
+            booking.refresh_from_db(fields=["charged_total"])
+            deducted_total = wallet.booking_charged_total(booking)
+            print(f"🔍 Total already deducted: ${deducted_total}")
 
-        # Deduct remaining amount using our new function
-        deduction_result = None
-        if remaining_to_deduct > Decimal("0.00"):
-            deduction_result = deduct_from_wallet(
-                user=request.user,
-                booking=booking,
-                amount=remaining_to_deduct,
-                note=f"Final parking charge - {elapsed_seconds}s at $1/30s",
+            # Calculate remaining amount to deduct
+            remaining_to_deduct = (final_cost - deducted_total).quantize(
+                Decimal("0.01"), rounding=ROUND_HALF_UP
             )
+
             print(
-                f"💳 Final deduction: ${remaining_to_deduct}, Success: {deduction_result['success']}"
+                f"🔍 Deduction calculation: Final cost: ${final_cost}, Already deducted: ${deducted_total}, Remaining: ${remaining_to_deduct}"
             )
+            print(f"🔍 Total amount to return: ${deducted_total + remaining_to_deduct}")
 
-        # Get current balance for response (refresh after any deductions)
-        profile, _ = UserProfile.objects.get_or_create(user=request.user)
-        profile.refresh_from_db()
-        current_balance = profile.balance or Decimal("0.00")
+            # Deduct remaining amount using our new function
+            deduction_result = None
+            if remaining_to_deduct > Decimal("0.00"):
+                deduction_result = deduct_from_wallet(
+                    user=request.user,
+                    booking=booking,
+                    amount=remaining_to_deduct,
+                    note=f"Final parking charge - {elapsed_seconds}s",
+                )
+                print(
+                    f"💳 Final deduction: ${remaining_to_deduct}, Success: {deduction_result['success']}"
+                )
 
-        print(
-            f"💰 Final booking cost: ${final_cost}, Balance after deduction: ${current_balance}"
-        )
+            # Get current balance for response (refresh after any deductions)
+            profile, _ = UserProfile.objects.get_or_create(user=request.user)
+            profile.refresh_from_db()
+            current_balance = profile.balance or Decimal("0.00")
 
-        # Persist final total_cost and completion details
-        booking.total_cost = float(CURRENT_BOOKING_TOTAL_COST or final_cost)
-        booking.save()
+            print(
+                f"💰 Final booking cost: ${final_cost}, Balance after deduction: ${current_balance}"
+            )
+
+            # Persist final total_cost (charged_total is kept by the debits)
+            booking.total_cost = float(final_cost)
+            booking.save(update_fields=["total_cost", "updated_at"])
 
         # Free up the parking spot after completion (CRITICAL: must happen after booking.save())
         try:
@@ -2331,7 +2698,7 @@ def complete_active_booking(request, booking_id):
                     f"🚗 You left the slot!\n\n"
                     f"📍 Slot: {slot_name}\n"
                     f"⏱️ Duration: {duration_minutes}m {duration_seconds}s\n"
-                    f"💰 Amount charged: ${float(CURRENT_BOOKING_TOTAL_COST or final_cost):.2f}\n"
+                    f"💰 Amount charged: ${float(final_cost):.2f}\n"
                     f"💳 Balance: ${float(current_balance):.2f}\n"
                     f"🟢 LED changed to GREEN (slot available)\n\n"
                     f"✅ Thank you for using Smart Parking! 🚗"
@@ -2341,9 +2708,9 @@ def complete_active_booking(request, booking_id):
                 )
                 result = send_whatsapp_message(test_phone, message)
                 if result:
-                    print(f"✅ [WhatsApp] Notification sent successfully")
+                    print(f"✅ [WhatsApp] Notification queued")
                 else:
-                    print(f"⚠️ [WhatsApp] Notification failed to send")
+                    print(f"⚠️ [WhatsApp] Notification could not be queued")
             except Exception as e:
                 print(f"⚠️ [WhatsApp] Failed to send notification: {e}")
                 import traceback
@@ -2354,12 +2721,12 @@ def complete_active_booking(request, booking_id):
             {
                 "message": "Booking completed",
                 "elapsed_seconds": elapsed_seconds,
-                "total_cost": float(CURRENT_BOOKING_TOTAL_COST or final_cost),
+                "total_cost": float(final_cost),
                 "status": "completed",
                 "balance": float(current_balance),
                 "deduction": {
                     "amount_deducted": float(
-                        CURRENT_BOOKING_TOTAL_COST or final_cost
+                        final_cost
                     ),  # Always return the total cost as amount deducted
                     "remaining_deducted": float(
                         remaining_to_deduct
@@ -2764,9 +3131,12 @@ def detect_car_parked(request, booking_id):
 def get_parking_stats(request):
     """Get parking statistics for home screen"""
     try:
-        # Get total parking spots
-        total_spots = ParkingSpot.objects.count()
-        available_spots = ParkingSpot.objects.filter(is_occupied=False).count()
+        # Spot totals from the per-lot counters (no COUNT over spots)
+        counters = ParkingLot.objects.values_list("spot_count", "occupied_count")
+        total_spots = available_spots = 0
+        for spot_count, occupied_count in counters:
+            total_spots += spot_count
+            available_spots += spot_count - occupied_count
 
         # Get total bookings
         total_bookings = Booking.objects.count()
@@ -2976,44 +3346,72 @@ def get_all_bookings_admin(request):
             )
 
         # Get all bookings with related user, profile, and parking spot data
-        bookings = (
-            Booking.objects.select_related("user", "parking_spot", "user__profile")
-            .all()
-            .order_by("-created_at")
+        bookings = Booking.objects.select_related(
+            "user", "parking_spot", "user__profile"
         )
+        fields = None
+        try:
+            bookings = filter_bookings(bookings, request.query_params)
+            # ?fields= selects slim values() rows instead of the nested records
+            if "fields" in request.query_params:
+                fields = parse_booking_fields(request.query_params["fields"])
+                bookings = booking_list_values(bookings, fields)
+            # ?cursor= / ?page_size= return one keyset page instead of everything
+            if wants_page(request.query_params):
+                bookings, next_cursor = paginate_bookings(
+                    bookings, request.query_params
+                )
+            else:
+                bookings = bookings.order_by("-created_at")
+        except PaginationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except serializers.ValidationError as e:
+            return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+
+        if fields is not None:
+            results = serialize_booking_rows(bookings, fields)
+        else:
+            results = []
+            for b in bookings:
+                user_profile = getattr(b.user, "profile", None)
+                user_address = (
+                    getattr(user_profile, "address", None) if user_profile else None
+                )
+                results.append(
+                    {
+                        "id": b.id,
+                        "user": {
+                            "id": b.user.id,
+                            "username": b.user.username,
+                            "email": b.user.email,
+                            "first_name": b.user.first_name,
+                            "last_name": b.user.last_name,
+                            "address": user_address,
+                        },
+                        "parking_spot": {
+                            "id": b.parking_spot.id,
+                            "spot_number": b.parking_spot.spot_number,
+                            "spot_type": b.parking_spot.spot_type,
+                        },
+                        "start_time": b.start_time,
+                        "end_time": b.end_time,
+                        "duration_minutes": b.duration_minutes,
+                        "status": b.status,
+                        "total_cost": b.total_cost,
+                        "created_at": b.created_at,
+                        "updated_at": b.updated_at,
+                    }
+                )
 
-        results = []
-        for b in bookings:
-            user_profile = getattr(b.user, "profile", None)
-            user_address = (
-                getattr(user_profile, "address", None) if user_profile else None
-            )
-            results.append(
+        if wants_page(request.query_params):
+            return Response(
                 {
-                    "id": b.id,
-                    "user": {
-                        "id": b.user.id,
-                        "username": b.user.username,
-                        "email": b.user.email,
-                        "first_name": b.user.first_name,
-                        "last_name": b.user.last_name,
-                        "address": user_address,
-                    },
-                    "parking_spot": {
-                        "id": b.parking_spot.id,
-                        "spot_number": b.parking_spot.spot_number,
-                        "spot_type": b.parking_spot.spot_type,
-                    },
-                    "start_time": b.start_time,
-                    "end_time": b.end_time,
-                    "duration_minutes": b.duration_minutes,
-                    "status": b.status,
-                    "total_cost": b.total_cost,
-                    "created_at": b.created_at,
-                    "updated_at": b.updated_at,
-                }
+                    "next": next_page_url(request, next_cursor),
+                    "next_cursor": next_cursor,
+                    "results": results,
+                },
+                status=status.HTTP_200_OK,
             )
-
         return Response(results, status=status.HTTP_200_OK)
 
     except Exception as e:
@@ -3274,7 +3672,11 @@ def get_all_users_admin(request):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_negative_balance_users_admin(request):
-    """Get users with negative wallet balances for admin users (superusers and staff)"""
+    """Get users with negative wallet balances for admin users (superusers and staff).
+
+    With ``?as_of=YYYY-MM-DD`` returns the balances at the end of that day and
+    their total instead of the current ones.
+    """
     try:
         # Check if user is admin or staff
         if not (request.user.is_superuser or request.user.is_staff):
@@ -3294,13 +3696,30 @@ def get_negative_balance_users_admin(request):
             .order_by("profile__balance")
         )
 
+        # ?as_of=YYYY-MM-DD: balances at the end of that day (from snapshots)
+        as_of = None
+        if request.query_params.get("as_of"):
+            try:
+                _, as_of = date_bounds({"to": request.query_params["as_of"]})
+            except PaginationError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            historical = (
+                wallet.with_historical_balance(UserProfile.objects.all(), as_of)
+                .filter(historical_balance__lt=0)
+                .values("user_id", "historical_balance")
+            )
+            balances = {row["user_id"]: row["historical_balance"] for row in historical}
+            users_with_negative_balance = sorted(
+                User.objects.filter(id__in=balances).select_related("profile"),
+                key=lambda user: balances[user.id],
+            )
+
         negative_users_data = []
         for user in users_with_negative_balance:
             try:
                 profile = user.profile
-                wallet_balance = (
-                    float(profile.balance) if profile and profile.balance else 0.0
-                )
+                balance = balances[user.id] if as_of else profile.balance
+                wallet_balance = float(balance) if profile and balance else 0.0
 
                 # Get number plate from profile
                 number_plate = None
@@ -3333,6 +3752,15 @@ def get_negative_balance_users_admin(request):
                 print(f"Error processing user {user.username}: {e}")
                 continue
 
+        if as_of:
+            return Response(
+                {
+                    "as_of": as_of,
+                    "total_negative_balance": float(sum(balances.values())),
+                    "users": negative_users_data,
+                },
+                status=status.HTTP_200_OK,
+            )
         return Response(negative_users_data, status=status.HTTP_200_OK)
 
     except Exception as e:
@@ -3885,15 +4313,18 @@ def update_user_admin(request, user_id):
                 profile.phone = request.data.get("phone") or None
                 print(f"[update_user_admin] Updated phone: {profile.phone}")
 
-            # Update wallet balance
+            # Balance is written by the ledger below, never from this stale copy
+            profile.save(update_fields=["address", "phone", "updated_at"])
+
+            # Update wallet balance (recorded as an adjustment in the ledger)
             if "balance" in request.data:
                 try:
-                    profile.balance = request.data.get("balance") or 0
-                    print(f"[update_user_admin] Updated balance: {profile.balance}")
+                    new_balance, _ = wallet.set_balance(
+                        user, request.data.get("balance") or 0
+                    )
+                    print(f"[update_user_admin] Updated balance: {new_balance}")
                 except Exception as e:
                     print(f"[update_user_admin] Could not set balance: {e}")
-
-            profile.save()
         except Exception as e:
             print(f"Warning: could not update user profile: {e}")
 
@@ -4597,7 +5028,7 @@ def reset_user_password_admin(request, user_id):
             from django.utils import timezone
 
             profile.last_password_reset = timezone.now()
-            profile.save()
+            profile.save(update_fields=["last_password_reset", "updated_at"])
         except Exception as e:
             print(f"Warning: Could not update password reset timestamp: {e}")
 
@@ -5486,7 +5917,7 @@ def forgot_password(request):
         from django.utils import timezone
 
         profile.last_password_reset = timezone.now()
-        profile.save()
+        profile.save(update_fields=["last_password_reset", "updated_at"])
 
         print(
             f"✅ Password reset successful for user {user.username} (ID: {user.id}) via forgot password"
@@ -6121,76 +6552,26 @@ def detect_car_parked(request, booking_id):
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-def check_if_car_still_parked(parking_spot):
-    """Check if a car is still parked in the spot using the same logic as home page"""
-    try:
-        from iot_integration.models import IoTDevice, SensorData
-        from django.utils import timezone
-        from datetime import timedelta
+def check_if_car_still_parked(parking_spot, snapshot=None):
+    """Check if a car is still parked in the spot using the same logic as home page.
 
-        # Use the same logic as get_parking_availability
-        # Check for recent sensor data (within last 60 seconds)
-        recent_sensor_data = SensorData.objects.filter(
-            timestamp__gte=timezone.now() - timedelta(seconds=60)
-        ).exists()
+    Sweeps over many bookings pass one shared ``OccupancySnapshot``.
+    """
+    try:
+        from iot_integration.occupancy import OccupancySnapshot
 
-        if not recent_sensor_data:
-            # No recent sensor data - ESP32 is offline, use parking spot status
+        snapshot = snapshot or OccupancySnapshot.take()
+        reading = snapshot.sensor_reading(parking_spot.spot_number)
+        if reading is None:
+            # No fresh sensor data (ESP32 offline): use parking spot status
             print(
-                f"⚠️  No recent sensor data for {parking_spot.spot_number}, using parking spot status"
+                f"⚠️  Using parking spot status for {parking_spot.spot_number}: {'Occupied' if parking_spot.is_occupied else 'Available'}"
             )
             return parking_spot.is_occupied
-
-        # ESP32 is online - get real-time data using same logic as home page
-        devices = IoTDevice.objects.filter(is_active=True).order_by("id")
-
-        # Map slot names to device indices (same as home page logic)
-        slot_mapping = {"Slot A": 0, "Slot B": 1}
-        device_index = slot_mapping.get(parking_spot.spot_number)
-
-        if device_index is not None and device_index < devices.count():
-            device = devices[device_index]
-            latest_data = (
-                SensorData.objects.filter(device=device).order_by("-timestamp").first()
-            )
-
-            if latest_data:
-                # Check if sensor data is recent (within last 60 seconds)
-                time_diff = timezone.now() - latest_data.timestamp
-                if time_diff.total_seconds() < 60:
-                    # Use the dual sensor data if available (same as home page)
-                    if (
-                        hasattr(latest_data, "slot1_occupied")
-                        and latest_data.slot1_occupied is not None
-                    ):
-                        if device_index == 0:  # Slot A
-                            is_occupied = latest_data.slot1_occupied
-                        elif device_index == 1:  # Slot B
-                            is_occupied = (
-                                latest_data.slot2_occupied
-                                if hasattr(latest_data, "slot2_occupied")
-                                else latest_data.is_occupied
-                            )
-                        else:
-                            is_occupied = latest_data.is_occupied
-                    else:
-                        # Fallback to general occupancy
-                        is_occupied = latest_data.is_occupied
-
-                    print(
-                        f"🔍 IoT Sensor check for {parking_spot.spot_number}: {'Occupied' if is_occupied else 'Available'} (device {device_index})"
-                    )
-                    return is_occupied
-                else:
-                    print(
-                        f"⚠️  Sensor data too old for {parking_spot.spot_number} ({time_diff.total_seconds():.0f}s ago)"
-                    )
-
-        # Fallback: use parking spot status (which should be updated by get_parking_availability)
         print(
-            f"⚠️  Using parking spot status for {parking_spot.spot_number}: {'Occupied' if parking_spot.is_occupied else 'Available'}"
+            f"🔍 IoT Sensor check for {parking_spot.spot_number}: {'Occupied' if reading else 'Available'}"
         )
-        return parking_spot.is_occupied
+        return reading
 
     except Exception as e:
         print(f"⚠️  Error checking car occupancy for {parking_spot.spot_number}: {e}")
@@ -6608,79 +6989,14 @@ def detect_car_parked(request, booking_id):
 def check_all_overtime_bookings(request):
     """Check all active bookings for overtime - can be called periodically"""
     try:
-        # Get all active bookings that have expired
-        from django.utils import timezone
-
-        expired_bookings = Booking.objects.filter(status="active").exclude(
-            end_time__gt=timezone.now()
-        )
-
-        processed_bookings = []
-
-        for booking in expired_bookings:
-            try:
-                # Calculate overtime
-                overtime_minutes, overtime_cost = booking.calculate_overtime()
-
-                if overtime_minutes > 0:
-                    # Update overtime billing
-                    booking.update_overtime_billing()
-
-                    # Check if car is still parked
-                    is_still_parked = check_if_car_still_parked(booking.parking_spot)
-
-                    if is_still_parked:
-                        # Send overtime alert notification
-                        NotificationService.send_overtime_alert(booking)
-
-                        processed_bookings.append(
-                            {
-                                "booking_id": booking.id,
-                                "spot_number": booking.parking_spot.spot_number,
-                                "overtime_minutes": overtime_minutes,
-                                "overtime_cost": float(overtime_cost),
-                                "total_cost_with_overtime": float(
-                                    booking.total_cost or 0
-                                )
-                                + float(overtime_cost),
-                                "status": "overtime_billing",
-                            }
-                        )
-                    else:
-                        # Car has left, complete the booking
-                        # Update total cost to include overtime
-                        base_cost = float(booking.total_cost or 0)
-                        booking.total_cost = base_cost + float(overtime_cost)
-
-                        booking.status = "completed"
-                        booking.save()
+        # Get all active bookings that have expired (shared with the scheduler)
+        from .overtime import expired_active_bookings, process_overtime_bookings
 
-                        # Send completion notification
-                        NotificationService.send_booking_completion_notification(
-                            booking
-                        )
-
-                        # Trigger ESP32 to turn off red light
-                        trigger_esp32_booking_led(
-                            booking.parking_spot.spot_number, False
-                        )
-
-                        processed_bookings.append(
-                            {
-                                "booking_id": booking.id,
-                                "spot_number": booking.parking_spot.spot_number,
-                                "overtime_minutes": overtime_minutes,
-                                "overtime_cost": float(overtime_cost),
-                                "total_cost_with_overtime": float(
-                                    booking.total_cost or 0
-                                )
-                                + float(overtime_cost),
-                                "status": "completed",
-                            }
-                        )
-
-            except Exception as e:
-                print(f"Error processing booking {booking.id}: {e}")
+        processed_bookings = process_overtime_bookings(expired_active_bookings())
+        for result in processed_bookings:
+            result["total_cost_with_overtime"] = (
+                result.pop("total_cost") + result["overtime_cost"]
+            )
 
         return Response(
             {
@@ -0,0 +1,512 @@
+"""
+Wallet ledger service
+Applies balance changes atomically in the database (balance = balance + delta)
+instead of read-modify-write in Python, so concurrent billing, charges and
+top-ups cannot lose updates. Each change records its WalletTransaction in the
+same transaction and returns the new balance without re-reading the profile.
+Statements derive the balance after every ledger row with a window function,
+anchored on the stored balance, and page or stream newest first. Nightly
+end-of-day snapshots make a past balance one snapshot lookup plus the (usually
+empty) ledger delta since it.
+"""
+
+import sqlite3
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from django.db import connection, transaction
+from django.db.models import (
+    Case,
+    Count,
+    DateTimeField,
+    DecimalField,
+    Exists,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+    Window,
+)
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Booking, UserProfile, WalletBalanceSnapshot, WalletTransaction
+from .pagination import (
+    CURSOR_PARAM,
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    PaginationError,
+    date_bounds,
+    decode_cursor,
+    encode_cursor,
+    older_than,
+    ordered,
+    page_size_from,
+)
+
+CENTS = Decimal("0.01")
+# Ledger types that count towards a booking's charged total (adjustments refund)
+BOOKING_LEDGER_TYPES = ["parking_charge", "adjustment"]
+MONEY = DecimalField(max_digits=10, decimal_places=2)
+STATEMENT_FIELDS = [
+    "id",
+    "user_id",
+    "type",
+    "amount",
+    "method",
+    "note",
+    "booking_id",
+    "created_at",
+]
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _to_amount(amount):
+    if not isinstance(amount, Decimal):
+        amount = Decimal(str(amount))
+    return amount.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def _supports_update_returning():
+    if connection.vendor == "postgresql":
+        return True
+    # SQLite gained UPDATE ... RETURNING in 3.35
+    return connection.vendor == "sqlite" and sqlite3.sqlite_version_info >= (3, 35)
+
+
+def _add_to_balance(user_id, delta):
+    """Atomically add ``delta`` to a profile balance; None if no profile exists"""
+    if _supports_update_returning():
+        table = connection.ops.quote_name(UserProfile._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET balance = balance + %s WHERE user_id = %s "
+                f"RETURNING balance",
+                [delta, user_id],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return Decimal(str(row[0])).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+    updated = UserProfile.objects.filter(user_id=user_id).update(
+        balance=F("balance") + delta
+    )
+    if not updated:
+        return None
+    return UserProfile.objects.values_list("balance", flat=True).get(user_id=user_id)
+
+
+def _net_charge():
+    """Signed ledger amount: charges add, booking adjustments refund"""
+    return Case(
+        When(type="adjustment", then=-F("amount")),
+        default=F("amount"),
+        output_field=MONEY,
+    )
+
+
+def _ledger_charged_total():
+    """Subquery rebuilding a booking's net charges from its ledger rows"""
+    totals = (
+        WalletTransaction.objects.filter(
+            booking_id=OuterRef("pk"), type__in=BOOKING_LEDGER_TYPES
+        )
+        .order_by()
+        .values("booking_id")
+        .annotate(total=Sum(_net_charge()))
+        .values("total")[:1]
+    )
+    return Coalesce(Subquery(totals), Value(Decimal("0.00")), output_field=MONEY)
+
+
+def charged_total_increment(amount):
+    """Expression adding ``amount`` to Booking.charged_total.
+
+    ``amount`` may itself be an expression (e.g. a Case with one amount per
+    booking for bulk updates). Untracked (legacy, NULL) bookings are rebuilt
+    from the ledger instead; the ledger row for this change must already be
+    inserted.
+    """
+    if not hasattr(amount, "resolve_expression"):
+        amount = Value(amount)
+    return Case(
+        When(charged_total__isnull=True, then=_ledger_charged_total()),
+        default=F("charged_total") + amount,
+        output_field=MONEY,
+    )
+
+
+def booking_charged_total(booking):
+    """Net amount charged for a booking: maintained total, or the ledger sum"""
+    if booking.charged_total is not None:
+        return booking.charged_total
+    total = WalletTransaction.objects.filter(
+        booking=booking, type__in=BOOKING_LEDGER_TYPES
+    ).aggregate(total=Sum(_net_charge()))["total"]
+    return (total or Decimal("0.00")).quantize(CENTS)
+
+
+def apply_wallet_change(
+    user, delta, type, booking=None, method="Wallet", note=None, amount=None
+):
+    """Change a wallet balance by ``delta`` and record the ledger entry.
+
+    ``amount`` is the (positive) amount stored on the transaction; it defaults
+    to abs(delta). Returns (new_balance, transaction). Negative balances are
+    allowed (overdraft).
+    """
+    delta = _to_amount(delta)
+    amount = _to_amount(amount if amount is not None else abs(delta))
+
+    with transaction.atomic():
+        new_balance = _add_to_balance(user.id, delta)
+        if new_balance is None:
+            UserProfile.objects.get_or_create(user=user)
+            new_balance = _add_to_balance(user.id, delta)
+        ledger_entry = WalletTransaction.objects.create(
+            user=user,
+            booking=booking,
+            type=type,
+            amount=amount,
+            method=method,
+            note=note,
+        )
+        if booking is not None and type in BOOKING_LEDGER_TYPES:
+            # Debits raise the booking's charged total, refunds lower it
+            Booking.objects.filter(pk=booking.pk).update(
+                charged_total=charged_total_increment(-delta)
+            )
+    return new_balance, ledger_entry
+
+
+def debit(user, amount, booking=None, note="Parking charge", method="Wallet"):
+    """Charge a wallet (parking_charge); returns (new_balance, transaction)"""
+    amount = _to_amount(amount)
+    return apply_wallet_change(
+        user, -amount, "parking_charge", booking=booking, method=method, note=note
+    )
+
+
+def credit(user, amount, type="topup", booking=None, note=None, method="Wallet"):
+    """Add funds to a wallet (top-up or adjustment); returns (new_balance, transaction)"""
+    amount = _to_amount(amount)
+    return apply_wallet_change(
+        user, amount, type, booking=booking, method=method, note=note
+    )
+
+
+def set_balance(user, balance, note="Balance set by admin", method="Admin"):
+    """Move a wallet to ``balance`` through an ``adjustment`` ledger row.
+
+    The row carries the signed difference, so statements and historical
+    balances still add up. Returns (new_balance, transaction), with no
+    transaction when the balance already matches.
+    """
+    balance = _to_amount(balance)
+    with transaction.atomic():
+        profile, _ = UserProfile.objects.select_for_update().get_or_create(user=user)
+        delta = balance - profile.balance
+        if not delta:
+            return profile.balance, None
+        return apply_wallet_change(
+            user, delta, "adjustment", method=method, note=note, amount=delta
+        )
+
+
+def compact_booking_charges(booking_ids=None, limit=500, dry_run=False):
+    """Merge each completed booking's parking charges into one row per day.
+
+    Progressive billing leaves one ledger row per tick; after a session ends
+    each (local) day's ticks are replaced by a single parking_charge carrying
+    that day's total, the time of its last charge and the merged ids in
+    ``compacted_from``. Rows never move across midnight, so end-of-day
+    snapshots and historical balances are unchanged, as are balances and
+    charged totals. Compacts up to ``limit`` bookings and returns a list of
+    per-booking, per-day result dicts.
+    """
+    days = (
+        WalletTransaction.objects.filter(
+            type="parking_charge", booking__status="completed"
+        )
+        .values("booking_id", day=TruncDate("created_at"))
+        .annotate(rows=Count("id"))
+        .filter(rows__gt=1)
+        .order_by("booking_id")
+    )
+    if booking_ids is not None:
+        days = days.filter(booking_id__in=booking_ids)
+    session_ids = []
+    for row in days.iterator():
+        if not session_ids or session_ids[-1] != row["booking_id"]:
+            if len(session_ids) == limit:
+                break
+            session_ids.append(row["booking_id"])
+    if not session_ids:
+        return []
+
+    groups = {}
+    for entry in WalletTransaction.objects.filter(
+        type="parking_charge", booking_id__in=session_ids
+    ).order_by("created_at", "id"):
+        key = (entry.booking_id, timezone.localdate(entry.created_at))
+        groups.setdefault(key, []).append(entry)
+
+    results, summaries, charged_at, merged_ids, kept_ids = [], [], [], [], []
+    for (booking_id, day), entries in groups.items():
+        if len(entries) == 1:
+            kept_ids.append(entries[0].id)
+            continue
+        ids = []
+        for entry in entries:
+            # Re-compaction (e.g. after a backfill correction) keeps the full trail
+            ids.extend(entry.compacted_from or [entry.id])
+        total = sum((entry.amount for entry in entries), Decimal("0.00"))
+        last = entries[-1]
+        results.append(
+            {
+                "booking_id": booking_id,
+                "day": day,
+                "rows_merged": len(entries),
+                "amount": total,
+            }
+        )
+        summaries.append(
+            WalletTransaction(
+                user_id=last.user_id,
+                booking_id=booking_id,
+                type="parking_charge",
+                amount=total,
+                method=last.method,
+                note=f"Parking session charges ({len(ids)} deductions)",
+                compacted_from=sorted(ids),
+            )
+        )
+        charged_at.append(last.created_at)
+        merged_ids.extend(entry.id for entry in entries)
+    if dry_run:
+        return results
+
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            WalletTransaction.objects.bulk_create(summaries)
+        else:
+            for summary in summaries:
+                summary.save()
+        # Summary rows keep the time of the day's last merged charge (not auto_now_add)
+        WalletTransaction.objects.filter(id__in=[s.id for s in summaries]).update(
+            created_at=Case(
+                *[
+                    When(id=summary.id, then=Value(moment))
+                    for summary, moment in zip(summaries, charged_at)
+                ],
+                output_field=DateTimeField(),
+            )
+        )
+        # Ids only grow, so this matches exactly the rows merged above
+        WalletTransaction.objects.filter(
+            type="parking_charge",
+            booking_id__in=session_ids,
+            id__lte=max(merged_ids),
+        ).exclude(id__in=kept_ids).delete()
+    return results
+
+
+def signed_amount():
+    """Balance effect of a ledger row: charges debit, top-ups and adjustments credit"""
+    return Case(
+        When(type="parking_charge", then=-F("amount")),
+        default=F("amount"),
+        output_field=MONEY,
+    )
+
+
+def with_running_totals(queryset):
+    """Annotate ``delta`` and ``newer_total`` on ledger rows.
+
+    ``newer_total`` sums the deltas from the newest row of each user's
+    (filtered) history down to and including the row, so the balance right
+    after a row is ``closing - newer_total + delta``, where ``closing`` is the
+    balance after the newest row. Filtering out newer rows (keyset pages) only
+    moves the anchor; filtering out older rows changes nothing.
+    """
+    return queryset.annotate(
+        delta=signed_amount(),
+        newer_total=Window(
+            Sum(signed_amount()),
+            partition_by=[F("user_id")],
+            order_by=[F("created_at").desc(), F("id").desc()],
+        ),
+    )
+
+
+def _ledger_total(**bounds):
+    """Subquery: net balance effect of the outer user's ledger rows in ``bounds``"""
+    totals = (
+        WalletTransaction.objects.filter(user_id=OuterRef("user_id"), **bounds)
+        .order_by()
+        .values("user_id")
+        .annotate(total=Sum(signed_amount()))
+        .values("total")[:1]
+    )
+    return Coalesce(Subquery(totals), Value(Decimal("0.00")), output_field=MONEY)
+
+
+def with_historical_balance(profiles, moment):
+    """Annotate UserProfiles with ``historical_balance`` just before ``moment``.
+
+    Uses the latest snapshot taken at or before ``moment`` plus the ledger rows
+    since it (none when the nightly job is current). Users without a snapshot
+    replay the rows after ``moment`` back from their stored balance.
+    """
+    snapshots = WalletBalanceSnapshot.objects.filter(
+        user_id=OuterRef("user_id"), as_of__lte=moment
+    ).order_by("-as_of")
+    return profiles.annotate(
+        snapshot_balance=Subquery(snapshots.values("balance")[:1]),
+        snapshot_as_of=Subquery(snapshots.values("as_of")[:1]),
+    ).annotate(
+        historical_balance=Case(
+            When(
+                snapshot_as_of__isnull=True,
+                then=F("balance") - _ledger_total(created_at__gte=moment),
+            ),
+            default=F("snapshot_balance")
+            + _ledger_total(
+                created_at__gte=OuterRef("snapshot_as_of"), created_at__lt=moment
+            ),
+            output_field=MONEY,
+        )
+    )
+
+
+def balance_at(user_id, moment=None):
+    """Balance just before ``moment`` (current balance if None)"""
+    profiles = UserProfile.objects.filter(user_id=user_id)
+    if moment is None:
+        balance = profiles.values_list("balance", flat=True).first()
+    else:
+        balance = (
+            with_historical_balance(profiles, moment)
+            .values_list("historical_balance", flat=True)
+            .first()
+        )
+    return balance if balance is not None else Decimal("0.00")
+
+
+def end_of_day(day):
+    """Aware datetime of the local midnight that ends ``day``"""
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def snapshot_balances(day):
+    """Write end-of-day balances for ``day``; returns the number of snapshots.
+
+    Covers users with ledger rows or profile changes that day, plus profiles
+    never snapshotted (the first run is a baseline for everyone). Each balance
+    is the stored balance less ledger rows after the day, so the job can run
+    any time after midnight and be re-run safely. This relies on ledger rows
+    never changing day: compact_booking_charges only merges within a day.
+    """
+    as_of = end_of_day(day)
+    start = as_of - timedelta(days=1)
+    ledger_activity = WalletTransaction.objects.filter(
+        user_id=OuterRef("user_id"), created_at__gte=start, created_at__lt=as_of
+    )
+    snapshotted = WalletBalanceSnapshot.objects.filter(user_id=OuterRef("user_id"))
+    changed = UserProfile.objects.filter(
+        Exists(ledger_activity)
+        | Q(updated_at__gte=start, updated_at__lt=as_of)
+        | ~Exists(snapshotted),
+        created_at__lt=as_of,
+    )
+    rows = changed.annotate(
+        closing=F("balance") - _ledger_total(created_at__gte=as_of)
+    ).values_list("user_id", "closing")
+    snapshots = [
+        WalletBalanceSnapshot(user_id=user_id, day=day, balance=balance, as_of=as_of)
+        for user_id, balance in rows
+    ]
+    WalletBalanceSnapshot.objects.bulk_create(
+        snapshots,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=["user", "day"],
+        update_fields=["balance", "as_of"],
+    )
+    return len(snapshots)
+
+
+def statement_page(user_id, params, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """One newest-first page of a user's ledger with ``balance_after`` per row.
+
+    Accepts cursor, page_size and from/to params. Returns
+    (rows, next_cursor, closing_balance). The first page anchors on the balance
+    at ``to``; the cursor carries the running balance, so deeper pages never
+    re-read newer history.
+    """
+    since, until = date_bounds(params)
+    size = page_size_from(params, default, maximum)
+    entries = WalletTransaction.objects.filter(user_id=user_id)
+    if since:
+        entries = entries.filter(created_at__gte=since)
+    if until:
+        entries = entries.filter(created_at__lt=until)
+    if params.get(CURSOR_PARAM):
+        moment, row_id, carried = decode_cursor(params[CURSOR_PARAM], extra=1)
+        try:
+            closing = Decimal(carried)
+        except InvalidOperation:
+            raise PaginationError("Invalid cursor")
+        entries = older_than(entries, moment, row_id, field="created_at")
+    else:
+        closing = balance_at(user_id, until)
+
+    rows = list(
+        ordered(with_running_totals(entries), field="created_at").values(
+            *STATEMENT_FIELDS, "delta", "newer_total"
+        )[: size + 1]
+    )
+    for row in rows:
+        row["balance_after"] = closing - row.pop("newer_total") + row["delta"]
+    if len(rows) <= size:
+        return rows, None, closing
+    rows = rows[:size]
+    last = rows[-1]
+    carried = str(last["balance_after"] - last["delta"])
+    return rows, encode_cursor(last, "created_at", extra=[carried]), closing
+
+
+def iter_statement(user_id=None, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Stream ledger rows with ``balance_after``, per user newest first.
+
+    ``user_id`` None exports every user. Rows come from a server-side iterator
+    and each user's anchor is joined from the profile, so memory stays constant
+    however long the history. Rows at or after ``until`` are read but not
+    yielded, as the running total starts from the stored balance.
+    """
+    entries = WalletTransaction.objects.all()
+    if user_id is not None:
+        entries = entries.filter(user_id=user_id)
+    if since:
+        entries = entries.filter(created_at__gte=since)
+    entries = (
+        with_running_totals(entries)
+        .annotate(
+            closing=Coalesce(
+                F("user__profile__balance"), Value(Decimal("0.00")), output_field=MONEY
+            )
+        )
+        .order_by("user_id", "-created_at", "-id")
+        .values(*STATEMENT_FIELDS, "delta", "newer_total", "closing")
+    )
+    for row in entries.iterator(chunk_size=chunk_size):
+        if until and row["created_at"] >= until:
+            continue
+        row["balance_after"] = (
+            row.pop("closing") - row.pop("newer_total") + row["delta"]
+        )
+        yield row
@@ -157,3 +157,100 @@ TWILIO_AUTH_TOKEN = os.environ.get(
     # "TWILIO_ACCOUNT_SID", "ACf6911308e6c77c49a82cb893aeac6a93"
 )
 TWILIO_WHATSAPP_NUMBER = "+14155238886"  # Your Twilio WhatsApp sandbox number
+
+# IoT occupancy debouncing: a slot transition is committed only after
+# "min_consistent" agreeing readings, or a majority of the last "window"
+# readings held for "stable_ms". Per-spot overrides are keyed by spot_number.
+OCCUPANCY_DEBOUNCE = {
+    "default": {"window": 3, "min_consistent": 2, "stable_ms": 4000},
+    "spots": {},
+}
+
+# Distance calibration learned by `manage.py recalibrate_sensors`
+SENSOR_CALIBRATION = {
+    "history_days": 14,
+    "min_samples": 50,
+    "drift_tolerance_cm": 10.0,
+}
+
+# Streaming sensor anomaly detection (see iot_integration/anomaly.py)
+SENSOR_ANOMALY = {
+    "flapping_rate": 0.3,
+    "stuck_readings": 120,
+    "battery_min_level": 15.0,
+    "rssi_min": -85.0,
+}
+
+# Overtime / expiry scheduler (see parking_app/overtime.py). autostart runs it
+# inside runserver; other deployments run `manage.py run_overtime_scheduler`.
+OVERTIME_SCHEDULER = {
+    "autostart": True,
+    "tick_seconds": 60,
+}
+
+# Progressive billing tick (see parking_app/billing.py). autostart runs it inside
+# runserver; other deployments run `manage.py run_billing_tick`.
+BILLING_TICK = {
+    "autostart": True,
+    "interval_seconds": 10,
+}
+
+# Outbound WhatsApp notifications (see parking_app/outbox.py). Requests only
+# queue messages; a dispatcher sends them. autostart runs it inside runserver,
+# otherwise run `manage.py dispatch_notifications`. transport "stub" sends nothing.
+NOTIFICATION_OUTBOX = {
+    "autostart": True,
+    "transport": "twilio",
+    "workers": 4,
+    "batch_size": 50,
+    "max_attempts": 5,
+    "backoff_seconds": 15,
+    "backoff_max_seconds": 900,
+}
+
+# Overtime alert / warning coalescing (see parking_app/notifications.py): at most
+# one message per user and booking per window (overtime alerts also across
+# processes, via Booking.last_alert_at), and per_user_limit per user.
+NOTIFICATION_COALESCING = {
+    "window_seconds": 900,
+    "per_user_limit": 6,
+}
+
+# Nearby lot search (see parking_app/geo.py): lots are bucketed into a grid of
+# cell_degrees cells, rebuilt at least every rebuild_seconds.
+PARKING_SEARCH = {
+    "cell_degrees": 0.01,
+    "rebuild_seconds": 60,
+    "default_k": 5,
+    "max_k": 50,
+}
+
+# Automatic spot allocation (see parking_app/allocation.py): in-memory free-spot
+# heaps, rebuilt from the database at least every rebuild_seconds.
+SPOT_ALLOCATION = {
+    "rebuild_seconds": 30,
+    "max_attempts": 20,
+}
+
+# Advance reservations (see parking_app/reservations.py): how far ahead users may
+# reserve, how often the in-memory schedule is reloaded from the database, and
+# how long an open-ended booking is assumed to hold its spot against reservations.
+PARKING_RESERVATIONS = {
+    "rebuild_seconds": 300,
+    "max_days_ahead": 30,
+    "walk_in_minutes": 60,
+}
+
+# Parking prices (see parking_app/tariffs.py). Rates are per billing unit and
+# may be overridden per spot type and per lot name; bands ("HH:MM" local time,
+# may wrap midnight) replace the unit price during part of the day, e.g.
+# "lots": {"IoT Smart Parking": {"bands": [{"start": "22:00", "end": "06:00", "unit_price": "0.50"}]}}
+PARKING_TARIFFS = {
+    "unit_seconds": 30,
+    "unit_price": "1.00",
+    "overtime_unit_seconds": 900,
+    "overtime_unit_price": "1.00",
+    "bands": [],
+    "spot_types": {},
+    "lots": {},
+}
@@ -1,6 +1,6 @@
 @echo off
-echo Starting Overtime Checker...
+echo Starting Overtime Scheduler...
 cd /d "C:\Users\CALVIN\Music\smartparking app\smartparking app\backend"
-python run_overtime_checker.py
+python manage.py run_overtime_scheduler
 pause
 